@@ -1,15 +1,182 @@
 #!/usr/bin/env python
-from pyrocko import cake
+import argparse
 import numpy as np
-import os
-import obspy.geodetics.base as gps
-import rt_functions as rt
 
-def makeinputs(input_file,nsrc,nsta,sta_dist,src_distxy,src_distz,nl,vpvs,top,v):
+"""
+Makes synthetic rayTrace inputs: rayTrace.inp, station.dat and event.dat
+
+Station and event coordinates are drawn from a seeded generator in one
+of three geometries:
+	uniform ---- stations over a sta_dist square, events over a centred
+				 src_distxy square and 0-src_distz km depth (default)
+	clustered -- events in nclusters swarms of normally distributed
+				 events around centres drawn as in uniform
+	dense ------ stations packed into a centred square of side aperture
+				 (a dense local array) with events drawn as in uniform
+Files are formatted a block of rows at a time with numpy, so tens of
+millions of lines are written in seconds.  Columns are right aligned
+in fixed-width fields (at least as wide as the %8.5f of the original
+script), which the free format readers of rayTrace and hypoDD accept.
+
+Run format: python make_inputfile.py [--nsta 20] [--nsrc 50] [--seed 0]
+			[--geometry uniform|clustered|dense] [inputfile]
+"""
+
+# Rows formatted at a time
+CHUNKSIZE = 1000000
+
+
+def format_numbers(values, decimals=0, width=0):
+	"""
+	Right aligned fixed-point text of every value, as %{width}.{decimals}f
+	(or %{width}i with decimals=0) would print it
+	###########
+	PARAMETERS:
+	values[n] (float array) ---- Values to format
+	decimals (int) ---- Digits after the decimal point
+	width (int) ---- Minimum field width; widened to fit the largest value
+	###########
+	RETURNS:
+	chars[n,width] (uint8 array) ---- ASCII characters of each field
+	###########
+	"""
+	values = np.asarray(values,dtype=float)
+	scaled = np.rint(np.abs(values)*10**decimals).astype(np.int64)
+	negative = (values < 0) & (scaled > 0)
+	# Digits before the point, the point, decimals and sign
+	ndigit = len(str(int(scaled.max())//10**decimals)) if len(scaled) else 1
+	width = max(width,ndigit+(decimals+1 if decimals else 0)+int(negative.any()))
+	chars = np.full((len(values),width),ord(' '),dtype=np.uint8)
+	col = width-1
+	for k in range(0,decimals):
+		chars[:,col] = ord('0')+scaled%10
+		scaled //= 10
+		col = col-1
+	if decimals:
+		chars[:,col] = ord('.')
+		col = col-1
+	# Units digit always, then only the significant ones
+	chars[:,col] = ord('0')+scaled%10
+	scaled //= 10
+	first = np.full(len(values),col)
+	while scaled.any():
+		col = col-1
+		more = scaled > 0
+		chars[more,col] = ord('0')+scaled[more]%10
+		first[more] = col
+		scaled //= 10
+	chars[negative,first[negative]-1] = ord('-')
+
+	return chars
+
+
+def write_rows(fileloc, columns, nrow):
+	"""
+	Write text rows built from fixed-width columns, a block at a time
+	###########
+	PARAMETERS:
+	fileloc (str) ---- Output file location
+	columns (list) ---- Each a str (the same in every row) or a function
+				returning the (n,width) uint8 characters of rows i0:i1
+	nrow (int) ---- Number of rows
+	###########
+	"""
+	with open(fileloc,'wb') as datafile:
+		for i0 in range(0,nrow,CHUNKSIZE):
+			i1 = min(i0+CHUNKSIZE,nrow)
+			parts = []
+			for column in columns:
+				if isinstance(column,str):
+					text = np.frombuffer(column.encode('ascii'),dtype=np.uint8)
+					parts.append(np.broadcast_to(text,(i1-i0,len(text))))
+				else:
+					parts.append(column(i0,i1))
+			datafile.write(np.concatenate(parts,axis=1).tobytes())
+
+
+def label_chars(prefix, index):
+	"""Left aligned labels prefix+index, padded with spaces to one width"""
+	digits = format_numbers(index)
+	width = digits.shape[1]
+	# Shift the right aligned digits to the left
+	shift = (digits == ord(' ')).sum(axis=1)
+	cols = np.arange(width)[None,:]+shift[:,None]
+	digits = np.where(cols < width,np.take_along_axis(digits,np.minimum(cols,width-1),axis=1),ord(' '))
+	text = np.frombuffer(prefix.encode('ascii'),dtype=np.uint8)
+
+	return np.concatenate([np.broadcast_to(text,(len(index),len(text))),digits.astype(np.uint8)],axis=1)
+
+
+def makecatalog(nsrc, nsta, sta_dist, src_distxy, src_distz, seed=None, geometry='uniform',
+				nclusters=10, spread=0.05, spread_z=2., aperture=0.5):
+	"""
+	Draw station and event coordinates
+	###########
+	PARAMETERS:
+	nsrc (int) ---- Number of events
+	nsta (int) ---- Number of stations
+	sta_dist (float) ---- Side of the square holding the stations (deg)
+	src_distxy (float) ---- Side of the centred square holding the events (deg)
+	src_distz (float) ---- Maximum event depth (km)
+	seed (int) ---- Seed of the random generator (optional)
+	geometry (str) ---- 'uniform', 'clustered' or 'dense'
+	nclusters (int) ---- Number of swarms for 'clustered'
+	spread (float) ---- Horizontal standard deviation of a swarm (deg)
+	spread_z (float) ---- Depth standard deviation of a swarm (km)
+	aperture (float) ---- Side of the station square for 'dense' (deg)
+	###########
+	RETURNS:
+	sta_lat, sta_lon[nsta] (float array) ---- Station coordinates
+	src_lat, src_lon, src_dep[nsrc] (float array) ---- Event coordinates
+	###########
+	"""
+	rng = np.random.default_rng(seed)
+	if geometry == 'dense':
+		sta_lat = aperture*rng.random(nsta) + (sta_dist - aperture)/2.
+		sta_lon = aperture*rng.random(nsta) + (sta_dist - aperture)/2.
+	elif geometry in ('uniform','clustered'):
+		sta_lat = sta_dist*rng.random(nsta)
+		sta_lon = sta_dist*rng.random(nsta)
+	else:
+		raise ValueError('Unknown geometry %s (use uniform, clustered or dense)' % geometry)
+	src_sqr = (sta_dist - src_distxy)/2.
+	if geometry == 'clustered':
+		cen_lat = src_distxy*rng.random(nclusters) + src_sqr
+		cen_lon = src_distxy*rng.random(nclusters) + src_sqr
+		cen_dep = src_distz*rng.random(nclusters)
+		cluster = rng.integers(0,nclusters,nsrc)
+		src_lat = cen_lat[cluster] + spread*rng.standard_normal(nsrc)
+		src_lon = cen_lon[cluster] + spread*rng.standard_normal(nsrc)
+		src_dep = np.clip(cen_dep[cluster] + spread_z*rng.standard_normal(nsrc),0.,src_distz)
+	else:
+		src_lat = src_distxy*rng.random(nsrc) + src_sqr
+		src_lon = src_distxy*rng.random(nsrc) + src_sqr
+		src_dep = src_distz*rng.random(nsrc)
+
+	return sta_lat,sta_lon,src_lat,src_lon,src_dep
+
+
+def makeinputs(input_file,nsrc,nsta,sta_dist,src_distxy,src_distz,nl,vpvs,top,v,seed=None,
+			   geometry='uniform',statfile='station.dat',eventfile='event.dat',**options):
+	"""
+	Write rayTrace.inp, station.dat and event.dat for a synthetic catalog
+	###########
+	PARAMETERS:
+	input_file (str) ---- Input file location
+	nsrc, nsta, sta_dist, src_distxy, src_distz, seed, geometry ---- As in makecatalog
+	nl (int) ---- Number of layers in velocity model
+	vpvs (float) ---- VP/VS ratio
+	top[nl] (float array) ---- Depth to top of layer (km)
+	v[nl] (float array) ---- Layer P velocities (km/s)
+	statfile (str) ---- Station file location (default station.dat)
+	eventfile (str) ---- Event file location (default event.dat)
+	options ---- nclusters, spread, spread_z, aperture (see makecatalog)
+	###########
+	"""
 	# Write to Input File
 	inputfile = open(input_file,'w')
-	inputfile.write('* RayTrac.INP: \n* --- Station File \nstation.dat \n')
-	inputfile.write('* \n* --- Event File \nevent.dat \n')
+	inputfile.write('* RayTrac.INP: \n* --- Station File \n%s \n' % statfile)
+	inputfile.write('* \n* --- Event File \n%s \n' % eventfile)
 	inputfile.write('* \n* --- Velocity Model: \n* Number of Layers \n%i \n' % nl)
 	inputfile.write('* vpvs ratio \n%2.3f \n* Top of Layers (km) \n' % vpvs)
 	for i in range(0,nl):
@@ -19,37 +186,49 @@ def makeinputs(input_file,nsrc,nsta,sta_dist,src_distxy,src_distz,nl,vpvs,top,v)
 		inputfile.write('%2.3f    ' % v[i])
 	inputfile.close()
 
+	sta_lat,sta_lon,src_lat,src_lon,src_dep = makecatalog(nsrc,nsta,sta_dist,src_distxy,src_distz,
+														  seed,geometry,**options)
+
 	# Write to station file
-	sta_lat = sta_dist*np.random.random(nsta)
-	sta_lon = sta_dist*np.random.random(nsta)
-	statfile = open('station.dat','w')
-	for i in range(0,nsta):
-		statfile.write('st%i %8.5f %8.5f \n' % (i,sta_lat[i],sta_lon[i]))
-	statfile.close()
+	write_rows(statfile,[lambda i0,i1: label_chars('st',np.arange(i0,i1)),' ',
+						 lambda i0,i1: format_numbers(sta_lat[i0:i1],5,8),' ',
+						 lambda i0,i1: format_numbers(sta_lon[i0:i1],5,8),' \n'],nsta)
 
 	# Write to event file
-	src_sqr = (sta_dist - src_distxy)/2.
-	src_lat = src_distxy*np.random.random(nsrc) + src_sqr
-	src_lon = src_distxy*np.random.random(nsrc) + src_sqr
-	src_dep = src_distz*np.random.random(nsrc)
-	eventfile = open('event.dat','w')
-	for i in range(0,nsrc):
-		eventfile.write('20200101   00000001 %8.5f %8.5f %8.5f   1.0   0.0   0.0  0.0 %8i \n' % (src_lat[i],src_lon[i],src_dep[i],i+1))
-	eventfile.close()
+	write_rows(eventfile,['20200101   00000001 ',lambda i0,i1: format_numbers(src_lat[i0:i1],5,8),' ',
+						  lambda i0,i1: format_numbers(src_lon[i0:i1],5,8),' ',
+						  lambda i0,i1: format_numbers(src_dep[i0:i1],5,8),'   1.0   0.0   0.0  0.0 ',
+						  lambda i0,i1: format_numbers(np.arange(i0+1,i1+1),0,8),' \n'],nsrc)
 
 	return
 
-################
-# Edit these lines
-input_file = '/Users/katie/Desktop/rayTrace/rayTrace.inp'
-nsrc = 50
-nsta = 20
-sta_dist = 12 # Deg
-src_distxy = 8 # Deg
-src_distz = 100 # km
-nl = 5
-vpvs = 1.75
-top = np.array([0.0,20.,35.,77.5,120.])
-v = np.array([5.8,6.5,8.04,8.045,8.05])
-
-makeinputs(input_file,nsrc,nsta,sta_dist,src_distxy,src_distz,nl,vpvs,top,v)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Make synthetic rayTrace input files')
+	parser.add_argument('inputfile',nargs='?',default='rayTrace.inp',help='Input file location (default rayTrace.inp)')
+	parser.add_argument('--nsrc',type=int,default=50,help='Number of events')
+	parser.add_argument('--nsta',type=int,default=20,help='Number of stations')
+	parser.add_argument('--seed',type=int,help='Random seed (fresh draws if not given)')
+	parser.add_argument('--geometry',choices=('uniform','clustered','dense'),default='uniform',
+						help='Station and event layout')
+	parser.add_argument('--sta-dist',type=float,default=12.,help='Side of the station square (deg)')
+	parser.add_argument('--src-distxy',type=float,default=8.,help='Side of the event square (deg)')
+	parser.add_argument('--src-distz',type=float,default=100.,help='Maximum event depth (km)')
+	parser.add_argument('--nclusters',type=int,default=10,help='Number of swarms (clustered)')
+	parser.add_argument('--spread',type=float,default=0.05,help='Horizontal swarm spread (deg, clustered)')
+	parser.add_argument('--spread-z',type=float,default=2.,help='Depth swarm spread (km, clustered)')
+	parser.add_argument('--aperture',type=float,default=0.5,help='Side of the station square (deg, dense)')
+	parser.add_argument('--station',default='station.dat',help='Station file location')
+	parser.add_argument('--event',default='event.dat',help='Event file location')
+	args = parser.parse_args()
+
+	################
+	# Velocity model, edit these lines
+	nl = 5
+	vpvs = 1.75
+	top = np.array([0.0,20.,35.,77.5,120.])
+	v = np.array([5.8,6.5,8.04,8.045,8.05])
+
+	makeinputs(args.inputfile,args.nsrc,args.nsta,args.sta_dist,args.src_distxy,args.src_distz,
+			   nl,vpvs,top,v,args.seed,args.geometry,args.station,args.event,nclusters=args.nclusters,
+			   spread=args.spread,spread_z=args.spread_z,aperture=args.aperture)
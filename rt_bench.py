@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+import argparse
+import multiprocessing
+import numpy as np
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import make_inputfile
+import rt_functions as rt
+import rt_run
+
+"""
+Benchmarks for the python version of rayTrace
+
+Synthetic catalogs are made with make_inputfile.makeinputs for every
+size (stations x events) and number of layers asked for, then read
+with rt_run and traced and written with rt_functions.partials.  For
+each run the time of every stage is printed (input parsing, delaz,
+vmodel, surface, tiddid, refract and direct from ttime, or kernel for a
+compiled backend, output writing and the rest of partials), with the
+station-event pairs traced per second and the peak memory used.  Each
+run is made in a fresh process, so the peak memory (the max resident
+size of that process, imports included) is its own.
+
+Five checks keep speedups from quietly changing the answers:
+	1. The example inputs in this folder are traced with every backend
+	   (see rt_functions.set_backend) of the python port that can be
+	   loaded and compared with rayTrace_py.src, the output of the
+	   original python port for them.  (rayTrace.src is the output of
+	   the fortran version, whose traveltimes differ from the python
+	   port.)
+	2. Pairs within a few hundred metres of the epicentre, with sources
+	   in every layer of a small model, are traced with the same
+	   backends and must be found and match the scalar ttime.
+	3. For every synthetic catalog a sample of pairs is recomputed with
+	   the scalar delaz and ttime routines (unless the fortran backend
+	   or the newton solver is timed), within rt_functions.float32_error of them for
+	   --precision float32.
+	4. For every synthetic catalog the first events are traced with
+	   every backend, layer derivatives included, and the PORTS must be
+	   identical to the python backend (the backends column).
+	5. For every synthetic catalog the first events are traced in
+	   float32 and float64, and the traveltimes must differ by no more
+	   than rt_functions.float32_error (the float32 column gives the
+	   largest difference as a fraction of that bound).
+A failed check gives a non zero exit status.  The fortran backend
+(rt_fortran.py, if built) traces with the fortran routines instead, so
+it is compared with the python backend pair by pair without failing:
+the f2py dt column gives the largest difference of the P and S
+traveltimes (s) and the number of pairs off by more than 1e-3 s.
+
+Run format: python rt_bench.py [--sizes 20x50,200x1000] [--layers 5,10]
+			[--seed 0] [--workers N] [--format text] [--backend numba]
+			[--precision float32] [--solver newton] [--fortran ./rayTrace]
+--backend times the given backend (default RT_BACKEND or python),
+--precision the given precision (default float64) and --solver the
+given direct ray solver (default RT_SOLVER or falsepos).
+With --fortran the compiled fortran rayTrace is timed on the same inputs.
+"""
+
+# Output of the original python port for the example inputs
+REFERENCE = 'rayTrace_py.src'
+
+# Backends that trace the python port, bit for bit
+PORTS = ('python','numba')
+
+# Stages reported, as recorded by rt_functions.Tracer
+STAGES = ('parse','delaz','vmodel','surface','tiddid','refract','direct','kernel','write','other')
+
+
+def model(nl):
+	"""
+	Velocity model with nl layers spanning the example model: tops from
+	0 to 120 km and P velocities increasing from 5.8 to 8.05 km/s (no
+	low velocity layer, as rt_functions.float32_error needs)
+	"""
+	return np.linspace(0.,120.,nl),np.linspace(5.8,8.05,nl)
+
+
+def read(fileloc):
+	"""Read a rayTrace.src file as rows of numbers and station labels"""
+	with open(fileloc) as srcfile:
+		rows = [line.split() for line in srcfile]
+	values = np.array([[float(x) for k,x in enumerate(row) if k != 3] for row in rows])
+
+	return values,[row[3] for row in rows]
+
+
+def check_reference():
+	"""
+	Trace the example inputs and compare with REFERENCE
+	###########
+	RETURNS:
+	ok (bool) ---- True when the output matches
+	message (str) ---- 'identical', or the largest difference found
+	###########
+	"""
+	here = os.path.dirname(os.path.abspath(__file__))
+	cwd = os.getcwd()
+	tmpdir = tempfile.mkdtemp()
+	try:
+		os.chdir(here)
+		eventfile,statfile,mod_nl,mod_ratio,mod_top,mod_v = rt_run.readinputfile('rayTrace.inp')
+		nsrc,src_cusp,src_lat,src_lon,src_dep = rt_run.readevents(eventfile)
+		nsta,sta_lab,sta_lat,sta_lon = rt_run.readstats(statfile)
+		output = os.path.join(tmpdir,'rayTrace.src')
+		rt.partials(nsrc,src_cusp,src_lat,src_lon,src_dep,nsta,sta_lab,sta_lat,sta_lon,
+					mod_nl,mod_ratio,mod_v,mod_top,output)
+		with open(REFERENCE,'rb') as a, open(output,'rb') as b:
+			if a.read() == b.read():
+				return True,'identical'
+		# Allow the last of the 6 printed digits to differ
+		ref,ref_lab = read(REFERENCE)
+		new,new_lab = read(output)
+		if ref.shape != new.shape or ref_lab != new_lab:
+			return False,'rows differ'
+		err = np.max(abs(new-ref)/np.maximum(abs(ref),1e-6))
+		return err < 1e-5,'max relative difference %g' % err
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(tmpdir)
+
+
+def check_epicentre():
+	"""
+	Trace pairs within a few hundred metres of the epicentre, where the
+	direct ray's initial bounds are already within its tolerance, for
+	sources in every layer of a small model, and compare with the
+	scalar ttime
+	###########
+	RETURNS:
+	ok (bool) ---- True when every traveltime, angle and derivative is
+				finite and the traveltimes match ttime to 1e-6 s
+	message (str) ---- 'ok', or the first problem found
+	###########
+	"""
+	v,top = np.array([4.,5.,6.,7.,8.]),np.array([0.,2.,10.,30.,100.])
+	delta,depth = np.meshgrid([0.,0.001,0.005,0.01,0.05,0.1,0.3],[1.,5.,15.,40.])
+	delta,depth = delta.ravel(),depth.ravel()
+	t,ain,dtdv,dtdtop = rt.ttime_batch(delta,depth,len(v),v,top,derivs=True)
+	if not all(np.isfinite(a).all() for a in (t,ain,dtdv,dtdtop)) or (t >= 100000.).any():
+		return False,'no ray found'
+	t0 = np.array([rt.ttime(d,z,len(v),v,top)[0] for d,z in zip(delta,depth)])
+	err = np.max(abs(t-t0))
+	return err < 1e-6,'ok' if err < 1e-6 else 'max difference %g s from ttime' % err
+
+
+def check_sample(src_lat, src_lon, src_dep, sta_lat, sta_lon, mod_nl, mod_ratio,
+				 mod_v, mod_top, ttp, tts, nsample=200, seed=0, dtype=float):
+	"""
+	Recompute a sample of pairs with the scalar delaz and ttime
+	###########
+	PARAMETERS:
+	src_dep[nsrc] (float array) ---- Source depths as read
+	ttp, tts[nsta,nsrc] (float array) ---- Traveltimes from partials
+	dtype (dtype) ---- Precision they were traced in
+	Others as in partials
+	###########
+	RETURNS:
+	nbad (int) ---- Number of sampled pairs off by more than 1e-6 s
+				(rt_functions.float32_error for float32)
+	###########
+	"""
+	rng = np.random.default_rng(seed)
+	src_dep = rt.offset_depths(src_dep,mod_nl,mod_top)
+	vs = np.zeros(mod_nl)
+	vs[:] = mod_v[:mod_nl]/mod_ratio
+	nbad = 0
+	for k in range(0,nsample):
+		i = rng.integers(len(sta_lat))
+		j = rng.integers(len(src_lat))
+		delt,dist,az = rt.delaz(src_lat[j],src_lon[j],sta_lat[i],sta_lon[i])
+		tp,ain = rt.ttime(dist,src_dep[j],mod_nl,mod_v,mod_top)
+		ts,ain = rt.ttime(dist,src_dep[j],mod_nl,vs,mod_top)
+		tolp,tols = 1e-6,1e-6
+		if np.dtype(dtype) == np.float32:
+			tolp,tols = rt.float32_error(tp,mod_v[:mod_nl]),rt.float32_error(ts,vs)
+		if abs(tp-ttp[i,j]) > tolp or abs(ts-tts[i,j]) > tols:
+			nbad = nbad+1
+
+	return nbad
+
+
+def available_backends():
+	"""Names of the backends that can be loaded"""
+	selected = rt.get_backend()[0]
+	names = []
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore')
+		for name in rt.BACKENDS:
+			if rt.set_backend(name) == name:
+				names.append(name)
+	rt.set_backend(selected)
+
+	return names
+
+
+def check_backends(src_lat, src_lon, src_dep, sta_lat, sta_lon, mod_nl, mod_ratio,
+				   mod_v, mod_top, nsrc=500, nnear=20):
+	"""
+	Trace the first nsrc events with every backend and compare with
+	the python backend.  Stations are added about 5 m from the
+	epicentres of the first nnear events, so direct rays near the
+	epicentre are compared too.
+	###########
+	PARAMETERS:
+	src_dep[nsrc] (float array) ---- Source depths as read
+	nsrc (int) ---- Number of events traced
+	nnear (int) ---- Number of events given a station by the epicentre
+	Others as in partials
+	###########
+	RETURNS:
+	bad (list) ---- PORTS whose results are not identical
+	fortran (tuple) ---- Largest difference of the P and S traveltimes
+					of the fortran backend and the number of pairs off
+					by more than 1e-3 s (None if it is not built, the
+					model has more than rt_fortran.MAXLAY layers or
+					the solver is not falsepos, which the fortran
+					routines use)
+	###########
+	"""
+	src_dep = rt.offset_depths(src_dep[:nsrc],mod_nl,mod_top)
+	sta_lat = np.append(sta_lat,src_lat[:nnear]+0.00005)
+	sta_lon = np.append(sta_lon,src_lon[:nnear])
+	args = (src_lat[:nsrc],src_lon[:nsrc],src_dep,sta_lat,sta_lon,mod_nl,mod_ratio,mod_v,mod_top)
+	selected = rt.get_backend()[0]
+	results = {}
+	try:
+		for name in available_backends():
+			rt.set_backend(name)
+			try:
+				results[name] = rt.trace_pairs(*args,derivs=True)
+			except ValueError:
+				# Too many layers for the fortran routines
+				if name in PORTS:
+					raise
+	finally:
+		rt.set_backend(selected)
+
+	bad = [name for name in results if name in PORTS and
+		   not all(np.array_equal(a,b,equal_nan=True) for a,b in zip(results[name],results['python']))]
+	fortran = None
+	if 'fortran' in results and rt.get_solver() == 'falsepos':
+		dt = np.abs(np.stack(results['fortran'][:2])-np.stack(results['python'][:2])).max(axis=0)
+		fortran = (dt.max(),int(np.count_nonzero(dt > 1e-3)))
+
+	return bad,fortran
+
+
+def check_precision(src_lat, src_lon, src_dep, sta_lat, sta_lon, mod_nl, mod_ratio,
+					mod_v, mod_top, nsrc=500):
+	"""
+	Trace the first nsrc events in float32 and float64 with the
+	selected backend
+	###########
+	PARAMETERS:
+	Same as check_backends
+	###########
+	RETURNS:
+	ratio (float) ---- Largest difference of the P and S traveltimes
+				as a fraction of rt_functions.float32_error (at most
+				1 when the bound holds)
+	###########
+	"""
+	src_dep = rt.offset_depths(src_dep[:nsrc],mod_nl,mod_top)
+	args = (src_lat[:nsrc],src_lon[:nsrc],src_dep,sta_lat,sta_lon,mod_nl,mod_ratio,mod_v,mod_top)
+	double = rt.trace_pairs(*args)
+	single = rt.trace_pairs(*args,dtype=np.float32)
+	vs = np.asarray(mod_v[:mod_nl],dtype=float)/mod_ratio
+	ratio = 0.
+	for t,t32,v in ((double[0],single[0],mod_v[:mod_nl]),(double[1],single[1],vs)):
+		ratio = max(ratio,np.max(abs(t32-t)/rt.float32_error(t,v),initial=0.))
+
+	return ratio
+
+
+def run_python(workers=1, fmt='text', backend=None, dtype=float, solver=None):
+	"""
+	Parse, trace and write the catalog in the current folder
+	###########
+	RETURNS:
+	times (dict) ---- Seconds spent in each of STAGES and 'total'
+	peak (float) ---- Max resident size of the process (MB)
+	check (int) ---- Sampled pairs off from the scalar routines (None
+					if the timed backend is not one of PORTS or the
+					solver is not falsepos)
+	bad, fortran ---- As in check_backends
+	ratio (float) ---- As in check_precision
+	###########
+	"""
+	rt.set_backend(backend)
+	rt.set_solver(solver)
+	# Load compiled kernels before the clock starts
+	for vtype in (np.float32,np.float64):
+		for ptype in (np.float32,np.float64):
+			rt.ttime_batch(np.ones(1),np.ones(1),2,np.array([1.,2.],dtype=vtype),np.array([0.,10.]),
+						   dtype=ptype)
+	tracer = rt.Tracer()
+	start = time.perf_counter()
+	eventfile,statfile,mod_nl,mod_ratio,mod_top,mod_v = rt_run.readinputfile('rayTrace.inp')
+	nsrc,src_cusp,src_lat,src_lon,src_dep = rt_run.readevents(eventfile)
+	nsta,sta_lab,sta_lat,sta_lon = rt_run.readstats(statfile)
+	parsed = time.perf_counter()
+	tmp_ttp,tmp_tts,tmp_xp,tmp_yp,tmp_zp = rt.partials(nsrc,src_cusp,src_lat,src_lon,src_dep,nsta,
+													   sta_lab,sta_lat,sta_lon,mod_nl,mod_ratio,
+													   mod_v,mod_top,'rayTrace.out',None,workers,
+													   tracer,fmt,dtype=dtype)
+	end = time.perf_counter()
+	# The high-water mark of this (fresh) process, so the run's own; a
+	# difference from a mark taken after the warm-up would read 0 for
+	# any run smaller than the imports and compiled kernels
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+	times = {'parse':parsed-start,'total':end-start}
+	for name in STAGES[1:-1]:
+		times[name] = tracer.time.get(name,0.)
+	times['other'] = times['total']-sum(times[name] for name in STAGES[:-1])
+	check = None
+	if rt.get_backend()[0] in PORTS and rt.get_solver() == 'falsepos':
+		check = check_sample(src_lat,src_lon,src_dep,sta_lat,sta_lon,mod_nl,mod_ratio,mod_v,mod_top,
+							 tmp_ttp,tmp_tts,dtype=dtype)
+	bad,fortran = check_backends(src_lat,src_lon,src_dep,sta_lat,sta_lon,mod_nl,mod_ratio,mod_v,mod_top)
+	ratio = check_precision(src_lat,src_lon,src_dep,sta_lat,sta_lon,mod_nl,mod_ratio,mod_v,mod_top)
+
+	return times,peak,check,bad,fortran,ratio
+
+
+def run_fortran(binary):
+	"""Time the fortran rayTrace on the inputs in the current folder (None if it fails)"""
+	start = time.perf_counter()
+	status = subprocess.run([os.path.abspath(binary),'rayTrace.inp'],stdout=subprocess.DEVNULL,
+							stderr=subprocess.DEVNULL).returncode
+	if status != 0:
+		return None
+
+	return time.perf_counter()-start
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark the python rayTrace')
+	parser.add_argument('--sizes',default='20x50,100x500,300x2000',
+						help='Comma separated stations x events, e.g. 20x50,1300x10800')
+	parser.add_argument('--layers',default='5,10',help='Comma separated numbers of layers')
+	parser.add_argument('--seed',type=int,default=0,help='Seed of the synthetic catalogs')
+	parser.add_argument('--workers',type=int,default=1,help='Number of processes to trace with')
+	parser.add_argument('--format',default='text',help='Output format (text, npz or raw)')
+	parser.add_argument('--backend',choices=list(rt.BACKENDS),help='Backend to time (default RT_BACKEND or python)')
+	parser.add_argument('--precision',choices=('float64','float32'),default='float64',
+						help='Precision to time (default float64)')
+	parser.add_argument('--solver',choices=list(rt.DIRECT_SOLVERS),
+						help='Direct ray solver to time (default RT_SOLVER or falsepos)')
+	parser.add_argument('--fortran',help='Compiled fortran rayTrace to time as well')
+	args = parser.parse_args()
+	sizes = [tuple(int(n) for n in size.split('x')) for size in args.sizes.split(',')]
+	layers = [int(nl) for nl in args.layers.split(',')]
+
+	failed = False
+	# The reference output and the scalar ttime use false position
+	rt.set_solver('falsepos')
+	for name in available_backends():
+		if name not in PORTS:
+			continue
+		rt.set_backend(name)
+		ok,message = check_reference()
+		print('Reference %s (%s): %s' % (REFERENCE,name,message))
+		failed = failed or not ok
+		ok,message = check_epicentre()
+		print('Near epicentre (%s): %s' % (name,message))
+		failed = failed or not ok
+	print('Timing the %s backend in %s with the %s solver' % (rt.set_backend(args.backend),args.precision,
+															   rt.set_solver(args.solver)))
+
+	header = '%11s %3s' % ('size','nl') + ''.join('%9s' % name for name in STAGES+('total',))
+	header += '%12s %9s %6s %9s %8s %14s' % ('pairs/s','peak MB','check','backends','float32','f2py dt')
+	if args.fortran is not None:
+		header += '%9s' % 'fortran'
+	print(header)
+	cwd = os.getcwd()
+	for nsta,nsrc in sizes:
+		for nl in layers:
+			tmpdir = tempfile.mkdtemp()
+			try:
+				os.chdir(tmpdir)
+				top,v = model(nl)
+				make_inputfile.makeinputs('rayTrace.inp',nsrc,nsta,12,8,100,nl,1.75,top,v,args.seed)
+				with ProcessPoolExecutor(1,mp_context=multiprocessing.get_context('spawn')) as pool:
+					times,peak,check,bad,fortran,ratio = pool.submit(run_python,args.workers,args.format,
+																	  args.backend,args.precision,
+																	  args.solver).result()
+				line = '%11s %3i' % ('%ix%i' % (nsta,nsrc),nl)
+				line += ''.join('%9.3f' % times[name] for name in STAGES+('total',))
+				line += '%12.0f %9.1f %6s %9s %8.3f %14s' % (nsta*nsrc/times['total'],peak,
+															 '-' if check is None else 'ok' if check == 0 else check,
+															 ','.join(bad) or 'ok',ratio,
+															 '-' if fortran is None else '%.3g/%i' % fortran)
+				if args.fortran is not None:
+					seconds = run_fortran(args.fortran)
+					line += '%9s' % ('failed' if seconds is None else '%.3f' % seconds)
+				print(line)
+				failed = failed or check not in (0,None) or len(bad) > 0 or ratio > 1
+			finally:
+				os.chdir(cwd)
+				shutil.rmtree(tmpdir)
+
+	sys.exit(1 if failed else 0)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+import numpy as np
+import sqlite3
+import rt_io
+
+######################################################################
+# Persistent result cache shared by rayTrace runs (SQLite file)
+######################################################################
+
+# Default size limit of the cached results (bytes)
+MAXSIZE = 2**30
+
+# Seconds a run waits for another run's write to the cache to finish
+TIMEOUT = 600.
+
+# Decimals kept of event coordinates (deg) and depths (km) in the keys
+DECIMALS = 6
+
+# splitmix64 constants
+MIX1 = np.uint64(0xbf58476d1ce4e5b9)
+MIX2 = np.uint64(0x94d049bb133111eb)
+
+
+def hash_columns(*columns):
+	"""
+	64 bit hash of each row of one or more columns, vectorized with
+	the splitmix64 finalizer
+	###########
+	PARAMETERS:
+	columns[n] (int64 or float64 arrays) ---- Columns to hash together
+	###########
+	RETURNS:
+	keys[n] (int64 array) ---- Hash of each row
+	###########
+	"""
+	h = np.zeros(len(columns[0]),dtype=np.uint64)
+	with np.errstate(over='ignore'):
+		for column in columns:
+			h ^= np.ascontiguousarray(column).view(np.uint64)
+			h ^= h >> np.uint64(30)
+			h *= MIX1
+			h ^= h >> np.uint64(27)
+			h *= MIX2
+			h ^= h >> np.uint64(31)
+
+	return h.view(np.int64)
+
+
+def station_keys(sta_lat, sta_lon):
+	"""Keys of stations, from their exact coordinates"""
+	# +0. turns -0. into 0.
+	return hash_columns(np.asarray(sta_lat,dtype=float)+0.,np.asarray(sta_lon,dtype=float)+0.)
+
+
+def event_keys(src_lat, src_lon, src_dep, decimals=DECIMALS):
+	"""Keys of events, from their coordinates and depth rounded to decimals"""
+	scale = 10.**decimals
+	return hash_columns(*[np.rint(np.asarray(x,dtype=float)*scale).astype(np.int64)
+						  for x in (src_lat,src_lon,src_dep)])
+
+
+class ResultCache(object):
+	"""
+	Content addressed store of traced station-event pairs, shared by
+	runs with the same velocity model.
+	###########
+	Each entry holds the results of one event (keyed by event_keys)
+	for one velocity model (keyed by rt_functions.model_fingerprint)
+	at every station traced for it so far: the sorted station_keys
+	and the rt_io.FIELDS arrays, as blobs (kept in their own table so
+	stamping an entry does not rewrite them).  Reading a catalog is
+	then one query per event and a searchsorted over its stations,
+	much cheaper than tracing the pairs; a row per pair would cost
+	more to read than to trace.  Catalogs that overlap a previous run
+	(more events, more stations, or both) only trace the missing
+	pairs, and store merges them into the entries.  Entries are
+	stamped with a counter advanced on every lookup and store, and
+	whenever a store takes the cache past maxsize bytes (and on close)
+	the least recently used are dropped until the rest fit.
+	###########
+	Several runs (processes) can share the file at once.  The file
+	is in WAL mode, so lookups are not blocked by another run's
+	store, and stores (and evictions) take the write lock before
+	reading the entries they merge, waiting up to timeout seconds for
+	other runs' writes, so none of their stations are lost.  Each run
+	counts its own clock from the newest stamp when it opened the
+	cache, so stamps of concurrent runs interleave only roughly.  WAL
+	needs the file on a local file system, not a network share.
+	###########
+	PARAMETERS:
+	fileloc (str) ---- SQLite file location, created if missing
+	maxsize (int) ---- Size limit of the cached results (bytes)
+	decimals (int) ---- Decimals of event coordinates kept in the keys
+	timeout (float) ---- Seconds to wait for other runs' writes
+	###########
+	"""
+	def __init__(self, fileloc, maxsize=MAXSIZE, decimals=DECIMALS, timeout=TIMEOUT):
+		self.maxsize = maxsize
+		self.decimals = decimals
+		self.hits = 0
+		self.misses = 0
+		self.db = sqlite3.connect(fileloc,timeout=timeout)
+		# Must be set before the first table so evicted pages are freed
+		self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+		# Readers and a writer from other runs don't block each other
+		self.db.execute('PRAGMA journal_mode = WAL')
+		self.db.execute('CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, model TEXT, '
+						'event INTEGER, size INTEGER, used INTEGER, UNIQUE (model,event))')
+		self.db.execute('CREATE TABLE IF NOT EXISTS blobs (id INTEGER PRIMARY KEY, stations BLOB, arrays BLOB)')
+		self.db.execute('CREATE INDEX IF NOT EXISTS lru ON entries (used)')
+		self.db.execute('CREATE TEMP TABLE wanted (event INTEGER PRIMARY KEY)')
+		self.clock = self.db.execute('SELECT COALESCE(MAX(used),0) FROM entries').fetchone()[0]
+		self.size = self.db.execute('SELECT COALESCE(SUM(size),0) FROM entries').fetchone()[0]
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		self.evict()
+		self.db.close()
+
+	def tick(self):
+		"""Advance the clock entries are stamped with and return it"""
+		self.clock += 1
+
+		return self.clock
+
+	def begin(self):
+		"""Start a write, waiting for other runs' writes to finish, so what it reads stays current"""
+		self.db.commit()
+		self.db.execute('BEGIN IMMEDIATE')
+
+	def keys(self, src_lat, src_lon, src_dep, sta_lat, sta_lon):
+		"""Event and station keys of a catalog (depths as read, before partials moves them)"""
+		return event_keys(src_lat,src_lon,src_dep,self.decimals),station_keys(sta_lat,sta_lon)
+
+	def fetch(self, model, events):
+		"""Yield (entry id, event key, station keys, arrays[8,n]) of the cached events among events"""
+		self.db.execute('DELETE FROM wanted')
+		self.db.executemany('INSERT OR IGNORE INTO wanted VALUES (?)',((k,) for k in events.tolist()))
+		rows = self.db.execute('SELECT e.id, e.event, b.stations, b.arrays FROM entries e JOIN wanted w '
+							   'ON e.event = w.event JOIN blobs b ON b.id = e.id WHERE e.model = ?',(model,))
+		for entry,event,stations,arrays in rows:
+			stations = np.frombuffer(stations,dtype=np.int64)
+			yield entry,event,stations,np.frombuffer(arrays,dtype=float).reshape(len(rt_io.FIELDS),len(stations))
+
+	def lookup(self, model, events, stations):
+		"""
+		Read the cached results of a catalog
+		###########
+		PARAMETERS:
+		model (str) ---- Velocity model fingerprint
+		events[nsrc], stations[nsta] (int64 array) ---- Keys from keys()
+		###########
+		RETURNS:
+		results (tuple) ---- The rt_io.FIELDS arrays [nsta,nsrc], NaN where missing
+		found[nsta,nsrc] (bool array) ---- Pairs read from the cache
+		###########
+		"""
+		nsta,nsrc = len(stations),len(events)
+		out = np.full((len(rt_io.FIELDS),nsta,nsrc),np.nan)
+		found = np.zeros((nsta,nsrc),dtype=bool)
+		order = np.argsort(events,kind='stable')
+		ordered = events[order]
+		clock = self.tick()
+		used = []
+		for entry,event,keys,arrays in self.fetch(model,events):
+			cols = order[np.searchsorted(ordered,event,'left'):np.searchsorted(ordered,event,'right')]
+			pos = np.minimum(np.searchsorted(keys,stations),len(keys)-1)
+			rows = np.nonzero(keys[pos] == stations)[0]
+			out[:,rows[:,None],cols] = arrays[:,pos[rows],None]
+			found[rows[:,None],cols] = True
+			used.append((clock,entry))
+		# End the read before stamping: a read upgraded to a write fails
+		# at once, without the timeout, if another run wrote meanwhile
+		self.db.commit()
+		self.db.executemany('UPDATE entries SET used = ? WHERE id = ?',used)
+		self.db.commit()
+		nfound = int(np.count_nonzero(found))
+		self.hits += nfound
+		self.misses += found.size-nfound
+
+		return tuple(out),found
+
+	def store(self, model, events, stations, results, cols):
+		"""
+		Add the results of some events to the cache, merged with the
+		stations already cached for them
+		###########
+		PARAMETERS:
+		model (str) ---- Velocity model fingerprint
+		events[nsrc], stations[nsta] (int64 array) ---- Keys from keys()
+		results (tuple) ---- The rt_io.FIELDS arrays [nsta,nsrc]
+		cols (int array) ---- Events (columns of results) to store
+		###########
+		"""
+		keys,first = np.unique(stations,return_index=True)
+		cols = np.asarray(cols)
+		# One column per distinct event
+		evts,pick = np.unique(events[cols],return_index=True)
+		cols = cols[pick]
+		self.begin()
+		cached = {event:(k,a) for entry,event,k,a in self.fetch(model,evts)}
+		clock = self.tick()
+		self.size -= self.db.execute('SELECT COALESCE(SUM(e.size),0) FROM entries e JOIN wanted w '
+									 'ON e.event = w.event WHERE e.model = ?',(model,)).fetchone()[0]
+		self.db.execute('DELETE FROM blobs WHERE id IN (SELECT e.id FROM entries e JOIN wanted w '
+						'ON e.event = w.event WHERE e.model = ?)',(model,))
+		self.db.execute('DELETE FROM entries WHERE model = ? AND event IN (SELECT event FROM wanted)',(model,))
+		for event,j in zip(evts.tolist(),cols.tolist()):
+			new = np.stack([result[first,j] for result in results])
+			if event in cached:
+				old_keys,old = cached[event]
+				keep = ~np.isin(old_keys,keys)
+				merged = np.concatenate([old_keys[keep],keys])
+				order = np.argsort(merged)
+				new = np.concatenate([old[:,keep],new],axis=1)[:,order]
+				merged = merged[order]
+			else:
+				merged = keys
+			stations_blob = merged.tobytes()
+			arrays_blob = np.ascontiguousarray(new).tobytes()
+			size = len(stations_blob)+len(arrays_blob)
+			entry = self.db.execute('INSERT INTO entries (model,event,size,used) VALUES (?,?,?,?)',
+									(model,event,size,clock)).lastrowid
+			self.db.execute('INSERT INTO blobs VALUES (?,?,?)',(entry,stations_blob,arrays_blob))
+			self.size += size
+		self.db.commit()
+		if self.size > self.maxsize:
+			self.evict()
+
+	def evict(self):
+		"""Drop the least recently used entries until the rest fit in maxsize bytes"""
+		self.begin()
+		total = self.db.execute('SELECT COALESCE(SUM(size),0) FROM entries').fetchone()[0]
+		if total > self.maxsize:
+			drop = []
+			for entry,size in self.db.execute('SELECT id, size FROM entries ORDER BY used'):
+				if total <= self.maxsize:
+					break
+				drop.append((entry,))
+				total -= size
+			self.db.executemany('DELETE FROM entries WHERE id = ?',drop)
+			self.db.executemany('DELETE FROM blobs WHERE id = ?',drop)
+		self.size = total
+		# Give free pages back to the file system.  Each step of the
+		# pragma frees one page and executescript steps it to the end
+		self.db.executescript('PRAGMA incremental_vacuum;')
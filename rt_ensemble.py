@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+import argparse
+import glob
+import itertools
+import numpy as np
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import rt_functions as rt
+import rt_io
+import rt_run
+
+"""
+Ensemble traveltimes for rayTrace
+
+Traces one catalog (the events and stations of an input file) through
+many velocity models, e.g. Monte Carlo perturbations of mod_v, mod_top
+and mod_ratio.  The station-event geometry (delaz) is computed once and
+only ttime is run per model, in turn or by a pool of processes, so a
+few hundred models cost a few hundred traveltime sweeps instead of as
+many full rt_run.py runs.
+
+The models are read from either
+	a .npz file with v[nmodels,nl] and optionally top[nmodels,nl] or
+		top[nl] and ratio[nmodels] or a single ratio (missing ones are
+		taken from the input file), or
+	a directory of rayTrace input files, of which only the velocity
+		models are used (in the order of their file names).
+Models are traced in the precision they are given in: input files are
+read as float32 like rt_run.py, so a .npz of float32 v and top gives the
+same traveltimes as rt_run.py for the same model.
+
+The P and S traveltimes go to a raw file (see rt_io.create_raw) holding
+cusp[nsrc], sta_lab[nsta], the models (v, top[nmodels,nl], ratio[nmodels])
+and ttp, tts[nmodels,nsta,nsrc]; with --stats also the mean and standard
+deviation over the models of every pair (ttp_mean, ttp_std, tts_mean,
+tts_std[nsta,nsrc]), updated as each model is traced.  Load it with
+rt_io.load_raw.
+
+Run format: python rt_ensemble.py inputfile models outputfile [--workers N] [--stats]
+"""
+
+
+def load_models(fileloc, base):
+	"""
+	Read a stack of velocity models
+	###########
+	PARAMETERS:
+	fileloc (str) ---- .npz file or directory of input files (see above)
+	base (VelocityModel) ---- Model of the input file, for missing top and ratio
+	###########
+	RETURNS:
+	models (list) ---- VelocityModel of each member
+	###########
+	"""
+	if os.path.isdir(fileloc):
+		models = []
+		for inputfile in sorted(glob.glob(os.path.join(fileloc,'*.inp'))):
+			eventfile,statfile,mod_nl,mod_ratio,mod_top,mod_v = rt_run.readinputfile(inputfile)
+			models.append(rt.VelocityModel(mod_nl,mod_ratio,mod_v,mod_top))
+	else:
+		with np.load(fileloc) as stack:
+			v = np.atleast_2d(stack['v'])
+			top = stack['top'] if 'top' in stack.files else base.top
+			ratio = stack['ratio'] if 'ratio' in stack.files else base.ratio
+		top = np.broadcast_to(top,v.shape)
+		ratio = np.broadcast_to(ratio,v.shape[:1])
+		models = [rt.VelocityModel(v.shape[1],float(ratio[k]),v[k],top[k]) for k in range(0,len(v))]
+	if not models:
+		raise ValueError('No velocity models in %s' % fileloc)
+	if len(set(model.nl for model in models)) > 1:
+		raise ValueError('The models of an ensemble must have the same number of layers')
+
+	return models
+
+
+class RunningStats(object):
+	"""
+	Mean and standard deviation of a stream of same-shaped arrays,
+	updated one array at a time (Welford's algorithm), so a whole
+	ensemble never has to be held in memory.
+	###########
+	PARAMETERS:
+	shape (tuple) ---- Shape of the arrays
+	###########
+	"""
+	def __init__(self, shape):
+		self.n = 0
+		self.mean = np.zeros(shape)
+		self.m2 = np.zeros(shape)
+
+	def update(self, x):
+		"""Add one array"""
+		self.n += 1
+		delta = x-self.mean
+		self.mean += delta/self.n
+		self.m2 += delta*(x-self.mean)
+
+	@property
+	def std(self):
+		"""Standard deviation (over n, like numpy.std)"""
+		return np.sqrt(self.m2/max(self.n,1))
+
+
+# Geometry shared by the worker processes of trace_ensemble
+shared = {}
+
+def init_worker(dist, src_dep):
+	shared['dist'] = dist
+	shared['src_dep'] = src_dep
+
+
+def trace_model(model):
+	"""P and S traveltimes [nsta,nsrc] of the shared geometry through one VelocityModel"""
+	src_dep = model.offset_depths(shared['src_dep'])
+	ttp,ain = rt.ttime_batch(shared['dist'],src_dep[None,:],model.nl,model.v,model.top)
+	tts,ain = rt.ttime_batch(shared['dist'],src_dep[None,:],model.nl,model.vs,model.top)
+
+	return ttp,tts
+
+
+def iterensemble(events, stations, models, workers=1):
+	"""
+	Trace a catalog through each model in turn
+	###########
+	PARAMETERS:
+	events (EventSet) ---- Events (depths as read)
+	stations (StationSet) ---- Stations
+	models (list) ---- VelocityModel of each member
+	workers (int) ---- Number of processes to trace with (default 1)
+	###########
+	RETURNS:
+	Generator of (ttp, tts) [nsta,nsrc] arrays, in the order of models
+	###########
+	"""
+	delt,dist,az = rt.delaz_pairs(events.lat,events.lon,stations.lat,stations.lon)
+	if workers <= 1:
+		init_worker(dist,events.dep)
+		for model in models:
+			yield trace_model(model)
+		return
+	with ProcessPoolExecutor(workers,initializer=init_worker,initargs=(dist,events.dep)) as pool:
+		# Keep two models per worker in flight and yield them in order
+		models = iter(models)
+		pending = deque(pool.submit(trace_model,model) for model in itertools.islice(models,2*workers))
+		while pending:
+			future = pending.popleft()
+			for model in itertools.islice(models,1):
+				pending.append(pool.submit(trace_model,model))
+			yield future.result()
+
+
+def trace_ensemble(events, stations, models, fileloc=None, stats=False, workers=1):
+	"""
+	Traveltimes of a catalog through every model of an ensemble
+	###########
+	PARAMETERS:
+	events (EventSet) ---- Events (depths as read)
+	stations (StationSet) ---- Stations
+	models (list) ---- VelocityModel of each member
+	fileloc (str) ---- Raw file to write the cube to (in memory if None)
+	stats (bool) ---- Also keep the mean and standard deviation of each pair
+	workers (int) ---- Number of processes to trace with (default 1)
+	###########
+	RETURNS:
+	arrays (dict) ---- ttp, tts[nmodels,nsta,nsrc] (memory-mapped when
+				written to fileloc) and with stats ttp_mean, ttp_std,
+				tts_mean, tts_std[nsta,nsrc]
+	###########
+	"""
+	nmodels,nsta,nsrc,nl = len(models),len(stations),len(events),models[0].nl
+	cube = (nmodels,nsta,nsrc)
+	if fileloc is not None:
+		sta_lab = np.asarray(stations.lab,dtype=str)
+		fields = [('cusp',events.cusp.dtype.str,(nsrc,)),('sta_lab',sta_lab.dtype.str,(nsta,)),
+				  ('v','<f8',(nmodels,nl)),('top','<f8',(nmodels,nl)),('ratio','<f8',(nmodels,)),
+				  ('ttp','<f8',cube),('tts','<f8',cube)]
+		if stats:
+			fields += [(name,'<f8',(nsta,nsrc)) for name in ('ttp_mean','ttp_std','tts_mean','tts_std')]
+		rt_io.create_raw(fileloc,fields,{'ensemble':nmodels})
+		arrays = rt_io.load_raw(fileloc,mode='r+')
+		arrays['cusp'][:] = events.cusp
+		arrays['sta_lab'][:] = sta_lab
+		arrays['v'][:] = [model.v for model in models]
+		arrays['top'][:] = [model.top for model in models]
+		arrays['ratio'][:] = [model.ratio for model in models]
+	else:
+		arrays = {'ttp':np.zeros(cube),'tts':np.zeros(cube)}
+	running = {'ttp':RunningStats((nsta,nsrc)),'tts':RunningStats((nsta,nsrc))} if stats else {}
+	for k,(ttp,tts) in enumerate(iterensemble(events,stations,models,workers)):
+		arrays['ttp'][k] = ttp
+		arrays['tts'][k] = tts
+		if stats:
+			running['ttp'].update(ttp)
+			running['tts'].update(tts)
+	for name,moments in running.items():
+		if fileloc is None:
+			arrays[name+'_mean'],arrays[name+'_std'] = moments.mean,moments.std
+		else:
+			arrays[name+'_mean'][:],arrays[name+'_std'][:] = moments.mean,moments.std
+	if fileloc is not None:
+		for array in arrays.values():
+			array.flush()
+
+	return arrays
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Trace a rayTrace catalog through an ensemble of velocity models')
+	parser.add_argument('inputfile',help='Input file with the events, stations and base velocity model')
+	parser.add_argument('models',help='.npz stack of models (v, optional top and ratio) or directory of input files')
+	parser.add_argument('outputfile',help='Raw file for the traveltime cube')
+	parser.add_argument('--workers',type=int,default=1,help='Number of processes to trace with')
+	parser.add_argument('--stats',action='store_true',help='Also write the mean and standard deviation of each pair')
+	args = parser.parse_args()
+
+	raytracer = rt_run.RayTracer.from_inputfile(args.inputfile)
+	models = load_models(args.models,raytracer.model)
+	start = time.time()
+	trace_ensemble(raytracer.events,raytracer.stations,models,args.outputfile,args.stats,args.workers)
+	print('Traced %i models of %i station-event pairs in %.1f s.  Output located in %s' %
+		  (len(models),raytracer.nsta*raytracer.nsrc,time.time()-start,args.outputfile))
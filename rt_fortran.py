@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+import glob
+import numpy as np
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+"""
+Fortran backend for rt_functions.ttime_batch
+
+Wraps the HypoDD routines bundled in this folder (vmodel.f, refract.f,
+tiddid.f, direct1.f) with f2py, driven by ttime_pairs.f, which traces
+every pair as ttime.f does.  Arrays are passed straight to the compiled
+routines, with no rayTrace.src in between.  The traveltimes are those
+of the fortran rayTrace, not of the python port: the routines work in
+single precision, direct1.f adds vsq*sqrt(...) per layer where direct
+has vsq+sqrt(...), the direct ray wins only if strictly faster, and a
+low velocity layer below the event layer is handled by refract.f
+instead of raising.  rt_bench.py compares the two pair by pair.
+
+Build the extension (_rt_fortran) once with gfortran and numpy.f2py:
+	python rt_fortran.py
+The routines are compiled from copies without their debugging print
+statements.  Then select it with rt_functions.set_backend('fortran'),
+RT_BACKEND=fortran or rt_run.py --backend fortran.  Velocity models
+may have at most MAXLAY layers (rayTrace.inc).
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Fortran sources of the extension
+SOURCES = ('ttime_pairs.f','vmodel.f','refract.f','tiddid.f','direct1.f')
+
+
+def maxlay(fileloc=os.path.join(HERE,'rayTrace.inc')):
+	"""MAXLAY set in rayTrace.inc (the routines also hold 20 layers at most)"""
+	with open(fileloc) as incfile:
+		for line in incfile:
+			match = re.search(r'MAXLAY\s*=\s*(\d+)',line)
+			if match and line[:1].lower() != 'c':
+				return min(int(match.group(1)),20)
+
+	raise ValueError('No MAXLAY parameter in %s' % fileloc)
+
+
+# Largest velocity model the routines hold
+MAXLAY = maxlay()
+
+
+def build(directory=HERE):
+	"""
+	Compile the _rt_fortran extension into directory with numpy.f2py
+	###########
+	RETURNS:
+	fileloc (str) ---- Location of the built extension
+	###########
+	"""
+	tmpdir = tempfile.mkdtemp()
+	try:
+		# Copies without the debugging prints of refract.f and tiddid.f
+		for name in SOURCES+('rayTrace.inc',):
+			with open(os.path.join(HERE,name)) as source:
+				lines = [line for line in source if not re.match(r'\s+print\s*\*',line,re.I)]
+			with open(os.path.join(tmpdir,name),'w') as copy:
+				copy.writelines(lines)
+		result = subprocess.run([sys.executable,'-m','numpy.f2py','-c','-m','_rt_fortran','-I'+tmpdir,
+								 *SOURCES,'only:','ttime_pairs',':'],cwd=tmpdir,stdout=subprocess.PIPE,
+								stderr=subprocess.STDOUT,universal_newlines=True)
+		if result.returncode != 0:
+			raise RuntimeError('f2py failed:\n%s' % result.stdout)
+		built = glob.glob(os.path.join(tmpdir,'_rt_fortran*.so'))+glob.glob(os.path.join(tmpdir,'_rt_fortran*.pyd'))
+		fileloc = os.path.join(directory,os.path.basename(built[0]))
+		shutil.move(built[0],fileloc)
+	finally:
+		shutil.rmtree(tmpdir)
+
+	return fileloc
+
+
+try:
+	import _rt_fortran
+except ImportError as error:
+	if __name__ != '__main__':
+		raise ImportError('%s; build it with python rt_fortran.py' % error)
+
+
+def ttime_pairs(nl, v, top, vsq, thk, jl, tkj, depth, isrc, delta):
+	"""
+	ttime of every pair with the fortran routines
+	###########
+	PARAMETERS:
+	As rt_numba.ttime_pairs; vsq, thk, jl and tkj are recomputed by
+	vmodel.f in single precision
+	###########
+	RETURNS:
+	As rt_numba.ttime_pairs, with the takeoff angles of the fortran
+	routines, no iteration counts and no low velocity layer errors
+	###########
+	"""
+	if nl > MAXLAY:
+		raise ValueError('The fortran backend takes at most %i layers (MAXLAY), not %i' % (MAXLAY,nl))
+	t,ain,kk,u,x,near = _rt_fortran.ttime_pairs(np.asarray(v[:nl],dtype=np.float32),
+												np.asarray(top[:nl],dtype=np.float32),
+												np.asarray(depth[isrc],dtype=np.float32),
+												np.asarray(delta,dtype=np.float32))
+	# Fortran layers count from 1
+	kk = np.where(kk > 0,kk-1,kk)
+	ain = np.where(kk == 0,np.nan,ain)
+
+	return (t.astype(float),ain.astype(float),kk,u.astype(float),x.astype(float),near.astype(bool),
+			None,np.zeros(len(t),dtype=bool))
+
+
+if __name__ == '__main__':
+	print('Built %s' % build())
@@ -1,6 +1,16 @@
 #!/usr/bin/env python
+import hashlib
+import importlib
+import itertools
 import numpy as np
 import os
+import time
+import warnings
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import rt_io
 
 ######################################################################
 # Function definitions for rayTrace subroutines taken from HypoDD v1.3
@@ -49,15 +59,17 @@ def direct(nl, v, vsq, thk, jl, tkj, delta, depth):
 		u = delta/r
 		x = delta
 		return tdir,u,x
-	# Otherwise find the fastest layer, lmax
+	# Otherwise find the fastest layer, lmax (the first if tied)
 	lmax = jl
 	tklmax = tkj
 	vlmax = v[jl]
-	for l in range(0,jl):
-		if v[l]>vlmax:
-			lmax = l
-			tklmax = thk[l]
-			vlmax = v[l]
+	l = np.argmax(v[:jl])
+	if v[l]>vlmax:
+		lmax = l
+		tklmax = thk[l]
+		vlmax = v[l]
+	# vsq[jl]/vsq[l] of the layers above the event
+	c = vsq[jl]/vsq[:jl]
 	# Min layer thickness
 	if tklmax <= 0.05:
 		tklmax = 0.05
@@ -77,28 +89,23 @@ def direct(nl, v, vsq, thk, jl, tkj, delta, depth):
 		xb = delta
 	else:
 		xb = tkj*ub/np.sqrt(1.0-ubsq)
-	dela = xa
-	delb = xb
-	for l in range(0,jl):
-		dela = dela + thk[l]*ua/np.sqrt(vsq[jl]/vsq[l]-uasq)
-		ubdiv = np.sqrt(vsq[jl]/vsq[l]-ubsq)
-		if ubdiv < 1e-20:
-			ubdiv = 1e-20
-		delb = delb+thk[l]*ub/np.sqrt(vsq[jl]/vsq[l]-ubsq)
+	dela = add_layers(xa,thk[:jl]*ua/np.sqrt(c-uasq))
+	delb = add_layers(xb,thk[:jl]*ub/np.sqrt(c-ubsq))
 	# Loop to find the zero of delt-delta by the method of false position
 	for count in range(0,25):
 		if (delb-dela) < 0.02:
 			x = 0.5*(xa+xb)
 			u = x/np.sqrt(x**2 + tkj**2)
 			usq = u**2
+			if count == 0:
+				# Initial bounds already within 0.02 km (near the epicentre)
+				delt = add_layers(x,thk[:jl]*u/np.sqrt(c-usq))
 			break
 		else:
 			x = xa+(delta-dela)*(xb-xa)/(delb-dela)
 			u = x/np.sqrt(x**2 + tkj**2)
 			usq = u**2
-			delt = x
-			for l in range(0,jl):
-				delt = delt+thk[l]*u/np.sqrt(vsq[jl]/vsq[l]-usq)
+			delt = add_layers(x,thk[:jl]*u/np.sqrt(c-usq))
 			xtest = delt-delta
 			if abs(xtest)<0.02:
 				break
@@ -109,14 +116,27 @@ def direct(nl, v, vsq, thk, jl, tkj, delta, depth):
 				xb = x
 				delb = delt
 	# Calculate direct-ray travel time
-	tdir = np.sqrt(x**2 + tkj**2)/v[jl]
-	for l in range(0,jl):
-		tdir = tdir+thk[l]*v[jl]/(vsq[l]+np.sqrt(vsq[jl]/vsq[l]-usq))
+	tdir = add_layers(np.sqrt(x**2 + tkj**2)/v[jl],thk[:jl]*v[jl]/(vsq[:jl]+np.sqrt(c-usq)))
 	tdir = tdir - (u/v[jl])*(delt-delta)
 
 	return tdir, u, x
 
 
+def add_layers(first, terms):
+	"""
+	first + terms[0] + terms[1] + ... added in that order, as the
+	Fortran loops over layers do, so results don't depend on the
+	number of layers summed at once.  terms has the layers first
+	(shape [nlayers] or [nlayers,n]).
+	"""
+	stack = np.empty((len(terms)+1,)+np.shape(terms)[1:],dtype=np.result_type(first,terms))
+	stack[0] = first
+	stack[1:] = terms
+	# Running sums are sequential, unlike sum(), which adds pairwise
+	# when the layers are contiguous
+	return np.cumsum(stack,axis=0,out=stack)[-1]
+
+
 def vmodel(nl, v, top, depth):
 	"""
 	Extract needed information from the velocity model
@@ -136,16 +156,15 @@ def vmodel(nl, v, top, depth):
 	"""
 	# Calculate vsq
 	vsq = np.zeros(nl)
-	for i in range(0,nl):
-		vsq[i] = v[i]**2
+	# Squared one at a time as before: NumPy rounds float32 scalar
+	# powers differently from array ones in the last bit
+	vsq[:] = [vi**2 for vi in v[:nl]]
 	# Layer thicknesses
 	thk = np.zeros(nl)
-	jl = nl
-	for i in reversed(range(0,nl)):
-		if depth <= top[i]:
-			jl = i-1
-	for i in range(0,nl-1):
-		thk[i] = top[i+1] - top[i]
+	thk[:nl-1] = top[1:nl] - top[:nl-1]
+	# Event layer is the one above the first top below the source
+	below = np.nonzero(depth <= top[:nl])[0]
+	jl = below[0]-1 if len(below) else nl
 	# Depth from top of layer to source
 	tkj = depth-top[jl]
 
@@ -167,41 +186,41 @@ def tiddid(jl, nl, v, vsq, thk):
 	thk[nl] (float array) ---- Thicknesses of each layer
 	###########
 	RETURNS:
-	tid[20] (float array) ---- Travel time intercept for refraction in each layer
-	real[20] (float array) ---- Critical distance each layer
+	tid[nl] (float array) ---- Travel time intercept for refraction in each layer
+	did[nl] (float array) ---- Critical distance each layer
 	##########
 	"""
-	tid = np.zeros(20)
-	did = np.zeros(20)	
-	j1=jl+1
-	for m in range(jl,nl):
-		tid[m] = 0
-		did[m] = 0
-		tid1 = 0
-		tid2 = 0
-		did1 = 0
-		did2 = 0
-		for l in range(0,m):
-			if vsq[m] <= vsq[l]:
-				# m is a low velocity layer
-				# set tid and did to large values
-				tid[m] = 100000.
-				did[m] = 100000.
-			else:
-				sqt = np.sqrt(vsq[m]-vsq[l])
-				tim = thk[l]*sqt/(v[l]*v[m])
-				dimm = thk[l]*v[l]/sqt
-				if l < jl:
-					# sum for layers above event layers
-					tid1 = tid1 + tim
-					did1 = did1 + dimm
-				else:
-					# sum for layers below and including event layer
-					tid2 = tid2 + tim
-					did2 = did2 + dimm
-		if tid[m] != 100000.:
-			tid[m] = tid1 + 2*tid2
-			did[m] = did1 + 2*did2
+	tid = np.zeros(nl,dtype=np.asarray(vsq).dtype)
+	did = np.zeros(nl,dtype=tid.dtype)
+	m = np.arange(jl,nl)
+	if len(m) == 0 or m[-1] == 0:
+		return tid,did
+	# m is a low velocity layer if a layer above is as fast:
+	# set tid and did to large values
+	fastest = np.maximum.accumulate(vsq[:nl])
+	lvl = np.zeros(len(m),dtype=bool)
+	lvl[m > 0] = vsq[m[m > 0]] <= fastest[m[m > 0]-1]
+	tid[m[lvl]] = 100000.
+	did[m[lvl]] = 100000.
+	m = m[~lvl & (m > 0)]
+	if len(m) == 0:
+		return tid,did
+	# Terms of layer l (columns) for refraction in layer m (rows),
+	# zero for l >= m
+	l = np.arange(0,m[-1])
+	above = l[None,:] < m[:,None]
+	sqt = np.sqrt(np.where(above,vsq[m,None]-vsq[None,l],1.))
+	tim = np.where(above,thk[l]*sqt/(v[l]*v[m,None]),0.)
+	dimm = np.where(above,thk[l]*v[l]/sqt,0.)
+	# Sums for layers above the event layer, then for layers below
+	# and including it
+	j = max(jl,0)
+	tid1 = add_layers(0.,tim[:,:j].T)
+	did1 = add_layers(0.,dimm[:,:j].T)
+	tid2 = add_layers(0.,tim[:,j:].T)
+	did2 = add_layers(0.,dimm[:,j:].T)
+	tid[m] = tid1 + 2*tid2
+	did[m] = did1 + 2*did2
 
 	return tid,did
 
@@ -262,7 +281,59 @@ def delaz(alat, alon, blat, blon):
 	return delt, dist, az
 
 
-def refract(nl, v, vsq, thk, jl, tkj, delta):
+def refract_terms(nl, v, vsq, thk, jl, tkj):
+	"""
+	Station independent part of refract.  The travel time
+	intercepts, critical distances and xovmax bound only depend
+	on the velocity model and the source depth, so they can be
+	reused for every receiver of an event (see LayerCache).
+	###########
+	PARAMETERS:
+	nl (int) ---- Number of layers
+	v[nl] (float array) ---- Velocity of layers
+	vsq[nl] (float array) ---- Squared velocities
+	thk[nl] (float array) ---- Thickness of layers
+	jl (int) ---- Event layer
+	tkj (float) ---- Depth of event in event layer
+	###########
+	RETURNS:
+	tid[nl] (float array) ---- Travel time intercepts from tiddid
+	did[nl] (float array) ---- Critical distances from tiddid
+	tinj[nl] (float array) ---- Travel time intercepts from the source depth
+	didj[nl] (float array) ---- Critical distances from the source depth
+	xovmax (float) ---- Bound on delta for a direct first arrival when
+					a refracted ray exists (None if the layer below
+					the event layer is a low velocity layer)
+	###########
+	"""
+	tinj = np.zeros(nl)
+	didj = np.zeros(nl)
+	tid,did = tiddid(jl,nl,v,vsq,thk)
+	# Layers below the event layer that are not low velocity layers
+	m = np.arange(jl+1,nl)
+	m = m[tid[m] != 100000.]
+	sqt = np.sqrt(vsq[m] - vsq[jl])
+	tinj[m] = tid[m] - tkj*sqt/(v[m]*v[jl])
+	didj[m] = did[m] - tkj*v[jl]/sqt
+	# Find lx (the 1st layer below the event layer which is 
+	# not a low velocity layer)
+	lx = jl+1
+	if lx >= nl or tid[lx] == 100000.:
+		xovmax = None
+	elif jl == 0:
+		# Event is in the first layer
+		xovmax = tinj[lx]*v[lx]*v[0]/(v[lx] - v[0])
+	else:
+		# tid[jl+1] is finite, so jx (the 1st layer above and
+		# including the event layer which is not a low velocity
+		# layer) is lx
+		jx = lx
+		xovmax = (tinj[lx] - tid[jx])*v[lx]*v[jx]/(v[lx]*v[jx])
+
+	return tid,did,tinj,didj,xovmax
+
+
+def refract(nl, v, vsq, thk, jl, tkj, delta, terms=None):
 	"""
 	Find "refracted" ray with smallest travel time
 	###########
@@ -282,6 +353,7 @@ def refract(nl, v, vsq, thk, jl, tkj, delta):
 	jl (int) ---- Event layer
 	tkj (float) ---- Depth of event in event layer
 	delta (float) ---- Horizontal distance between event and receiver
+	terms (tuple) ---- Output of refract_terms for this event (optional)
 	###########
 	RETURNS:
 	kk (int)) ---- Refracting layer for fasted refracted ray
@@ -290,71 +362,199 @@ def refract(nl, v, vsq, thk, jl, tkj, delta):
 					direct ray can be the first arrival
 	###########
 	"""	
-	tr = np.zeros(nl)
-	tinj = np.zeros(nl)
-	didj = np.zeros(nl)
+	if terms is None:
+		terms = refract_terms(nl,v,vsq,thk,jl,tkj)
+	tid,did,tinj,didj,xovmax = terms
 	# Determine tref, kk, didjkk
-	print('Before tiddid')
-	tid,did = tiddid(jl,nl,v,vsq,thk)
-	print('After tiddid',tid,did)
 	tref = 100000.
-	j1 = jl+1
-	for m in range(j1,nl):
-		if tid[m] == 100000.:
-			tr[m] = 100000.
-		else:
-			sqt = np.sqrt(vsq[m] - vsq[jl])
-			tinj[m] = tid[m] - tkj*sqt/(v[m]*v[jl])
-			didj[m] = did[m] - tkj*v[jl]/sqt
-			tr[m] = tinj[m] + delta/v[m]
-			if didj[m] > delta:
-				tr[m] = 100000.
-		if tr[m] < tref:
-			tref = tr[m]
-			kk = m
+	m = np.arange(jl+1,nl)
+	tr = tinj[m] + delta/v[m]
+	tr[(tid[m] == 100000.) | (didj[m] > delta)] = 100000.
+	if len(tr) and tr.min() < tref:
+		# The first of the fastest layers
+		l = np.argmin(tr)
+		tref = tr[l]
+		kk = m[l]
 	# If there's no refracted ray
 	if tref == 100000.:
 		xovmax = 100000.
 		kk = 0
 		return kk, tref, xovmax
-	# If threre's a refracted ray, determine xovmx:
-	# Find lx (the 1st layer below the event layer which is 
-	# not a low velocity layer)
-	m = jl+1
-	if tid[m] == 100000.:
-		m = m+1
-	else:
-		lx = m
-	# Check if the event is in the first layer
-	if jl == 0:
-		xovmax = tinj[lx]*v[lx]*v[0]/(v[lx] - v[0])
-		return kk, tref, xovmax
-	m = jl
-	# Find jx, the 1st layer above and including the
-	# event layer which is not a low velocity layer
-	# Decide whether or not jx=1 and calulate xovmax
-	while m > 0 and tid[m+1] == 100000.:
-		tid[m] = 0.
-		m1 = m-1
-		for l in range(0,m1):
-			if vsq[m] < vsq[l]:
-				tid[m] = 100000.
-			else:
-				sqt = sqrt(vsq[m] - vsq[l])
-				tim = thk[l]*sqt/(v[l]*v[m])
-				tid[m] = tid[m] + tim
-		m = m-1
-
-	if tid[m+1] < 100000.:
-		jx = m+1
-		xovmax = (tinj[lx] - tid[jx])*v[lx]*v[jx]/(v[lx]*v[jx])
-	else:
-		xovmax = tinj[lx]*v[lx]*v[0]/(v[lx] - v[0])
+	if xovmax is None:
+		raise RuntimeError('Low velocity layer below event layer %i' % jl)
 
 	return kk, tref, xovmax
 
 
-def ttime(delta, depth, nl, v, top):
+class LayerCache(object):
+	"""
+	Cache of the station independent work in ttime.
+	###########
+	vmodel and refract_terms only depend on the velocity model and
+	the source depth, so one entry serves every station of an event.
+	Entries are keyed by (v, top, depth); P and S models share one
+	cache.  The least recently used entry is dropped once maxsize
+	entries are held.
+	###########
+	PARAMETERS:
+	maxsize (int) ---- Maximum number of cached (model, depth) entries
+	###########
+	"""
+	def __init__(self, maxsize=100000):
+		self.maxsize = maxsize
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def terms(self, nl, v, top, depth):
+		"""
+		Return the layer terms for a source depth, computing them on a miss
+		###########
+		PARAMETERS:
+		nl (int) ---- Number of layers in velocity model
+		v[nl] (float array) ---- Velocity in each layer
+		top[nl] (float array) ---- Depth to top of layer
+		depth (float) ---- Focal depth of source in km
+		###########
+		RETURNS:
+		vsq, thk, jl, tkj ---- Outputs of vmodel
+		terms (tuple) ---- Output of refract_terms
+		###########
+		"""
+		key = (nl,np.asarray(v).tobytes(),np.asarray(top).tobytes(),depth)
+		entry = self.entries.get(key)
+		if entry is not None:
+			self.hits += 1
+			self.entries.move_to_end(key)
+			return entry
+		self.misses += 1
+		vsq,thk,jl,tkj = vmodel(nl,v,top,depth)
+		entry = (vsq,thk,jl,tkj,refract_terms(nl,v,vsq,thk,jl,tkj))
+		self.entries[key] = entry
+		if len(self.entries) > self.maxsize:
+			self.entries.popitem(last=False)
+
+		return entry
+
+	def clear(self):
+		self.entries.clear()
+		self.hits = 0
+		self.misses = 0
+
+
+class Tracer(object):
+	"""
+	Opt-in instrumentation for the ray tracing routines.
+	###########
+	Pass a Tracer to partials, ttime or ttime_batch to record the
+	number of calls and the cumulative time spent in each subroutine,
+	how many pairs were won by the direct or the refracted ray and a
+	histogram of the iterations taken by the direct ray solver.  Per
+	event layer it also keeps the pairs traced, the pairs close enough
+	(delta <= xovmax) for the direct ray to be solved for, the pairs
+	it won and the time spent, so report can single out hot layers.
+	Without a tracer the routines skip all of this.
+	###########
+	"""
+	def __init__(self):
+		self.calls = OrderedDict()
+		self.time = OrderedDict()
+		self.rays = OrderedDict([('direct',0),('refracted',0)])
+		self.iterations = np.zeros(0,dtype=int)
+		self.layers = {}
+
+	def record(self, name, seconds, calls=1):
+		"""Add calls and elapsed seconds to a subroutine"""
+		self.calls[name] = self.calls.get(name,0) + calls
+		self.time[name] = self.time.get(name,0.) + seconds
+
+	def ray(self, name, count=1):
+		"""Count pairs won by the 'direct' or 'refracted' ray"""
+		self.rays[name] += count
+
+	def iterate(self, niter):
+		"""Add the direct ray solver iterations of each pair to the histogram"""
+		self.count_iterations(np.bincount(np.asarray(niter,dtype=int)))
+
+	def layer(self, jl, pairs, near, direct, seconds):
+		"""Add pairs, direct ray solves, direct ray wins and seconds to event layer jl"""
+		counts = self.layers.setdefault(int(jl),[0,0,0,0.])
+		counts[0] += int(pairs)
+		counts[1] += int(near)
+		counts[2] += int(direct)
+		counts[3] += seconds
+
+	def count_iterations(self, counts):
+		"""Add a histogram of iterations (counts[k] pairs took k iterations)"""
+		n = max(len(self.iterations),len(counts))
+		self.iterations = np.pad(self.iterations,(0,n-len(self.iterations)))
+		self.iterations[:len(counts)] += counts
+
+	def merge(self, other):
+		"""Add the counts of another Tracer (e.g. from a worker process)"""
+		for name in other.calls:
+			self.record(name,other.time[name],other.calls[name])
+		for name in other.rays:
+			self.ray(name,other.rays[name])
+		self.count_iterations(other.iterations)
+		for jl,counts in other.layers.items():
+			self.layer(jl,*counts)
+
+	def summary(self):
+		"""Return the counts as a printable table"""
+		lines = ['%-12s %10s %12s' % ('Subroutine','Calls','Time (s)')]
+		for name in self.calls:
+			lines.append('%-12s %10i %12.4f' % (name,self.calls[name],self.time[name]))
+		total = max(1,sum(self.rays.values()))
+		for name in self.rays:
+			lines.append('%-12s %10i %11.1f%%' % (name+' ray',self.rays[name],100.*self.rays[name]/total))
+		near = sum(counts[1] for counts in self.layers.values())
+		if near > 0:
+			lines.append('%-12s %10i %11.1f%%' % ('direct solve',near,100.*near/total))
+		if self.iterations.sum() > 0:
+			mean = np.dot(np.arange(len(self.iterations)),self.iterations)/self.iterations.sum()
+			lines.append('%-12s %10.2f %12s' % ('direct iter',mean,'max %i' % (len(self.iterations)-1)))
+
+		return '\n'.join(lines)
+
+	def report(self):
+		"""
+		Return the counts as a dict of plain types, for json
+		###########
+		RETURNS:
+		report (dict) ---- With keys
+			subroutines: {name: {calls, time}} in order of first call
+			rays: {direct, refracted} pairs won by each ray
+			direct_solves: {pairs, fraction} pairs with delta <= xovmax
+			direct_iterations: {histogram, mean, max} of the direct
+				ray solver (histogram[k] pairs took k iterations)
+			layers: [{layer, pairs, direct_solves, direct_rays, time}]
+				per event layer, the most time first
+		###########
+		"""
+		total = sum(self.rays.values())
+		near = sum(counts[1] for counts in self.layers.values())
+		solved = int(self.iterations.sum())
+		mean = float(np.dot(np.arange(len(self.iterations)),self.iterations)/solved) if solved else 0.
+		layers = sorted(self.layers.items(),key=lambda item: -item[1][3])
+
+		return OrderedDict([
+			('subroutines',OrderedDict((name,OrderedDict([('calls',int(self.calls[name])),
+														  ('time',float(self.time[name]))]))
+									   for name in self.calls)),
+			('rays',OrderedDict((name,int(count)) for name,count in self.rays.items())),
+			('direct_solves',OrderedDict([('pairs',near),('fraction',near/total if total else 0.)])),
+			('direct_iterations',OrderedDict([('histogram',self.iterations.tolist()),('mean',mean),
+											  ('max',max(len(self.iterations)-1,0))])),
+			('layers',[OrderedDict([('layer',jl),('pairs',counts[0]),('direct_solves',counts[1]),
+									('direct_rays',counts[2]),('time',counts[3])])
+					   for jl,counts in layers])])
+
+
+def ttime(delta, depth, nl, v, top, cache=None, tracer=None, derivs=False):
 	"""
 	This function determines the fastest traveltime between
 	a source at depth=depth and a receiver at distance=delta(km)
@@ -365,44 +565,1750 @@ def ttime(delta, depth, nl, v, top):
 	nl (int) ---- Number of layers in velocity model
 	v[nl] (float array) ---- Velocity in each layer
 	top[nl] (float array) ---- Fepth to top of layer
+	cache (LayerCache) ---- Reuse layer terms across calls (optional)
+	tracer (Tracer) ---- Record calls, time and ray branch (optional)
+	derivs (bool) ---- Also return the derivatives of t with respect
+					to each layer (see ray_derivatives)
 	###########
 	RETURNS:
 	t (float) ---- Minimum traveltime
 	ain (float) ---- Angle of emergences at the source
+	dtdv[nl], dtdtop[nl] (float array) ---- dt/dv and dt/dtop of each
+					layer (only if derivs=True)
 	###########
 	"""
-	print('Before vmodel ')
-	vsq,thk,jl,tkj = vmodel(nl,v,top,depth)
-	print('After vmodel. ',vsq,thk,jl,tkj)
-	print('Before refract')
-	kk,tref,xovmax = refract(nl,v,vsq,thk,jl,tkj,delta)
-	print('After refract ',kk,tref,xovmax)
+	if tracer is not None:
+		start = begin = time.perf_counter()
+	if cache is None:
+		vsq,thk,jl,tkj = vmodel(nl,v,top,depth)
+		terms = None
+	else:
+		vsq,thk,jl,tkj,terms = cache.terms(nl,v,top,depth)
+	if tracer is not None:
+		tracer.record('vmodel',time.perf_counter()-start)
+		start = time.perf_counter()
+	kk,tref,xovmax = refract(nl,v,vsq,thk,jl,tkj,delta,terms)
+	if tracer is not None:
+		tracer.record('refract',time.perf_counter()-start)
 	# if delta <= xovmax, call direct to find the direct
 	# ray traveltime otherwise tref is the minimum traveltime
 	t = tref
+	ray = 'refracted'
 	if kk > 0:
 		u=v[jl]/v[kk]
 		ain = np.arcsin(u)*57.2958
 	if delta <= xovmax:
-		print('Before direct ')
+		if tracer is not None:
+			start = time.perf_counter()
 		tdir,u,x = direct(nl,v,vsq,thk,jl,tkj,delta,depth)
-		print('After direct ',tdir,u,x)
+		if tracer is not None:
+			tracer.record('direct',time.perf_counter()-start)
 		# compare traveltimes
 		if tref >= tdir:
 			t = tdir
 			ain = 180 - np.arcsin(u)*57.2958
+			ray = 'direct'
+	if tracer is not None:
+		tracer.ray(ray)
+		tracer.layer(jl,1,delta <= xovmax,ray == 'direct',time.perf_counter()-begin)
+	if derivs:
+		if ray == 'direct':
+			kk = -1
+		else:
+			u = v[jl]/v[kk] if kk > 0 else 0.
+			x = 0.
+		dtdv,dtdtop = ray_derivatives(nl,v,thk,np.array([jl]),np.array([tkj]),np.array([delta]),
+									  np.array([kk]),np.array([u]),np.array([x]))
+		return t,ain,dtdv[0],dtdtop[0]
 
 	return t,ain
 
 
+######################################################################
+# Batched versions of the subroutines above.  These take arrays of
+# station-event pairs and reproduce the scalar routines pair for pair.
+######################################################################
+
+# Pairs per chunk of the batched routines, small enough for the CPU cache
+CHUNK = 16384
+
+def delaz_points(lat, lon):
+	"""
+	Per point terms of delaz_pairs: sine and cosine of the geocentric
+	colatitude, of the longitude and of half the latitude, and the
+	cotangent of the colatitude
+	"""
+	# Same constants as delaz
+	pi2 = 1.570796
+	rad = 1.745329e-2
+	flat = .993231
+	latr = np.asarray(lat,dtype=float)*rad
+	lonr = np.asarray(lon,dtype=float)*rad
+	col = pi2 - np.arctan(flat*np.tan(latr))
+
+	return (np.sin(col),np.cos(col),np.sin(lonr),np.cos(lonr),np.sin(latr/2.),np.cos(latr/2.),
+			1./np.tan(col))
+
+
+def delaz_block(a, b):
+	"""delaz_pairs from the delaz_points terms of sources a to stations b"""
+	pi2 = 1.570796
+	rad = 1.745329e-2
+	sina,cosa,sinla,cosla,sinha,cosha,cota = a
+	sinb,cosb,sinlb,coslb,sinhb,coshb,cotb = b
+	# Calculate delta, with diflon = blonr-alonr
+	# cosdel = sina*sinb*cos(diflon) + cosa*cosb
+	cosdel = np.stack([sinb*coslb,sinb*sinlb,cosb],axis=1) @ np.stack([sina*cosla,sina*sinla,cosa])
+	delr = np.arccos(cosdel,out=cosdel)
+	# Calculate azimuth from a to b
+	# top = sin(diflon), den = sina/tan(bcol) - cos(diflon)*cosa
+	top = np.stack([sinlb,-coslb],axis=1) @ np.stack([cosla,sinla])
+	den = np.stack([cotb,-coslb,-sinlb],axis=1) @ np.stack([sina,cosla*cosa,sinla*cosa])
+	az = np.arctan2(top,den,out=top)
+	# Convert to degrees
+	delt = delr/rad
+	az /= rad
+	az[az < 0.0] += 360.
+	# Compute distance in km
+	# cos(colat) with colat = pi2 - (alatr+blatr)/2 (pi2 is not exactly pi/2)
+	c,s = np.cos(pi2),np.sin(pi2)
+	coscol = np.stack([c*coshb+s*sinhb,s*coshb-c*sinhb],axis=1) @ np.stack([cosha,sinha])
+	coscol *= coscol
+	radius = np.subtract(1/3,coscol,out=coscol)
+	radius *= 3.37853e-3
+	radius += 1.0
+	radius *= 6378.137
+	dist = np.multiply(delr,radius,out=den)
+
+	return delt, dist, az
+
+
+def delaz_pairs(src_lat, src_lon, sta_lat, sta_lon, dtype=float):
+	"""
+	delaz from every source to every station.  The trigonometric terms
+	of each point (geocentric colatitude, longitude and half latitude)
+	are computed once per point.  Expanded with the angle-sum
+	identities, cos(delta), the azimuth terms and cos(colat) are dot
+	products of short per-point vectors, so each is one matrix product;
+	only arccos and arctan2 are left per pair.  Agrees with delaz to
+	float rounding.
+	###########
+	Pairs are always worked in double precision: cos(delta) of pairs a
+	few km apart is within float32 rounding of 1, so arccos would lose
+	them.  For a narrower dtype the results are computed CHUNK pairs
+	(whole station rows) at a time and stored rounded, so only the
+	outputs are full size.
+	###########
+	PARAMETERS:
+	src_lat, src_lon[nsrc] (float array) ---- Source coordinates (first points)
+	sta_lat, sta_lon[nsta] (float array) ---- Station coordinates (second points)
+	dtype (dtype) ---- Type of the results (default float64)
+	###########
+	RETURNS:
+	delt[nsta,nsrc] (float array) ---- Central angles (degrees)
+	dist[nsta,nsrc] (float array) ---- Distances (km)
+	az[nsta,nsrc] (float array) ---- Azimuths from source to station (degrees)
+	###########
+	"""
+	a = delaz_points(src_lat,src_lon)
+	b = delaz_points(sta_lat,sta_lon)
+	if np.dtype(dtype) == np.float64:
+		return delaz_block(a,b)
+	nsta,nsrc = len(b[0]),len(a[0])
+	out = tuple(np.empty((nsta,nsrc),dtype=dtype) for k in range(0,3))
+	rows = max(1,CHUNK//max(1,nsrc))
+	for i0 in range(0,nsta,rows):
+		for result,block in zip(out,delaz_block(a,tuple(x[i0:i0+rows] for x in b))):
+			result[i0:i0+rows] = block
+
+	return out
+
+
+def vmodel_batch(nl, v, top, depth):
+	"""
+	Array version of vmodel for many source depths
+	###########
+	PARAMETERS:
+	nl (int) ---- Number of layers in velocity model
+	v[nl] (float array) ---- Velocity in each layer
+	top[nl] (float array) ---- Depth to top of layer
+	depth[n] (float array) ---- Focal depths of sources in km
+	###########
+	RETURNS:
+	vsq[nl] (float array) ---- Squared velocities
+	thk[nl] (float array) ---- Thicknesses of layers
+	jl[n] (int array) ---- Event layer of each source
+	tkj[n] (float array) ---- Depth of each source in its event layer
+	###########
+	"""
+	top = np.asarray(top)
+	depth = np.asarray(depth)
+	# Calculate vsq, in the wider precision of depth and v
+	dtype = np.promote_types(depth.dtype,np.asarray(v).dtype)
+	vsq = np.zeros(nl,dtype=dtype)
+	# Squared one at a time as before: NumPy rounds float32 scalar
+	# powers differently from array ones in the last bit
+	vsq[:] = [vi**2 for vi in v[:nl]]
+	# Layer thicknesses
+	thk = np.zeros(nl,dtype=dtype)
+	thk[:nl-1] = top[1:nl] - top[:nl-1]
+	# Event layer is the one above the first top below the source
+	below = depth[...,None] <= top[:nl]
+	jl = np.where(below.any(axis=-1), np.argmax(below,axis=-1)-1, nl)
+	# Depth from top of layer to source
+	tkj = depth-top[jl]
+
+	return vsq,thk,jl,tkj
+
+
+def refract_terms_batch(nl, v, vsq, thk, jl, tkj):
+	"""
+	Array version of refract_terms for many sources in event layer jl
+	###########
+	PARAMETERS:
+	nl (int) ---- Number of layers
+	v[nl] (float array) ---- Velocity of layers
+	vsq[nl] (float array) ---- Squared velocities
+	thk[nl] (float array) ---- Thickness of layers
+	jl (int) ---- Event layer (same for all sources)
+	tkj[n] (float array) ---- Depth of each source in event layer
+	###########
+	RETURNS:
+	tid[nl] (float array) ---- Travel time intercepts from tiddid
+	did[nl] (float array) ---- Critical distances from tiddid
+	tinj[nl,n] (float array) ---- Travel time intercepts from each source
+	didj[nl,n] (float array) ---- Critical distances from each source
+	xovmax[n] (float array) ---- Bound on delta for a direct first arrival
+					(nan if the layer below is a low velocity layer)
+	###########
+	"""
+	n = len(tkj)
+	tinj = np.zeros((nl,n),dtype=tkj.dtype)
+	didj = np.zeros((nl,n),dtype=tkj.dtype)
+	# Travel time intercepts only depend on the event layer
+	tid,did = tiddid(jl,nl,v,vsq,thk)
+	m = np.arange(jl+1,nl)
+	m = m[tid[m] != 100000.]
+	sqt = np.sqrt(vsq[m] - vsq[jl])[:,None]
+	tinj[m] = tid[m,None] - tkj*sqt/(v[m]*v[jl])[:,None]
+	didj[m] = did[m,None] - tkj*v[jl]/sqt
+	lx = jl+1
+	if lx >= nl or tid[lx] == 100000.:
+		xovmax = np.full(n,np.nan,dtype=tkj.dtype)
+	elif jl == 0:
+		xovmax = tinj[lx]*v[lx]*v[0]/(v[lx] - v[0])
+	else:
+		jx = lx
+		xovmax = (tinj[lx] - tid[jx])*v[lx]*v[jx]/(v[lx]*v[jx])
+
+	return tid,did,tinj,didj,xovmax
+
+
+def refract_batch(nl, v, vsq, thk, jl, tkj, delta, terms=None, src=None):
+	"""
+	Array version of refract for many pairs sharing event layer jl.
+	The fastest layer of CHUNK pairs at a time is found with an
+	argmin over the layers, gathering the terms of each pair's
+	source, so the work grows with nl but memory does not.
+	###########
+	PARAMETERS:
+	nl (int) ---- Number of layers
+	v[nl] (float array) ---- Velocity of layers
+	vsq[nl] (float array) ---- Squared velocities
+	thk[nl] (float array) ---- Thickness of layers
+	jl (int) ---- Event layer (same for all pairs)
+	tkj[n] (float array) ---- Depth of event in event layer
+	delta[n] (float array) ---- Horizontal distance between event and receiver
+	terms (tuple) ---- Output of refract_terms_batch for these pairs (optional)
+	src[n] (int array) ---- Column of terms for each pair (default
+					one column per pair)
+	###########
+	RETURNS:
+	kk[n] (int array) ---- Refracting layer for fastest refracted ray
+	tref[n] (float array) ---- Travel time of fastest refracted ray
+	xovmax[n] (float array) ---- Upper bound on delta for which the
+					direct ray can be the first arrival
+	###########
+	"""
+	if terms is None:
+		terms = refract_terms_batch(nl,v,vsq,thk,jl,tkj)
+	tid,did,tinj,didj,xovmax = terms
+	n = len(delta)
+	if src is None:
+		src = np.arange(n)
+	xovmax = xovmax[src]
+	tref = np.full(n,100000.,dtype=np.result_type(delta,tinj))
+	kk = np.zeros(n,dtype=int)
+	# Layers below the event layer that are not low velocity layers
+	m = np.arange(jl+1,nl)
+	m = m[tid[m] != 100000.]
+	if len(m):
+		tinj = tinj[m]
+		didj = didj[m]
+		vm = v[m,None]
+		for i0 in range(0,n,CHUNK):
+			i1 = min(i0+CHUNK,n)
+			d = delta[i0:i1]
+			j = src[i0:i1]
+			tr = tinj[:,j] + d/vm
+			tr[didj[:,j] > d] = 100000.
+			# First of the fastest layers, as the loop over m finds
+			l = np.argmin(tr,axis=0)
+			trl = tr[l,np.arange(i1-i0)]
+			faster = trl < 100000.
+			tref[i0:i1][faster] = trl[faster]
+			kk[i0:i1][faster] = m[l[faster]]
+	# No refracted ray
+	found = tref != 100000.
+	if np.isnan(xovmax[found]).any():
+		raise RuntimeError('Low velocity layer below event layer %i' % jl)
+	xovmax = np.where(found,xovmax,100000.)
+
+	return kk, tref, xovmax
+
+
+def direct_batch(nl, v, vsq, thk, jl, tkj, delta, depth, iters=False):
+	"""
+	Array version of direct for many pairs sharing event layer jl.
+	The false position iterations run on all unconverged pairs at once.
+	###########
+	PARAMETERS:
+	nl (int) ---- Number of layers in v model
+	v (float array) ---- Layer wave speeds with length nl
+	vsq (float array) ---- Squares of wave speed with length nl
+	thk (float array) ---- Layer thicknesses with length nl
+	jl (int) ---- Index of event layer (same for all pairs)
+	tkj[n] (float array) ---- Depth of event within layer jl
+	delta[n] (float array) ---- Epicentral distance
+	depth[n] (float array) ---- Event depth
+	iters (bool) ---- Also return the iterations of each pair
+	###########
+	RETURNS:
+	tdir[n] (float array) ---- Direct-ray travel time
+	u[n] (float array) ---- Sine of the take-off angle
+	x[n] (float array) ---- Horizontal travel distance in event layer
+	niter[n] (int array) ---- Iterations of each pair (only if iters=True)
+	###########
+	"""
+	# Surface layer events
+	if jl==0:
+		r = np.sqrt(depth**2 + delta**2)
+		tdir = r/v[0]
+		u = delta/r
+		x = delta
+		if iters:
+			return tdir,u,x,np.zeros(len(delta),dtype=int)
+		return tdir,u,x
+	# Fastest layer between the event and the surface (the first if tied)
+	lmax = jl
+	vlmax = v[jl]
+	l = np.argmax(v[:jl])
+	if v[l]>vlmax:
+		lmax = l
+		vlmax = v[l]
+	# vsq[jl]/vsq[l] and thicknesses of the layers above the event
+	c = (vsq[jl]/vsq[:jl])[:,None]
+	h = thk[:jl,None]
+	if lmax == jl:
+		tklmax = tkj
+	else:
+		tklmax = np.full(len(tkj),thk[lmax])
+	tklmax = np.where(tklmax <= 0.05, 0.05, tklmax)
+	# Initial bounds on sine of takeoff angle
+	ua = (v[jl]/vlmax)*delta/np.sqrt(delta**2 + depth**2)
+	ub = (v[jl]/vlmax)*delta/np.sqrt(delta**2 + tklmax**2)
+	uasq = np.where(ua**2 >= 1, 0.9999, ua**2)
+	ubsq = np.where(ub**2 >= 1, 0.9999, ub**2)
+	xa = tkj*ua/np.sqrt(1.0-uasq)
+	if lmax == jl:
+		xb = np.array(delta,dtype=ua.dtype)
+	else:
+		xb = tkj*ub/np.sqrt(1.0-ubsq)
+	dela = add_layers(xa,h*ua/np.sqrt(c-uasq))
+	delb = add_layers(xb,h*ub/np.sqrt(c-ubsq))
+	# False position on every unconverged pair
+	n = len(delta)
+	x = np.zeros(n,dtype=xa.dtype)
+	u = np.zeros(n,dtype=xa.dtype)
+	usq = np.zeros(n,dtype=xa.dtype)
+	delt = np.full(n,np.nan,dtype=xa.dtype)
+	niter = np.zeros(n,dtype=int)
+	active = np.arange(n)
+	for count in range(0,25):
+		close = (delb[active]-dela[active]) < 0.02
+		i = active[close]
+		x[i] = 0.5*(xa[i]+xb[i])
+		u[i] = x[i]/np.sqrt(x[i]**2 + tkj[i]**2)
+		usq[i] = u[i]**2
+		if count == 0:
+			# Initial bounds already within 0.02 km (near the epicentre)
+			delt[i] = add_layers(x[i],h*u[i]/np.sqrt(c-usq[i]))
+		i = active[~close]
+		if len(i) == 0:
+			break
+		niter[i] += 1
+		xi = xa[i]+(delta[i]-dela[i])*(xb[i]-xa[i])/(delb[i]-dela[i])
+		ui = xi/np.sqrt(xi**2 + tkj[i]**2)
+		usqi = ui**2
+		delti = add_layers(xi,h*ui/np.sqrt(c-usqi))
+		x[i] = xi
+		u[i] = ui
+		usq[i] = usqi
+		delt[i] = delti
+		xtest = delti-delta[i]
+		done = abs(xtest)<0.02
+		lower = ~done & (xtest < 0.0)
+		upper = ~done & ~(xtest < 0.0)
+		xa[i[lower]] = xi[lower]
+		dela[i[lower]] = delti[lower]
+		xb[i[upper]] = xi[upper]
+		delb[i[upper]] = delti[upper]
+		active = i[~done]
+	# Direct-ray travel time
+	tdir = add_layers(np.sqrt(x**2 + tkj**2)/v[jl],h*v[jl]/(vsq[:jl,None]+np.sqrt(c-usq)))
+	tdir = tdir - (u/v[jl])*(delt-delta)
+
+	if iters:
+		return tdir, u, x, niter
+	return tdir, u, x
+
+
+def direct_newton(nl, v, vsq, thk, jl, tkj, delta, depth, iters=False, tol=0.02, maxiter=25):
+	"""
+	Direct ray solved by safeguarded Newton iterations, for many pairs
+	sharing event layer jl.
+	###########
+	The horizontal distance travelled by a ray leaving at sine u,
+		X(u) = tkj*u/sqrt(1-u**2) + sum_l thk[l]*u/sqrt(c[l]-u**2)
+	with c[l] = vsq[jl]/vsq[l] over the layers above the event, blows
+	up as u nears umax = min(1, sqrt(c)).  Writing
+		u = umax*s/sqrt(1+s**2),  c-u**2 = (c-umax**2) + umax**2/(1+s**2)
+	turns the blow up into a straight line in s, where Newton steps
+	with the analytic derivative
+		dX/ds = (tkj/(1-u**2)**1.5 + sum_l thk[l]*c[l]/(c[l]-u**2)**1.5)*umax/(1+s**2)**1.5
+	converge quickly.  Steps leaving the bracket [lo, hi] around the
+	root fall back to bisection (or doubling while hi is open).  The
+	layer sums are taken over all layers at once.  Iterations stop
+	when |X - delta| < tol (the 0.02 km of direct) and the traveltime
+	is then computed as in direct, so the two agree to that tolerance.
+	###########
+	PARAMETERS:
+	Same as direct_batch, plus
+	tol (float) ---- Tolerance on the horizontal distance (km)
+	maxiter (int) ---- Max number of iterations
+	###########
+	RETURNS:
+	Same as direct_batch
+	###########
+	"""
+	if jl==0:
+		return direct_batch(nl,v,vsq,thk,jl,tkj,delta,depth,iters)
+	delta = np.asarray(delta)
+	n = len(delta)
+	# Work in the precision of the pairs and model, as direct_batch
+	dtype = np.result_type(delta,tkj,vsq)
+	c = np.append(vsq[jl]/vsq[:jl],1.).astype(dtype)[:,None]
+	h = np.append(thk[:jl],0.).astype(dtype)[:,None]
+	umax = float(np.sqrt(c.min()))
+	cm = c - umax**2
+	# Start from the straight ray to the surface (the lower bound of direct)
+	u0 = umax*delta/np.sqrt(delta**2 + depth**2)
+	s = u0/np.sqrt(umax**2 - np.minimum(u0,0.999*umax)**2)
+	lo = np.zeros(n,dtype=dtype)
+	hi = np.full(n,np.inf,dtype=dtype)
+	u = np.zeros(n,dtype=dtype)
+	delt = np.zeros(n,dtype=dtype)
+	gu = np.zeros(n,dtype=dtype)
+	niter = np.zeros(n,dtype=int)
+	active = np.arange(n)
+	for count in range(0,maxiter+1):
+		si = s[active]
+		g = umax**2/(1. + si*si)
+		ui = si*np.sqrt(g)
+		# c-u**2 and 1-u**2 without cancellation near umax
+		csq = cm + g
+		jsq = (1. - umax**2) + g
+		tk = tkj[active]
+		delti = tk*ui/np.sqrt(jsq) + np.sum(h*ui/np.sqrt(csq),axis=0)
+		u[active] = ui
+		gu[active] = g
+		delt[active] = delti
+		f = delti-delta[active]
+		done = abs(f) < tol
+		active = active[~done]
+		if len(active) == 0 or count == maxiter:
+			break
+		keep = ~done
+		si,f = si[keep],f[keep]
+		niter[active] += 1
+		# Keep the root bracketed
+		below = f < 0.
+		lo[active[below]] = si[below]
+		hi[active[~below]] = si[~below]
+		# Newton step in s
+		slope = tk[keep]/jsq[keep]**1.5 + np.sum(h*c/csq[:,keep]**1.5,axis=0)
+		slope *= (g[keep]/umax**2)**1.5*umax
+		step = si - f/slope
+		lo_a,hi_a = lo[active],hi[active]
+		out = ~((step > lo_a) & (step < hi_a))
+		step[out] = np.where(np.isinf(hi_a[out]),2.*np.maximum(si[out],1.),0.5*(lo_a[out]+hi_a[out]))
+		s[active] = step
+	# 1-u**2 and c-u**2 of the final u, again without cancellation
+	x = tkj*u/np.sqrt((1. - umax**2) + gu)
+	# Direct-ray travel time, as in direct
+	tdir = add_layers(np.sqrt(x**2 + tkj**2)/v[jl],h[:jl]*v[jl]/(vsq[:jl,None]+np.sqrt(cm[:jl]+gu)))
+	tdir = tdir - (u/v[jl])*(delt-delta)
+
+	if iters:
+		return tdir, u, x, niter
+	return tdir, u, x
+
+
+# Direct ray solvers selectable in ttime_batch (see set_solver)
+DIRECT_SOLVERS = OrderedDict([('falsepos',direct_batch),('newton',direct_newton)])
+
+# Direct ray solver in use, picked on first use by set_solver
+solver = {'name':None}
+
+def set_solver(name=None):
+	"""
+	Select the direct ray solver of ttime_batch (and so partials):
+	'falsepos' (direct_batch, the method of HypoDD) or 'newton'
+	(direct_newton).  Newton takes fewer iterations, which pays off
+	with many layers above the events, and its traveltimes are within
+	a few ms of the fully converged direct ray, where false position
+	can stop up to seconds off (it stalls on some rays).  So the
+	output differs from the default.  Compiled backends only run
+	falsepos; with newton ttime_batch uses the NumPy routines.
+	###########
+	PARAMETERS:
+	name (str) ---- Key of DIRECT_SOLVERS (default the RT_SOLVER
+					environment variable, else 'falsepos')
+	###########
+	RETURNS:
+	name (str) ---- Solver in use
+	###########
+	"""
+	if name is None:
+		name = os.environ.get('RT_SOLVER','falsepos')
+	if name not in DIRECT_SOLVERS:
+		raise ValueError('Unknown solver %r (one of %s)' % (name,', '.join(DIRECT_SOLVERS)))
+	solver['name'] = name
+
+	return name
+
+
+def get_solver():
+	"""Name of the direct ray solver in use (see set_solver)"""
+	if solver['name'] is None:
+		set_solver()
+
+	return solver['name']
+
+
+def surface_batch(nl, v, vsq, thk, tkj, delta, depth, counts=False):
+	"""
+	ttime for pairs whose event lies in the surface layer (jl=0).
+	The direct ray has a closed form there, so it is computed for
+	every pair and compared with the head waves, which are built
+	straight from the tiddid intercepts without the per-depth terms
+	of refract_terms_batch.  Pairs are worked in place in chunks of
+	CHUNK so the temporaries stay in cache.  Same results as
+	refract_batch and direct_batch with jl=0.
+	###########
+	PARAMETERS:
+	nl (int) ---- Number of layers
+	v[nl] (float array) ---- Velocity of layers
+	vsq[nl] (float array) ---- Squared velocities
+	thk[nl] (float array) ---- Thickness of layers
+	tkj[n] (float array) ---- Depth of event in the surface layer
+	delta[n] (float array) ---- Epicentral distance
+	depth[n] (float array) ---- Event depth
+	counts (bool) ---- Also return the number of pairs with delta <= xovmax
+	###########
+	RETURNS:
+	t[n] (float array) ---- Minimum traveltime
+	ain[n] (float array) ---- Angle of emergence at the source
+	kk[n] (int array) ---- Refracting layer of the fastest ray, -1 for the direct ray
+	near (int) ---- Pairs with delta <= xovmax (only if counts=True)
+	###########
+	"""
+	tid,did = tiddid(0,nl,v,vsq,thk)
+	lvl = nl < 2 or tid[1] == 100000.
+	n = len(delta)
+	dtype = np.result_type(delta,tkj,tid)
+	t = np.empty(n,dtype=dtype)
+	ain = np.full(n,np.nan,dtype=dtype)
+	kk = np.empty(n,dtype=int)
+	work = np.empty((3,min(n,CHUNK)),dtype=dtype)
+	mask = np.empty((2,min(n,CHUNK)),dtype=bool)
+	near = 0
+	for i0 in range(0,n,CHUNK):
+		i1 = min(i0+CHUNK,n)
+		tc,kc,dc,zc = t[i0:i1],kk[i0:i1],delta[i0:i1],tkj[i0:i1]
+		tr,tmp,r = work[:,:i1-i0]
+		faster,beyond = mask[:,:i1-i0]
+		# Fastest head wave
+		tc[:] = 100000.
+		kc[:] = 0
+		for m in range(1,nl):
+			if tid[m] == 100000.:
+				continue
+			sqt = np.sqrt(vsq[m] - vsq[0])
+			# tr = (tid[m] - tkj*sqt/(v[m]*v[0])) + delta/v[m]
+			np.divide(np.multiply(zc,sqt,out=tmp),v[m]*v[0],out=tmp)
+			np.subtract(tid[m],tmp,out=tr)
+			tr += np.divide(dc,v[m],out=tmp)
+			# only beyond the critical distance did[m] - tkj*v[0]/sqt
+			np.divide(np.multiply(zc,v[0],out=tmp),sqt,out=tmp)
+			np.subtract(did[m],tmp,out=tmp)
+			np.less_equal(tmp,dc,out=beyond)
+			np.less(tr,tc,out=faster)
+			faster &= beyond
+			np.copyto(tc,tr,where=faster)
+			np.copyto(kc,m,where=faster)
+		# Crossover distance, from the intercept of layer 1
+		np.not_equal(tc,100000.,out=beyond)
+		if lvl:
+			if beyond.any():
+				raise RuntimeError('Low velocity layer below event layer 0')
+			tmp[:] = 100000.
+		else:
+			sqt = np.sqrt(vsq[1] - vsq[0])
+			np.divide(np.multiply(zc,sqt,out=tmp),v[1]*v[0],out=tmp)
+			np.subtract(tid[1],tmp,out=tmp)
+			tmp *= v[1]
+			tmp *= v[0]
+			tmp /= v[1] - v[0]
+			np.copyto(tmp,100000.,where=~beyond)
+		# Direct ray, r = sqrt(depth**2 + delta**2)
+		np.multiply(depth[i0:i1],depth[i0:i1],out=r)
+		r += np.multiply(dc,dc,out=tr)
+		np.sqrt(r,out=r)
+		np.divide(r,v[0],out=tr)
+		np.less_equal(dc,tmp,out=faster)
+		near += np.count_nonzero(faster)
+		np.greater_equal(tc,tr,out=beyond)
+		faster &= beyond
+		np.copyto(tc,tr,where=faster)
+		np.copyto(kc,-1,where=faster)
+	# Takeoff angles
+	ref = kk > 0
+	ain[ref] = np.arcsin(v[0]/v[kk[ref]])*57.2958
+	win = np.nonzero(kk == -1)[0]
+	r = np.sqrt(depth[win]**2 + delta[win]**2)
+	ain[win] = 180 - np.arcsin(delta[win]/r)*57.2958
+
+	if counts:
+		return t,ain,kk,near
+	return t,ain,kk
+
+
+def ray_derivatives(nl, v, thk, jl, tkj, delta, kk, u, x):
+	"""
+	Derivatives of the traveltimes of traced rays with respect to the
+	velocity and the depth to top of each layer
+	###########
+	By Fermat's principle a ray's time is stationary under small
+	changes of its path, so the first order change of its time only
+	comes from the change of slowness and thickness of the layers
+	along the fixed path.  With p = u/v[jl] the ray parameter and
+	eta[l] = sqrt(1/v[l]**2 - p**2) the vertical slowness,
+		dT/dv[l] = -L[l]/v[l]**2
+	where L[l] is the length of the ray in layer l (the horizontal leg
+	along the top of kk for a refracted ray), and
+		dT/dtop[k] = eta[k-1]*dV[k-1]/dtop[k] + eta[k]*dV[k]/dtop[k]
+	where V[l] is the vertical distance the ray covers in layer l: a
+	direct ray crosses the layers above the source once, a refracted
+	ray crosses them once and those from the source down to kk twice.
+	These are the derivatives of the time along the ray, sum L/v.
+	Refracted rays and surface layer direct rays of ttime have that
+	time.  For deeper direct rays the tdir of direct adds
+	thk*v[jl]/(vsq + sqrt(...)) per layer above the source where
+	direct1.f has vsq*sqrt(...), so their derivatives are those of
+	the ray's actual time rather than of the tdir returned.
+	###########
+	PARAMETERS:
+	nl (int) ---- Number of layers
+	v[nl] (float array) ---- Velocity of layers
+	thk[nl] (float array) ---- Thickness of layers
+	jl[n] (int array) ---- Event layer of each pair
+	tkj[n] (float array) ---- Depth of event in event layer
+	delta[n] (float array) ---- Epicentral distance
+	kk[n] (int array) ---- Refracting layer of the ray, -1 for the
+					direct ray and 0 for none (as ttime_batch rays)
+	u[n] (float array) ---- Sine of the takeoff angle at the source
+	x[n] (float array) ---- Horizontal distance of direct rays in the
+					event layer (unused for refracted rays)
+	###########
+	RETURNS:
+	dtdv[n,nl] (float array) ---- dT/dv of each layer (s per km/s),
+					NaN for pairs without a ray
+	dtdtop[n,nl] (float array) ---- dT/dtop of each layer (s/km),
+					NaN for pairs without a ray
+	###########
+	"""
+	n = len(delta)
+	dtdv = np.zeros((n,nl))
+	dtdtop = np.zeros((n,nl))
+	l = np.arange(nl)
+	vl = np.asarray(v[:nl],dtype=float)
+	for i0 in range(0,n,CHUNK):
+		i1 = min(i0+CHUNK,n)
+		j = jl[i0:i1,None]
+		k = kk[i0:i1,None]
+		z = tkj[i0:i1,None]
+		refr = k > 0
+		above = l < j
+		at = l == j
+		below = refr & (l > j) & (l < k)
+		# Vertical distance covered in each layer, and its
+		# coefficients on the tops of the layer (b) and of the one
+		# below (a)
+		V = np.where(above,thk,0.) + np.where(at,np.where(refr,2*thk-z,z),0.) + np.where(below,2*thk,0.)
+		a = above + 2*(refr & (at | below))
+		b = -1*(above | at) - 2*below
+		# Surface layer direct rays are timed from depth 0, not top[0]
+		b[~refr & at & (j == 0)] = 0
+		p = (u[i0:i1]/vl[jl[i0:i1]])[:,None]
+		crossed = (a != 0) | (b != 0)
+		eta = np.where(crossed,np.sqrt(np.maximum(1/vl**2 - p**2,0.)),0.)
+		with np.errstate(divide='ignore',invalid='ignore'):
+			L = np.where(V > 0,V/(vl*eta),0.)
+			# Horizontal leg along the top of the refracting layer
+			leg = delta[i0:i1] - np.sum(np.where(V > 0,V*p/eta,0.),axis=1)
+		L = np.where(refr & (l == k),leg[:,None],L)
+		# Straight to the source in the event layer
+		L = np.where(~refr & at,np.hypot(x[i0:i1,None],z),L)
+		dtdv[i0:i1] = -L/vl**2
+		dtdtop[i0:i1,0] = b[:,0]*eta[:,0]
+		dtdtop[i0:i1,1:] = a[:,:-1]*eta[:,:-1] + b[:,1:]*eta[:,1:]
+	none = kk == 0
+	dtdv[none] = np.nan
+	dtdtop[none] = np.nan
+
+	return dtdv,dtdtop
+
+
+# Kernel backends of ttime_batch: modules with a ttime_pairs like
+# rt_numba's, None for the NumPy routines in this file
+BACKENDS = OrderedDict([('python',None),('numba','rt_numba'),('fortran','rt_fortran')])
+
+# Backend in use, picked on first use by set_backend
+backend = {'name':None,'module':None}
+
+def set_backend(name=None):
+	"""
+	Select the kernels ttime_batch (and so partials) traces with.
+	A backend whose module can not be imported (numba not installed)
+	falls back to 'python' with a warning.
+	###########
+	PARAMETERS:
+	name (str) ---- Key of BACKENDS (default the RT_BACKEND environment
+					variable, else 'python')
+	###########
+	RETURNS:
+	name (str) ---- Backend in use
+	###########
+	"""
+	if name is None:
+		name = os.environ.get('RT_BACKEND','python')
+	if name not in BACKENDS:
+		raise ValueError('Unknown backend %r (one of %s)' % (name,', '.join(BACKENDS)))
+	module = None
+	if BACKENDS[name] is not None:
+		try:
+			module = importlib.import_module(BACKENDS[name])
+		except ImportError as error:
+			warnings.warn('%s backend not available (%s), using python' % (name,error))
+			name = 'python'
+	backend['name'] = name
+	backend['module'] = module
+
+	return name
+
+
+def get_backend():
+	"""Name and module of the backend in use (see set_backend)"""
+	if backend['name'] is None:
+		set_backend()
+
+	return backend['name'],backend['module']
+
+
+def ttime_kernel(module, nl, v, top, vsq, thk, jl, tkj, depths, isrc, delta, tracer=None):
+	"""
+	ttime_batch of every pair with the ttime_pairs of a compiled backend.
+	Unless the backend returns its own, takeoff angles are computed
+	here as in ttime_batch, so they match the python backend too.  A
+	tracer gets the kernel time as 'kernel' and the counts of every
+	event layer, with no time of their own.
+	###########
+	PARAMETERS:
+	module ---- Backend module
+	vsq, thk, jl, tkj ---- Outputs of vmodel_batch for depths
+	depths[nsrc] (float array) ---- Distinct source depths
+	isrc[n] (int array) ---- Source depth of each pair
+	delta[n] (float array) ---- Epicentral distance of each pair
+	Others as in ttime_batch
+	###########
+	RETURNS:
+	t[n], ain[n] (float array) ---- Minimum traveltimes and takeoff angles
+	ray[n] (int array) ---- Refracting layer, -1 for the direct ray
+	u[n], x[n] (float array) ---- Sine of the takeoff angle and event
+					layer leg of direct rays (0 for refracted rays)
+	All float arrays are of the dtype of delta, whatever precision the
+	backend works in.
+	###########
+	"""
+	if tracer is not None:
+		start = time.perf_counter()
+	t,ain,ray,u,x,near,niter,lvl = module.ttime_pairs(nl,np.asarray(v),np.asarray(top),vsq,thk,jl,tkj,
+													  depths,isrc,delta)
+	jlpair = jl[isrc]
+	if lvl.any():
+		raise RuntimeError('Low velocity layer below event layer %i' % jlpair[lvl].min())
+	win = ray == -1
+	if ain is None:
+		ain = np.full(len(delta),np.nan)
+		ref = ray > 0
+		ain[ref] = np.arcsin(v[jlpair[ref]]/v[ray[ref]])*57.2958
+		ain[win] = 180 - np.arcsin(u[win])*57.2958
+	if tracer is not None:
+		tracer.record('kernel',time.perf_counter()-start,len(delta))
+		if niter is not None:
+			tracer.iterate(niter[near & (jlpair != 0)])
+		layers,index = np.unique(jlpair,return_inverse=True)
+		pairs = np.bincount(index,minlength=len(layers))
+		solved = np.bincount(index,near,len(layers))
+		direct = np.bincount(index,win,len(layers))
+		for k,layer in enumerate(layers):
+			tracer.layer(layer,pairs[k],solved[k],direct[k],0.)
+	t,ain,u,x = (a.astype(delta.dtype,copy=False) for a in (t,ain,u,x))
+
+	return t,ain,ray,u,x
+
+
+# Error bound of traveltimes traced with dtype=np.float32 against float64
+# ones, as (rtol, distance in km): |t32 - t64| <= rtol*t64 + distance/vmin,
+# vmin the slowest layer velocity (see float32_error).  Refracted rays
+# and direct rays from the surface layer only differ by float32 rounding,
+# a few 1e-7 of t.  Deeper direct rays stop the false position iterations
+# of direct_batch within 0.02 km of delta, and the two precisions can
+# stop at different iterates: each tdir is then off the exact ray by up
+# to 0.02 km over the event layer velocity, so they differ by up to twice
+# that (on random models: 3e-7 of t and 0.013 km/vmin at most).  Delaz
+# runs in float64, so distances and azimuths are only rounded.
+# The bound only holds for models whose velocities never decrease with
+# depth (see float32_bounded).  Below a low velocity layer, direct rays
+# from an event under a faster layer run close to its critical angle,
+# where c - u**2 cancels in float32: differences reach thousands of
+# times the bound and some pairs flip between a time and 100000.
+FLOAT32_ERROR = (1e-6,0.04)
+
+def float32_bounded(v):
+	"""True if FLOAT32_ERROR holds for velocities v[nl] (no layer slower than one above it)"""
+	v = np.asarray(v)
+
+	return not (v[1:] < np.maximum.accumulate(v)[:-1]).any()
+
+
+def float32_error(t, v):
+	"""
+	Largest difference allowed by FLOAT32_ERROR between traveltimes
+	traced with dtype=np.float32 and float64.  Raises ValueError for
+	models with a low velocity layer, where there is no such bound.
+	###########
+	PARAMETERS:
+	t (float array) ---- Traveltimes traced in float64
+	v[nl] (float array) ---- Velocity of the layers they were traced through
+	###########
+	RETURNS:
+	err (float array) ---- Bound on |t32 - t| of each traveltime (s)
+	###########
+	"""
+	if not float32_bounded(v):
+		raise ValueError('FLOAT32_ERROR does not hold for models with a low velocity layer')
+	rtol,distance = FLOAT32_ERROR
+
+	return rtol*np.abs(t) + distance/np.min(v)
+
+
+def ttime_batch(delta, depth, nl, v, top, rays=False, tracer=None, solver=None, derivs=False,
+				dtype=float):
+	"""
+	Array version of ttime.  The layer terms are computed once per
+	distinct source depth, then pairs are grouped by event layer.
+	Surface layer pairs go to surface_batch and the deeper layers
+	are solved with refract_batch and direct_batch.  A tracer gets the
+	time of refract_terms_batch as 'tiddid' and the counts of every
+	event layer (Tracer.layer).  With a compiled backend selected (see
+	set_backend) the falsepos solver runs in ttime_kernel instead, with
+	the same results.
+	###########
+	PARAMETERS:
+	delta (float array) ---- Epicentral distances in km
+	depth (float array) ---- Focal depths of sources in km (broadcast with delta)
+	nl (int) ---- Number of layers in velocity model
+	v[nl] (float array) ---- Velocity in each layer
+	top[nl] (float array) ---- Depth to top of layer
+	rays (bool) ---- Also return the layer of each fastest ray
+	tracer (Tracer) ---- Record pairs, time and ray branches (optional)
+	solver (str) ---- Direct ray solver, 'falsepos' (direct_batch) or
+					'newton' (direct_newton); default the one in use
+					(see set_solver)
+	derivs (bool) ---- Also return the derivatives of the traveltimes
+					with respect to each layer (see ray_derivatives)
+	dtype (dtype) ---- Precision the pairs are traced in and returned
+					(default float64).  delta and depth are cast to
+					it, and v and top too if they are wider; with
+					float32 the python backend works in float32
+					throughout (see FLOAT32_ERROR)
+	###########
+	RETURNS:
+	t (float array) ---- Minimum traveltimes
+	ain (float array) ---- Angles of emergence at the source
+	kk (int array) ---- Refracting layer of the fastest ray, -1 for
+					the direct ray (only if rays=True)
+	dtdv, dtdtop (float array) ---- dT/dv and dT/dtop of each layer,
+					shaped as t plus a last axis of nl (only if derivs=True)
+	###########
+	"""
+	dtype = np.dtype(dtype)
+	# The model is only cast down: a float32 model, as read, is traced
+	# in float32 with float64 pairs as it always was
+	v,top = np.asarray(v),np.asarray(top)
+	if np.promote_types(v.dtype,dtype) != dtype:
+		v = v.astype(dtype)
+	if np.promote_types(top.dtype,dtype) != dtype:
+		top = top.astype(dtype)
+	# Index every pair by its source depth
+	depths,isrc = np.unique(np.asarray(depth,dtype=dtype),return_inverse=True)
+	isrc = isrc.reshape(np.shape(depth))
+	delta,isrc = np.broadcast_arrays(np.asarray(delta,dtype=dtype),isrc)
+	shape = delta.shape
+	delta = delta.ravel()
+	isrc = isrc.ravel()
+	t = np.zeros(delta.size,dtype=dtype)
+	ain = np.full(delta.size,np.nan,dtype=dtype)
+	ray = np.zeros(delta.size,dtype=int)
+	# Sine of takeoff angle and event layer leg of direct rays
+	usrc = np.zeros(delta.size,dtype=dtype)
+	xsrc = np.zeros(delta.size,dtype=dtype)
+	if tracer is not None:
+		start = time.perf_counter()
+	vsq,thk,jl,tkj = vmodel_batch(nl,v,top,depths)
+	jlpair = jl[isrc]
+	if tracer is not None:
+		tracer.record('vmodel',time.perf_counter()-start,len(depths))
+	module = get_backend()[1]
+	if solver is None:
+		solver = get_solver()
+	if module is not None and solver == 'falsepos':
+		# Every pair at once in compiled code
+		t,ain,ray,usrc,xsrc = ttime_kernel(module,nl,v,top,vsq,thk,jl,tkj,depths,isrc,delta,tracer)
+	else:
+		for layer in np.unique(jl):
+			if tracer is not None:
+				start = begin = time.perf_counter()
+			if layer == 0:
+				# Surface layer events have a closed form
+				ig = np.nonzero(jlpair == 0)[0]
+				i = isrc[ig]
+				t[ig],ain[ig],ray[ig],near = surface_batch(nl,v,vsq,thk,tkj[i],delta[ig],depths[i],True)
+				if tracer is not None:
+					seconds = time.perf_counter()-start
+					tracer.record('surface',seconds,len(ig))
+					tracer.layer(0,len(ig),near,np.count_nonzero(ray[ig] == -1),seconds)
+				continue
+			# Layer terms for the sources in this layer
+			isl = np.nonzero(jl == layer)[0]
+			tid,did,tinj,didj,xovmax = refract_terms_batch(nl,v,vsq,thk,layer,tkj[isl])
+			if tracer is not None:
+				tracer.record('tiddid',time.perf_counter()-start,len(isl))
+				start = time.perf_counter()
+			pos = np.zeros(len(depths),dtype=int)
+			pos[isl] = np.arange(len(isl))
+			# Pairs with a source in this layer
+			ig = np.nonzero(jlpair == layer)[0]
+			k = pos[isrc[ig]]
+			terms = (tid,did,tinj,didj,xovmax)
+			kk,tref,xovmax = refract_batch(nl,v,vsq,thk,layer,tkj[isl][k],delta[ig],terms,k)
+			if tracer is not None:
+				tracer.record('refract',time.perf_counter()-start,len(ig))
+			# Refracted ray is the minimum traveltime unless the direct ray wins
+			t[ig] = tref
+			ray[ig] = kk
+			ref = kk > 0
+			u = v[layer]/v[kk[ref]]
+			ain[ig[ref]] = np.arcsin(u)*57.2958
+			near = np.nonzero(delta[ig] <= xovmax)[0]
+			if len(near) == 0:
+				if tracer is not None:
+					tracer.layer(layer,len(ig),0,0,time.perf_counter()-begin)
+				continue
+			i = ig[near]
+			if tracer is not None:
+				start = time.perf_counter()
+			solve = DIRECT_SOLVERS[solver]
+			# The layer sums take [layer,nl] temporaries, so solve in chunks
+			tdir,u,x = np.empty(len(i),dtype=dtype),np.empty(len(i),dtype=dtype),np.empty(len(i),dtype=dtype)
+			niter = np.zeros(len(i),dtype=int)
+			tk,dep = tkj[isl][k[near]],depths[isrc[i]]
+			for i0 in range(0,len(i),CHUNK):
+				part = slice(i0,i0+CHUNK)
+				tdir[part],u[part],x[part],niter[part] = solve(nl,v,vsq,thk,layer,tk[part],delta[i[part]],
+																dep[part],True)
+			if tracer is not None:
+				tracer.record('direct',time.perf_counter()-start,len(i))
+				tracer.iterate(niter)
+			win = tref[near] >= tdir
+			t[i[win]] = tdir[win]
+			ain[i[win]] = 180 - np.arcsin(u[win])*57.2958
+			ray[i[win]] = -1
+			usrc[i[win]] = u[win]
+			xsrc[i[win]] = x[win]
+			if tracer is not None:
+				tracer.layer(layer,len(ig),len(i),np.count_nonzero(win),time.perf_counter()-begin)
+
+	if tracer is not None:
+		ndirect = int(np.count_nonzero(ray == -1))
+		tracer.ray('direct',ndirect)
+		tracer.ray('refracted',delta.size-ndirect)
+	out = (t.reshape(shape),ain.reshape(shape))
+	if rays:
+		out += (ray.reshape(shape),)
+	if derivs:
+		if tracer is not None:
+			start = time.perf_counter()
+		jlpair = jl[isrc]
+		ref = ray > 0
+		usrc[ref] = v[jlpair[ref]]/v[ray[ref]]
+		# Surface layer direct rays go straight to the receiver
+		top0 = (ray == -1) & (jlpair == 0)
+		xsrc[top0] = delta[top0]
+		usrc[top0] = delta[top0]/np.sqrt(depths[isrc[top0]]**2 + delta[top0]**2)
+		dtdv,dtdtop = ray_derivatives(nl,v,thk,jlpair,tkj[isrc],delta,ray,usrc,xsrc)
+		out += (dtdv.astype(dtype,copy=False).reshape(shape+(nl,)),
+				dtdtop.astype(dtype,copy=False).reshape(shape+(nl,)))
+		if tracer is not None:
+			tracer.record('derivs',time.perf_counter()-start,delta.size)
+
+	return out
+
+
+class TravelTimeTable(object):
+	"""
+	P and S traveltimes and takeoff angles tabulated on a
+	(epicentral distance, depth) grid for one velocity model.
+	###########
+	The table is filled with ttime_batch and queried by bilinear
+	interpolation, so repeated relocation runs with the same model
+	skip the ray tracing.  Depth nodes are laid out separately in
+	each layer so no cell straddles a layer top.  build() compares
+	the interpolation with ttime at every cell centre; cells that
+	miss the tol error bound, or whose corners are reached by
+	different rays (direct or refracted in different layers), are
+	flagged and queries falling in them are traced with ttime_batch,
+	as are queries outside the grid.  The spacing is halved while
+	more than maxexact of the cells are flagged.
+	###########
+	PARAMETERS:
+	dists[ndist] (float array) ---- Grid epicentral distances (km)
+	depths[ndep] (float array) ---- Grid source depths (km)
+	ttp, tts[ndist,ndep] (float array) ---- P and S traveltimes
+	ainp, ains[ndist,ndep] (float array) ---- P and S takeoff angles
+	exactp, exacts[ndist-1,ndep-1] (bool array) ---- Cells traced exactly
+	mod_nl, mod_ratio, mod_v, mod_top ---- Velocity model of the table
+	tol (float) ---- Error bound of the interpolated traveltimes (s)
+	backend (str) ---- Backend the table was traced with (see set_backend)
+	dtype (dtype) ---- Precision the table was traced in
+	solver (str) ---- Direct ray solver the table was traced with (see set_solver)
+	###########
+	"""
+	def __init__(self, dists, depths, ttp, tts, ainp, ains, exactp, exacts,
+				 mod_nl, mod_ratio, mod_v, mod_top, tol, backend='python', dtype=float,
+				 solver='falsepos'):
+		self.dists = np.asarray(dists,dtype=float)
+		self.depths = np.asarray(depths,dtype=float)
+		self.ttp = ttp
+		self.tts = tts
+		self.ainp = ainp
+		self.ains = ains
+		self.exactp = exactp
+		self.exacts = exacts
+		self.mod_nl = int(mod_nl)
+		self.mod_ratio = float(mod_ratio)
+		self.mod_v = np.asarray(mod_v)
+		self.mod_top = np.asarray(mod_top)
+		self.tol = float(tol)
+		self.backend = str(backend)
+		self.dtype = np.dtype(dtype)
+		self.solver = str(solver)
+
+	@classmethod
+	def build(cls, mod_nl, mod_ratio, mod_v, mod_top, dmax, zmax, ddist=2.0, ddep=1.0,
+			  tol=0.01, maxexact=0.05, maxlevel=3, dtype=float):
+		"""
+		Tabulate ttime_batch over 0-dmax km distance and top[0]-zmax km
+		depth, with the backend and solver in use
+		###########
+		PARAMETERS:
+		mod_nl, mod_ratio, mod_v, mod_top ---- Velocity model (as in partials)
+		dmax (float) ---- Largest epicentral distance in km
+		zmax (float) ---- Largest source depth in km (at most the deepest layer top)
+		ddist (float) ---- Initial distance spacing in km
+		ddep (float) ---- Initial depth spacing in km
+		tol (float) ---- Error bound on interpolated traveltimes in s
+		maxexact (float) ---- Refine while a larger fraction of cells is traced exactly
+		maxlevel (int) ---- Max number of times the spacing is halved
+		dtype (dtype) ---- Precision to trace in (see ttime_batch)
+		###########
+		RETURNS:
+		table (TravelTimeTable)
+		###########
+		"""
+		vs = np.zeros(mod_nl)
+		vs[:] = mod_v[:mod_nl]/mod_ratio
+		tops = np.append(mod_top[:mod_nl][mod_top[:mod_nl] < zmax],zmax).astype(float)
+		for level in range(0,maxlevel+1):
+			dists = np.arange(int(np.ceil(dmax/ddist))+1)*ddist
+			# Depth nodes per layer.  partials keeps sources at least
+			# 0.0001 km below a layer top, so the first node of each
+			# layer sits there
+			depths = []
+			for k in range(0,len(tops)-1):
+				layer = np.linspace(tops[k],tops[k+1],int(np.ceil((tops[k+1]-tops[k])/ddep))+1)
+				layer[0] = tops[k]+0.0001
+				depths.append(layer)
+			depths = np.concatenate(depths)
+			jl = vmodel_batch(mod_nl,mod_v,mod_top,depths)[2]
+			mdist = 0.5*(dists[1:]+dists[:-1])[:,None]
+			mdep = 0.5*(depths[1:]+depths[:-1])[None,:]
+			grids = []
+			for v in (mod_v,vs):
+				tt,ain,ray = ttime_batch(dists[:,None],depths[None,:],mod_nl,v,mod_top,True,dtype=dtype)
+				# Flag cells crossing a layer top or reached by several rays
+				exact = np.zeros((len(dists)-1,len(depths)-1),dtype=bool)
+				exact |= (jl[1:] != jl[:-1])[None,:]
+				for a,b in ((ray[1:,:-1],ray[:-1,:-1]),(ray[:-1,1:],ray[:-1,:-1]),(ray[1:,1:],ray[:-1,:-1])):
+					exact |= a != b
+				# and cells where the interpolation misses at the centre
+				chk,ain_chk = ttime_batch(mdist,mdep,mod_nl,v,mod_top,dtype=dtype)
+				mid = 0.25*(tt[1:,1:]+tt[1:,:-1]+tt[:-1,1:]+tt[:-1,:-1])
+				exact |= ~(abs(mid-chk) <= tol)
+				grids += [tt,ain,exact]
+			table = cls(dists,depths,grids[0],grids[3],grids[1],grids[4],grids[2],grids[5],
+						mod_nl,mod_ratio,mod_v,mod_top,tol,get_backend()[0],dtype,get_solver())
+			if max(table.exactp.mean(),table.exacts.mean()) <= maxexact:
+				break
+			ddist = ddist/2.
+			ddep = ddep/2.
+
+		return table
+
+	def matches(self, mod_nl, mod_ratio, mod_v, mod_top, dtype=float):
+		"""Check that the table was built for this velocity model, precision and the backend and solver in use"""
+		return (self.backend == get_backend()[0] and self.solver == get_solver() and self.dtype == np.dtype(dtype)
+				and self.mod_nl == mod_nl and np.isclose(self.mod_ratio,mod_ratio)
+				and np.array_equal(self.mod_v[:mod_nl],np.asarray(mod_v)[:mod_nl])
+				and np.array_equal(self.mod_top[:mod_nl],np.asarray(mod_top)[:mod_nl]))
+
+	def interp(self, tt, ain, exact, delta, depth):
+		"""
+		Bilinear interpolation of tabulated traveltimes and angles
+		###########
+		PARAMETERS:
+		tt[ndist,ndep] (float array) ---- ttp or tts
+		ain[ndist,ndep] (float array) ---- ainp or ains
+		exact[ndist-1,ndep-1] (bool array) ---- exactp or exacts
+		delta (float array) ---- Epicentral distances in km
+		depth (float array) ---- Source depths in km (broadcast with delta)
+		###########
+		RETURNS:
+		t (float array) ---- Interpolated traveltimes
+		a (float array) ---- Interpolated angles
+		ok (bool array) ---- Query lies in an unflagged cell of the grid
+		###########
+		"""
+		delta,depth = np.broadcast_arrays(np.asarray(delta,dtype=float),np.asarray(depth,dtype=float))
+		fx = (delta-self.dists[0])/(self.dists[1]-self.dists[0])
+		ix = np.clip(np.floor(fx).astype(int),0,len(self.dists)-2)
+		iz = np.clip(np.searchsorted(self.depths,depth,side='right')-1,0,len(self.depths)-2)
+		wx = fx-ix
+		wz = (depth-self.depths[iz])/(self.depths[iz+1]-self.depths[iz])
+		ok = ((delta >= self.dists[0]) & (delta <= self.dists[-1]) &
+			  (depth >= self.depths[0]) & (depth <= self.depths[-1]) & ~exact[ix,iz])
+		w = ((1-wx)*(1-wz),wx*(1-wz),(1-wx)*wz,wx*wz)
+		t = w[0]*tt[ix,iz] + w[1]*tt[ix+1,iz] + w[2]*tt[ix,iz+1] + w[3]*tt[ix+1,iz+1]
+		a = w[0]*ain[ix,iz] + w[1]*ain[ix+1,iz] + w[2]*ain[ix,iz+1] + w[3]*ain[ix+1,iz+1]
+
+		return t,a,ok
+
+	def lookup(self, delta, depth):
+		"""
+		P and S traveltimes and takeoff angles for station-event pairs.
+		Pairs the table cannot interpolate are traced with ttime_batch.
+		###########
+		PARAMETERS:
+		delta (float array) ---- Epicentral distances in km
+		depth (float array) ---- Source depths in km (broadcast with delta)
+		###########
+		RETURNS:
+		ttp, ainp, tts, ains (float arrays) ---- As returned by ttime_batch
+		###########
+		"""
+		delta,depth = np.broadcast_arrays(np.asarray(delta,dtype=float),np.asarray(depth,dtype=float))
+		vs = np.zeros(self.mod_nl)
+		vs[:] = self.mod_v[:self.mod_nl]/self.mod_ratio
+		out = []
+		for grids,v in (((self.ttp,self.ainp,self.exactp),self.mod_v),
+						((self.tts,self.ains,self.exacts),vs)):
+			t,ain,ok = self.interp(*grids,delta,depth)
+			if not ok.all():
+				t[~ok],ain[~ok] = ttime_batch(delta[~ok],depth[~ok],self.mod_nl,v,self.mod_top,
+											  dtype=self.dtype)
+			out += [t,ain]
+
+		return tuple(out)
+
+	def save(self, fileloc):
+		"""Write the table to a .npz file"""
+		np.savez(fileloc,dists=self.dists,depths=self.depths,ttp=self.ttp,tts=self.tts,
+				 ainp=self.ainp,ains=self.ains,exactp=self.exactp,exacts=self.exacts,
+				 mod_nl=self.mod_nl,mod_ratio=self.mod_ratio,mod_v=self.mod_v,
+				 mod_top=self.mod_top,tol=self.tol,backend=self.backend,dtype=self.dtype.str,
+				 solver=self.solver)
+
+	@classmethod
+	def load(cls, fileloc):
+		"""Read a table written by save (older tables were traced by python in float64 with falsepos)"""
+		with np.load(fileloc) as f:
+			backend = f['backend'] if 'backend' in f.files else 'python'
+			dtype = f['dtype'] if 'dtype' in f.files else '<f8'
+			solver = f['solver'] if 'solver' in f.files else 'falsepos'
+			return cls(f['dists'],f['depths'],f['ttp'],f['tts'],f['ainp'],f['ains'],
+					   f['exactp'],f['exacts'],f['mod_nl'],f['mod_ratio'],f['mod_v'],
+					   f['mod_top'],f['tol'],backend,str(dtype),solver)
+
+
+def trace_pairs(src_lat, src_lon, src_dep, sta_lat, sta_lon, mod_nl, mod_ratio,
+				mod_v, mod_top, ttable=None, tracer=None, derivs=False, dtype=float):
+	"""
+	Traveltimes, partial derivatives and ray geometry for every
+	station-event pair.  Source depths must already be moved off
+	layer boundaries (see partials).
+	###########
+	PARAMETERS:
+	src_lat, src_lon, src_dep[nsrc] (float array) ---- Source coordinates
+	sta_lat, sta_lon[nsta] (float array) ---- Station coordinates
+	mod_nl, mod_ratio, mod_v, mod_top ---- Velocity model (as in partials)
+	ttable (TravelTimeTable) ---- Interpolate traveltimes from this table
+					(optional, built for the same model, dtype, backend and solver)
+	tracer (Tracer) ---- Record calls, time and ray branches (optional)
+	derivs (bool) ---- Also return the derivatives of the traveltimes
+					with respect to the layers (see ray_derivatives;
+					not with ttable)
+	dtype (dtype) ---- Precision of the geometry, the traveltimes and
+					the returned arrays (default float64, see ttime_batch)
+	###########
+	RETURNS:
+	tmp_ttp, tmp_tts, tmp_xp, tmp_yp, tmp_zp[nsta,nsrc] (float array) ---- As in partials
+	dist[nsta,nsrc] (float array) ---- Epicentral distances (km)
+	az[nsta,nsrc] (float array) ---- Azimuths (deg)
+	ain[nsta,nsrc] (float array) ---- Takeoff angles (deg)
+	dtp_dv, dtp_dtop[nsta*nsrc,mod_nl] (float array) ---- dT/dv and
+					dT/dtop of the P traveltimes for each layer, pairs
+					in the order of the flattened [nsta,nsrc] arrays
+					(only if derivs=True)
+	dts_dv, dts_dtop[nsta*nsrc,mod_nl] (float array) ---- The same for
+					S traveltimes, dv of the S velocities (only if derivs=True)
+	###########
+	"""
+	nsta = len(sta_lat)
+	nsrc = len(src_lat)
+	# Get S velocity model
+	vs = np.zeros(mod_nl)
+	vs[:] = mod_v[:mod_nl]/mod_ratio
+	# Compute epicentral distances, azimuths, angles of incidence,
+	# and P/S trave time from sources to stations for all pairs at once
+	pi = 3.141593 # Define for continuity sake
+	if tracer is not None:
+		start = time.perf_counter()
+	delt, dist, az = delaz_pairs(src_lat,src_lon,sta_lat,sta_lon,dtype)
+	if tracer is not None:
+		tracer.record('delaz',time.perf_counter()-start,dist.size)
+	# 1D ray tracing
+	if derivs and ttable is not None:
+		raise ValueError('Layer derivatives need ray tracing, not a traveltime table')
+	if derivs:
+		tmp_ttp, ain, dtp_dv, dtp_dtop = ttime_batch(dist,src_dep[None,:],mod_nl,mod_v,mod_top,
+													 tracer=tracer,derivs=True,dtype=dtype)
+		tmp_tts, ain, dts_dv, dts_dtop = ttime_batch(dist,src_dep[None,:],mod_nl,vs,mod_top,
+													 tracer=tracer,derivs=True,dtype=dtype)
+	elif ttable is None:
+		tmp_ttp, ain = ttime_batch(dist,src_dep[None,:],mod_nl,mod_v,mod_top,tracer=tracer,dtype=dtype)
+		tmp_tts, ain = ttime_batch(dist,src_dep[None,:],mod_nl,vs,mod_top,tracer=tracer,dtype=dtype)
+	elif ttable.matches(mod_nl,mod_ratio,mod_v,mod_top,dtype):
+		if tracer is not None:
+			start = time.perf_counter()
+		tmp_ttp, ainp, tmp_tts, ain = (tt.astype(dtype,copy=False) for tt in ttable.lookup(dist,src_dep[None,:]))
+		if tracer is not None:
+			tracer.record('lookup',time.perf_counter()-start,2*dist.size)
+	else:
+		raise ValueError('Traveltime table was built for a different velocity model, backend, solver or precision')
+	# Determine wave speed at the hypocenter
+	tmp_xp = np.zeros((nsta,nsrc),dtype=dtype)
+	tmp_yp = np.zeros((nsta,nsrc),dtype=dtype)
+	tmp_zp = np.zeros((nsta,nsrc),dtype=dtype)
+	# Each source takes mod_v[k-1] of the last layer k with
+	# src_dep <= mod_top[k], as the loop over layers of the
+	# original overwrote earlier ones
+	above = np.asarray(src_dep)[:,None] <= mod_top[:mod_nl]
+	j = above.any(axis=1)
+	k = mod_nl-1-np.argmax(above[:,::-1],axis=1)[j]
+	vel = mod_v[k-1]
+	# Depth Derivatives
+	tmp_zp[:,j] = np.cos((ain[:,j]*pi)/180.)/vel
+	# Epicentral Derivatives
+	tmp_xp[:,j] = (np.sin((ain[:,j]*pi)/180.)*np.cos(((az[:,j]-90.)*pi)/180.))/vel
+	tmp_yp[:,j] = (np.sin((ain[:,j]*pi)/180.)*np.cos((az[:,j]*pi)/180.))/vel
+
+	if derivs:
+		layers = (dtp_dv,dtp_dtop,dts_dv,dts_dtop)
+		return (tmp_ttp,tmp_tts,tmp_xp,tmp_yp,tmp_zp,dist,az,ain)+tuple(d.reshape(-1,mod_nl) for d in layers)
+	return tmp_ttp,tmp_tts,tmp_xp,tmp_yp,tmp_zp,dist,az,ain
+
+
+# Inputs shared by the worker processes of trace_parallel
+worker = {}
+
+def init_worker(shm_name, shape, args, tracing=False):
+	"""Attach a trace_parallel worker to the shared result arrays (of the dtype last in args)"""
+	if shm_name is not None:
+		worker['shm'] = shared_memory.SharedMemory(name=shm_name)
+		worker['out'] = np.ndarray(shape,dtype=args[-1],buffer=worker['shm'].buf)
+	worker['args'] = args
+	worker['tracing'] = tracing
+
+
+def trace_tile(tile):
+	"""
+	Trace one (station block, event block) tile into the shared
+	arrays.  Returns the tile's Tracer when tracing, else None.
+	"""
+	i0,i1,j0,j1 = tile
+	src_lat,src_lon,src_dep,sta_lat,sta_lon,mod_nl,mod_ratio,mod_v,mod_top,ttable,dtype = worker['args']
+	tracer = Tracer() if worker['tracing'] else None
+	results = trace_pairs(src_lat[j0:j1],src_lon[j0:j1],src_dep[j0:j1],sta_lat[i0:i1],
+						  sta_lon[i0:i1],mod_nl,mod_ratio,mod_v,mod_top,ttable,tracer,dtype=dtype)
+	for k,result in enumerate(results):
+		worker['out'][k,i0:i1,j0:j1] = result
+
+	return tracer
+
+
+def trace_block(tile):
+	"""
+	Trace one tile for iterpartials and return it with the tile's
+	Tracer (None when not tracing).
+	"""
+	i0,i1,j0,j1 = tile
+	src_lat,src_lon,src_dep,sta_lat,sta_lon,mod_nl,mod_ratio,mod_v,mod_top,ttable,dtype = worker['args']
+	tracer = Tracer() if worker['tracing'] else None
+	results = trace_pairs(src_lat[j0:j1],src_lon[j0:j1],src_dep[j0:j1],sta_lat[i0:i1],
+						  sta_lon[i0:i1],mod_nl,mod_ratio,mod_v,mod_top,ttable,tracer,dtype=dtype)
+
+	return results,tracer
+
+
+def trace_parallel(src_lat, src_lon, src_dep, sta_lat, sta_lon, mod_nl, mod_ratio,
+				   mod_v, mod_top, ttable=None, workers=2, tile=None, tracer=None, dtype=float):
+	"""
+	trace_pairs split into station x event tiles run by a pool of
+	processes.  Workers write their tiles straight into shared
+	memory, so results are not pickled back to the parent.
+	###########
+	PARAMETERS:
+	Same as trace_pairs, plus
+	workers (int) ---- Number of worker processes
+	tile (tuple) ---- (stations, events) per tile; by default all
+				stations and about 4 tiles per worker
+	tracer (Tracer) ---- Collects the counts of all workers (optional)
+	###########
+	RETURNS:
+	Same as trace_pairs
+	###########
+	"""
+	nsta = len(sta_lat)
+	nsrc = len(src_lat)
+	if tile is None:
+		tile = (nsta,max(1,-(-nsrc//(4*workers))))
+	tiles = [(i0,min(i0+tile[0],nsta),j0,min(j0+tile[1],nsrc))
+			 for i0 in range(0,nsta,tile[0]) for j0 in range(0,nsrc,tile[1])]
+	shape = (8,nsta,nsrc)
+	shm = shared_memory.SharedMemory(create=True,size=max(1,8*nsta*nsrc*np.dtype(dtype).itemsize))
+	try:
+		args = (src_lat,src_lon,src_dep,sta_lat,sta_lon,mod_nl,mod_ratio,mod_v,mod_top,ttable,dtype)
+		initargs = (shm.name,shape,args,tracer is not None)
+		with ProcessPoolExecutor(workers,initializer=init_worker,initargs=initargs) as pool:
+			for counts in pool.map(trace_tile,tiles):
+				if tracer is not None:
+					tracer.merge(counts)
+		out = np.ndarray(shape,dtype=dtype,buffer=shm.buf).copy()
+	finally:
+		shm.close()
+		shm.unlink()
+
+	return tuple(out)
+
+
+# Station-event pairs per tile when streaming partials
+BLOCK = 250000
+
+def iterpartials(src_lat, src_lon, src_dep, sta_lat, sta_lon, mod_nl, mod_ratio,
+				 mod_v, mod_top, ttable=None, tile=None, workers=1, tracer=None, dtype=float):
+	"""
+	trace_pairs as a generator of (station block, event block)
+	tiles in station-major order.  Only the tiles being traced (one,
+	or two per worker) are held in memory at a time.
+	###########
+	PARAMETERS:
+	Same as trace_pairs, plus
+	tile (tuple) ---- (stations, events) per tile; by default all events
+				and enough stations for about BLOCK pairs
+	workers (int) ---- Number of processes to trace with (default 1)
+	###########
+	RETURNS:
+	Generator of (i0, j0, results) where results are the trace_pairs
+	arrays for stations i0:i0+n and events j0:j0+m
+	###########
+	"""
+	nsta = len(sta_lat)
+	nsrc = len(src_lat)
+	if tile is None:
+		tile = (max(1,BLOCK//max(1,nsrc)),nsrc)
+	tiles = [(i0,min(i0+tile[0],nsta),j0,min(j0+tile[1],nsrc))
+			 for i0 in range(0,nsta,tile[0]) for j0 in range(0,nsrc,tile[1])]
+	if workers <= 1:
+		for i0,i1,j0,j1 in tiles:
+			yield i0,j0,trace_pairs(src_lat[j0:j1],src_lon[j0:j1],src_dep[j0:j1],sta_lat[i0:i1],
+									sta_lon[i0:i1],mod_nl,mod_ratio,mod_v,mod_top,ttable,tracer,
+									dtype=dtype)
+		return
+	args = (src_lat,src_lon,src_dep,sta_lat,sta_lon,mod_nl,mod_ratio,mod_v,mod_top,ttable,dtype)
+	initargs = (None,None,args,tracer is not None)
+	with ProcessPoolExecutor(workers,initializer=init_worker,initargs=initargs) as pool:
+		# Keep two tiles per worker in flight and yield them in order
+		tiles = iter(tiles)
+		pending = deque((tile,pool.submit(trace_block,tile)) for tile in itertools.islice(tiles,2*workers))
+		while pending:
+			(i0,i1,j0,j1),future = pending.popleft()
+			results,counts = future.result()
+			for tile in itertools.islice(tiles,1):
+				pending.append((tile,pool.submit(trace_block,tile)))
+			if tracer is not None:
+				tracer.merge(counts)
+			yield i0,j0,results
+
+
+def offset_depths(src_dep, mod_nl, mod_top):
+	"""
+	Move hypocenters within 0.1 m of a layer top up by 1 cm so they
+	don't fall on boundaries.
+	###########
+	PARAMETERS:
+	src_dep[nsrc] (float array) ---- Source depths in km
+	mod_nl (int) ---- Number of layers in velocity model
+	mod_top[mod_nl] (float array) ---- Depth to top of layer (km)
+	###########
+	RETURNS:
+	src_dep[nsrc] (float array) ---- Moved source depths (a copy)
+	###########
+	"""
+	src_dep = np.array(src_dep,dtype=float)
+	for j in range(0,mod_nl):
+		onlayer = abs(src_dep - mod_top[j]) < 0.0001
+		src_dep[onlayer] = src_dep[onlayer]-0.001 # Move by 1cm
+
+	return src_dep
+
+
+def model_fingerprint(mod_nl, mod_ratio, mod_v, mod_top, ttable=None, dtype=float, backend=None,
+					  solver=None):
+	"""
+	Hash of everything besides the station and event coordinates that
+	the results of partials depend on
+	###########
+	PARAMETERS:
+	mod_nl, mod_ratio, mod_v, mod_top ---- Velocity model (as in partials)
+	ttable (TravelTimeTable) ---- Table the traveltimes are interpolated from (optional)
+	dtype (dtype) ---- Precision of the run (float64 leaves the hash as
+					it was before precisions could be chosen)
+	backend (str) ---- Backend of the run (default the one in use;
+					python leaves the hash as it was before backends)
+	solver (str) ---- Direct ray solver of the run (default the one in
+					use; falsepos leaves the hash as it was)
+	###########
+	RETURNS:
+	fingerprint (str) ---- SHA-256 hex digest
+	###########
+	"""
+	sha = hashlib.sha256()
+	sha.update(np.int64(mod_nl).tobytes())
+	sha.update(np.float64(mod_ratio).tobytes())
+	for values in (mod_v,mod_top):
+		values = np.asarray(values)[:mod_nl]
+		sha.update(values.dtype.str.encode('ascii'))
+		sha.update(values.tobytes())
+	if ttable is not None:
+		for values in (ttable.dists,ttable.depths,np.float64(ttable.tol)):
+			sha.update(values.tobytes())
+	if np.dtype(dtype) != np.float64:
+		sha.update(np.dtype(dtype).str.encode('ascii'))
+	if backend is None:
+		backend = get_backend()[0]
+	if backend != 'python':
+		sha.update(backend.encode('ascii'))
+	if solver is None:
+		solver = get_solver()
+	if solver != 'falsepos':
+		sha.update(solver.encode('ascii'))
+
+	return sha.hexdigest()
+
+
+def match_rows(prev_keys, prev_coords, keys, coords):
+	"""
+	Find the row of a previous run with the same key (cusp or station
+	label) and exactly the same coordinates
+	###########
+	PARAMETERS:
+	prev_keys[nprev] (array) ---- Keys of the previous run
+	prev_coords (tuple) ---- Coordinate arrays [nprev] of the previous run
+	keys[n] (array) ---- Keys of this run
+	coords (tuple) ---- Coordinate arrays [n] of this run
+	###########
+	RETURNS:
+	rows[n] (int array) ---- Previous row of each key, -1 if new or moved
+	###########
+	"""
+	keys = np.asarray(keys)
+	prev_keys = np.asarray(prev_keys,dtype=keys.dtype)
+	if len(prev_keys) == 0:
+		return np.full(len(keys),-1)
+	order = np.argsort(prev_keys,kind='stable')
+	rows = order[np.minimum(np.searchsorted(prev_keys,keys,sorter=order),len(order)-1)]
+	same = prev_keys[rows] == keys
+	for prev,coord in zip(prev_coords,coords):
+		same &= np.asarray(prev)[rows] == coord
+
+	return np.where(same,rows,-1)
+
+
+# Record type of an event: integer ID, coordinates and depth (km)
+EVENT_DTYPE = np.dtype([('cusp',np.int64),('lat',np.float64),('lon',np.float64),('dep',np.float64)])
+
+
+def station_dtype(width):
+	"""Record type of a station with labels of up to width characters"""
+	return np.dtype([('lab','U%i' % max(1,width)),('lat',np.float64),('lon',np.float64)])
+
+
+class EventSet(object):
+	"""
+	Events as one read-only structured array of EVENT_DTYPE records.
+	###########
+	Fields are read as attributes (cusp, lat, lon, dep), which are
+	views of the records, and indexing (slices, index arrays or
+	masks) gives another EventSet, so shards of a catalog share
+	memory when sliced.  The records can not be written through the
+	set, so tracing never moves the depths as read.
+	###########
+	PARAMETERS:
+	records[nsrc] (structured array) ---- Rows with the fields of EVENT_DTYPE
+	###########
+	"""
+	fields = EVENT_DTYPE.names
+
+	def __init__(self, records):
+		records = np.asarray(records)
+		if records.dtype.names != self.fields:
+			records = records.astype(EVENT_DTYPE)
+		self.records = records.view()
+		self.records.flags.writeable = False
+
+	@classmethod
+	def from_arrays(cls, cusp, lat, lon, dep):
+		"""Build a set from parallel arrays"""
+		records = np.empty(len(lat),dtype=EVENT_DTYPE)
+		for name,values in zip(EVENT_DTYPE.names,(cusp,lat,lon,dep)):
+			records[name] = values
+
+		return cls(records)
+
+	def __len__(self):
+		return len(self.records)
+
+	def __getitem__(self, index):
+		if np.ndim(index) == 0 and not isinstance(index,slice):
+			index = slice(index,index+1 if index != -1 else None)
+
+		return self.__class__(self.records[index])
+
+	def __getattr__(self, name):
+		if name in self.fields:
+			return self.records[name]
+		raise AttributeError(name)
+
+
+class StationSet(EventSet):
+	"""
+	Stations as one read-only structured array of station_dtype
+	records (fixed-width lab, lat and lon); used as EventSet.
+	###########
+	PARAMETERS:
+	records[nsta] (structured array) ---- Rows with fields lab, lat and lon
+	###########
+	"""
+	fields = ('lab','lat','lon')
+
+	def __init__(self, records):
+		records = np.asarray(records)
+		if records.dtype.names != self.fields or records.dtype['lab'].kind != 'U':
+			width = max([len(str(lab)) for lab in records['lab']],default=1)
+			records = records.astype(station_dtype(width))
+		self.records = records.view()
+		self.records.flags.writeable = False
+
+	@classmethod
+	def from_arrays(cls, lab, lat, lon):
+		"""Build a set from parallel arrays"""
+		lab = np.asarray(lab).astype(str)
+		records = np.empty(len(lat),dtype=station_dtype(lab.dtype.itemsize//4))
+		for name,values in zip(cls.fields,(lab,lat,lon)):
+			records[name] = values
+
+		return cls(records)
+
+
+class VelocityModel(object):
+	"""
+	Immutable layered velocity model with its P and S velocities.
+	###########
+	v and top keep the type they were read with (float32 from
+	rayTrace.inp), so results and fingerprints match the loose
+	argument routines.  vs is computed once as trace_pairs does.
+	Arrays are read-only and attributes can not be set.  params gives
+	(nl, ratio, v, top) for the routines taking the model as loose
+	arguments.
+	###########
+	PARAMETERS:
+	nl (int) ---- Number of layers
+	ratio (float) ---- VP/VS ratio
+	v[nl] (float array) ---- Layer P velocities (km/s)
+	top[nl] (float array) ---- Depth to top of layer (km)
+	###########
+	"""
+	__slots__ = ('nl','ratio','v','top','vs')
+
+	def __init__(self, nl, ratio, v, top):
+		v = np.array(v)[:nl]
+		top = np.array(top)[:nl]
+		vs = np.zeros(nl)
+		vs[:] = v/ratio
+		terms = {'nl':int(nl),'ratio':ratio,'v':v,'top':top,'vs':vs}
+		for name,value in terms.items():
+			if isinstance(value,np.ndarray):
+				value.flags.writeable = False
+			object.__setattr__(self,name,value)
+
+	def __setattr__(self, name, value):
+		raise AttributeError('VelocityModel is immutable')
+
+	def __reduce__(self):
+		# Rebuilt from its parameters when sent to worker processes
+		return VelocityModel,self.params
+
+	@property
+	def params(self):
+		return self.nl,self.ratio,self.v,self.top
+
+	def offset_depths(self, src_dep):
+		"""Copy of src_dep moved off the layer tops (see offset_depths)"""
+		return offset_depths(src_dep,self.nl,self.top)
+
+	def fingerprint(self, ttable=None, dtype=float):
+		"""model_fingerprint of the model (and ttable) for a run in dtype, with the backend and solver in use"""
+		return model_fingerprint(self.nl,self.ratio,self.v,self.top,ttable,dtype)
+
+
+def trace_cached(src_lat, src_lon, src_dep, sta_lat, sta_lon, mod_nl, mod_ratio, mod_v,
+				 mod_top, cache, events, stations, ttable=None, workers=1, tracer=None, dtype=float):
+	"""
+	trace_pairs that reads the pairs already in a rt_cache.ResultCache
+	and only traces the rest.  Stations missing for every event (new
+	stations) are traced against all events, then the other missing
+	pairs in one (stations x events) block.  New results are stored
+	back in the cache (in double precision, whatever the dtype; results
+	of each precision are kept apart).
+	###########
+	PARAMETERS:
+	Same as trace_parallel, plus
+	cache (ResultCache) ---- Cache to read and update
+	events[nsrc], stations[nsta] (int64 array) ---- Keys from cache.keys()
+	###########
+	RETURNS:
+	Same as trace_pairs
+	###########
+	"""
+	model = model_fingerprint(mod_nl,mod_ratio,mod_v,mod_top,ttable,dtype)
+	if tracer is not None:
+		start = time.perf_counter()
+	results,found = cache.lookup(model,events,stations)
+	if tracer is not None:
+		tracer.record('cache',time.perf_counter()-start,found.size)
+	missing = ~found
+	full = np.nonzero(missing.all(axis=1))[0] if len(events) else np.zeros(0,dtype=int)
+	rest = missing.copy()
+	rest[full] = False
+	blocks = [(full,np.arange(len(events))),(np.nonzero(rest.any(axis=1))[0],np.nonzero(rest.any(axis=0))[0])]
+	for rows,cols in blocks:
+		if len(rows) == 0 or len(cols) == 0:
+			continue
+		args = (src_lat[cols],src_lon[cols],src_dep[cols],sta_lat[rows],sta_lon[rows],
+				mod_nl,mod_ratio,mod_v,mod_top,ttable)
+		if workers > 1:
+			traced = trace_parallel(*args,workers=workers,tracer=tracer,dtype=dtype)
+		else:
+			traced = trace_pairs(*args,tracer=tracer,dtype=dtype)
+		for result,new in zip(results,traced):
+			result[np.ix_(rows,cols)] = new
+	if missing.any():
+		if tracer is not None:
+			start = time.perf_counter()
+		cache.store(model,events,stations,results,np.nonzero(missing.any(axis=0))[0])
+		if tracer is not None:
+			tracer.record('cache',time.perf_counter()-start,int(np.count_nonzero(missing)))
+
+	return tuple(result.astype(dtype,copy=False) for result in results)
+
+
 def partials(nsrc, src_cusp, src_lat, src_lon, src_dep, nsta, sta_lab, sta_lat,
-			 sta_lon, mod_nl, mod_ratio, mod_v, mod_top, fn_srcpar='rayTrace.src'):
+			 sta_lon, mod_nl, mod_ratio, mod_v, mod_top, fn_srcpar='rayTrace.src',
+			 ttable=None, workers=1, tracer=None, fmt='text', cache=None, dtype=float):
 	"""
 	This function returns traveltimes (P&S) and partial time derivatives for sources
 	and receiver pairs for a give homogeneous layered vmodel.
+	All pairs are traced together with delaz_pairs and ttime_batch;
+	with workers > 1 the pairs are split into tiles traced in parallel.
+	Depths are moved off layer boundaries in a copy, so src_dep is not
+	modified.  For an EventSet, StationSet and VelocityModel use
+	partials_catalog.
 	###########
 	PARAMETERS:
 	fn_srcpar (str) ---- Source parameter file locations defaults to 'rayTrace.src'
+					(None to skip writing)
 	nsrc (int) ---- Number of sources
 	src_cusp[nsrc] (int array) ---- Integer event IDS for sources
 	src_lat[nsrc] (float array) ---- Source latitudes
@@ -416,6 +2322,17 @@ def partials(nsrc, src_cusp, src_lat, src_lon, src_dep, nsta, sta_lab, sta_lat,
 	mod_ratio (float) ---- VP/VS ratio
 	mod_v[mod_nl] (float array) ---- Layer P velocities (km/s)
 	mod_top[mod_nl] (float array) ---- Depth to top of layer (km)
+	ttable (TravelTimeTable) ---- Interpolate traveltimes from this table
+					instead of ray tracing (optional)
+	workers (int) ---- Number of processes to trace with (default 1)
+	tracer (Tracer) ---- Record calls, time and ray branches (optional)
+	fmt (str) ---- Output format, 'text' (default), 'npz' or 'raw' (see rt_io)
+	cache (ResultCache) ---- Read pairs traced by earlier runs from this
+					rt_cache.ResultCache and add the new ones (optional)
+	dtype (dtype) ---- Precision of the tracing, the returned arrays and
+					binary output: float64 (default) or float32, which
+					halves their memory (error bound in FLOAT32_ERROR,
+					for models without low velocity layers)
 	############
 	RETURNS:
 	tmp_ttp[nsta,nsrc] (float array) ---- P traveltime for all station-event combos
@@ -425,48 +2342,161 @@ def partials(nsrc, src_cusp, src_lat, src_lon, src_dep, nsta, sta_lab, sta_lat,
 	tmp_zp[nsta,nsrc] (float array) ---- Z partial derivative
 	###########
 	"""
-	# Initialise output arrays
-	tmp_ttp = np.zeros((nsta,nsrc))
-	tmp_tts = np.zeros((nsta,nsrc))
-	tmp_xp = np.zeros((nsta,nsrc))
-	tmp_yp = np.zeros((nsta,nsrc))
-	tmp_zp = np.zeros((nsta,nsrc))
-	# Open src file
-	srcpar = open(fn_srcpar,'w')
+	# Cache keys use the depths as read
+	if cache is not None:
+		keys,stakeys = cache.keys(src_lat,src_lon,src_dep,sta_lat,sta_lon)
 	# Make sure hypocenters don't fall on boundaries
-	for i in range(0,nsrc):
-		for j in range(0,mod_nl):
-			if abs(src_dep[i] - mod_top[j]) < 0.0001:
-				src_dep[i] = src_dep[i]-0.001 # Move by 1cm
-	# Get S velocity model
-	vs = np.zeros(mod_nl)
-	for i in range(0,mod_nl):
-		vs[i] = mod_v[i]/mod_ratio
-	# Compute epicentral distances, azimuths, angles of incidence,
-	# and P/S trave time from sources to stations
-	pi = 3.141593 # Define for continuity sake
-	for i in range(0,nsta):
-		for j in range(0,nsrc):
-			print('Before delaz ')
-			delt, dist, az = delaz(src_lat[j],src_lon[j],sta_lat[i],sta_lon[i])
-			print('After delaz ',delt,dist,az)
-			# 1D ray tracing
-			print('Before ttime ')
-			tmp_ttp[i,j], ain = ttime(dist,src_dep[j],mod_nl,mod_v,mod_top)
-			tmp_tts[i,j], ain = ttime(dist,src_dep[j],mod_nl,vs,mod_top)
-			print('After ttime ',tmp_ttp[i,j],tmp_tts[i,j])
-			# Determine wave speed at the hypocenter
-			for k in range(0,mod_nl):
-				if src_dep[j] <= mod_top[k]:
-					# Depth Derivatives
-					tmp_zp[i,j] = np.cos((ain*pi)/180.)/mod_v[k-1]
-					# Epicentral Derivatives
-					tmp_xp[i,j] = (np.sin((ain*pi)/180.)*np.cos(((az-90.)*pi)/180.))/mod_v[k-1]
-					tmp_yp[i,j] = (np.sin((ain*pi)/180.)*np.cos((az*pi)/180.))/mod_v[k-1]
-
-			# Write to source parameter file
-			srcpar.write('%13g %13g %13g %13s %13g %13g %13g \n' % 
-				(src_cusp[j],tmp_ttp[i,j],tmp_tts[i,j],sta_lab[i],dist,az,ain))
-	srcpar.close()
+	src_dep = offset_depths(src_dep,mod_nl,mod_top)
+	# Trace all pairs, in tiles across processes if requested
+	if cache is not None:
+		tmp_ttp,tmp_tts,tmp_xp,tmp_yp,tmp_zp,dist,az,ain = trace_cached(
+			src_lat,src_lon,src_dep,sta_lat,sta_lon,mod_nl,mod_ratio,mod_v,mod_top,cache,
+			keys,stakeys,ttable,workers,tracer,dtype)
+	elif workers > 1:
+		tmp_ttp,tmp_tts,tmp_xp,tmp_yp,tmp_zp,dist,az,ain = trace_parallel(
+			src_lat,src_lon,src_dep,sta_lat,sta_lon,mod_nl,mod_ratio,mod_v,mod_top,ttable,
+			workers,tracer=tracer,dtype=dtype)
+	else:
+		tmp_ttp,tmp_tts,tmp_xp,tmp_yp,tmp_zp,dist,az,ain = trace_pairs(
+			src_lat,src_lon,src_dep,sta_lat,sta_lon,mod_nl,mod_ratio,mod_v,mod_top,ttable,tracer,
+			dtype=dtype)
+	# Write to source parameter file
+	if fn_srcpar is None:
+		return tmp_ttp,tmp_tts,tmp_xp,tmp_yp,tmp_zp
+	if tracer is not None:
+		start = time.perf_counter()
+	with rt_io.open_writer(fn_srcpar,fmt,src_cusp,sta_lab,dtype) as writer:
+		writer.write(0,0,(tmp_ttp,tmp_tts,tmp_xp,tmp_yp,tmp_zp,dist,az,ain))
+	if tracer is not None:
+		tracer.record('write',time.perf_counter()-start,nsta*nsrc)
 
 	return tmp_ttp,tmp_tts,tmp_xp,tmp_yp,tmp_zp
+
+
+def partials_catalog(events, stations, model, fn_srcpar='rayTrace.src', ttable=None, workers=1,
+					 tracer=None, fmt='text', cache=None, dtype=float):
+	"""
+	partials for an EventSet, StationSet and VelocityModel.  Their
+	fields are passed on as views, without copying the catalog.
+	###########
+	PARAMETERS:
+	events (EventSet) ---- Sources
+	stations (StationSet) ---- Receivers
+	model (VelocityModel) ---- Velocity model
+	Others as in partials
+	###########
+	RETURNS:
+	Same as partials
+	###########
+	"""
+	return partials(len(events),events.cusp,events.lat,events.lon,events.dep,len(stations),
+					stations.lab,stations.lat,stations.lon,*model.params,fn_srcpar,ttable,workers,
+					tracer,fmt,cache,dtype)
+
+
+def partials_stream(nsrc, src_cusp, src_lat, src_lon, src_dep, nsta, sta_lab, sta_lat,
+					sta_lon, mod_nl, mod_ratio, mod_v, mod_top, fn_srcpar='rayTrace.src',
+					ttable=None, workers=1, tracer=None, fmt='text', block=BLOCK, dtype=float):
+	"""
+	partials for catalogs that don't fit in memory.  Tiles of whole
+	station rows from iterpartials go straight to the output writer,
+	so memory use does not grow with the number of stations.
+	###########
+	PARAMETERS:
+	Same as partials, plus
+	block (int) ---- Station-event pairs per tile (default BLOCK); at
+				least one station row is traced at a time
+	###########
+	RETURNS:
+	npairs (int) ---- Number of station-event pairs written
+	###########
+	"""
+	src_dep = offset_depths(src_dep,mod_nl,mod_top)
+	tile = (max(1,block//max(1,nsrc)),nsrc)
+	with rt_io.open_writer(fn_srcpar,fmt,src_cusp,sta_lab,dtype) as writer:
+		for i0,j0,results in iterpartials(src_lat,src_lon,src_dep,sta_lat,sta_lon,mod_nl,mod_ratio,
+										  mod_v,mod_top,ttable,tile,workers,tracer,dtype):
+			if tracer is not None:
+				start = time.perf_counter()
+			writer.write(i0,j0,results)
+			if tracer is not None:
+				tracer.record('write',time.perf_counter()-start,results[0].size)
+
+	return nsta*nsrc
+
+
+def partials_incremental(nsrc, src_cusp, src_lat, src_lon, src_dep, nsta, sta_lab, sta_lat,
+						 sta_lon, mod_nl, mod_ratio, mod_v, mod_top, fn_srcpar='rayTrace.src',
+						 fn_state='rayTrace.state', ttable=None, workers=1, tracer=None,
+						 fmt='text', block=BLOCK, dtype=float):
+	"""
+	partials that only traces pairs whose event or station is new or
+	has moved since the last run.  Results are kept in a binary
+	sidecar (see rt_io.create_state) together with the coordinates and
+	a model_fingerprint; events are matched by cusp and stations by
+	label, with identical coordinates.  Pairs are traced the same way
+	as in a full run, so the output is identical to one.  If the
+	sidecar is missing or the model (or dtype) changed, every pair is
+	traced.
+	###########
+	PARAMETERS:
+	Same as partials_stream, plus
+	fn_state (str) ---- Sidecar location, read and then replaced
+				(default 'rayTrace.state')
+	###########
+	RETURNS:
+	ntraced (int) ---- Number of station-event pairs traced
+	###########
+	"""
+	fingerprint = model_fingerprint(mod_nl,mod_ratio,mod_v,mod_top,ttable,dtype)
+	prev = None
+	if os.path.exists(fn_state):
+		prev_fingerprint,prev = rt_io.load_state(fn_state)
+		if prev_fingerprint != fingerprint:
+			prev = None
+	# Match events and stations with the previous run
+	if prev is None:
+		src_row = np.full(nsrc,-1)
+		sta_row = np.full(nsta,-1)
+	else:
+		src_row = match_rows(prev['cusp'],(prev['src_lat'],prev['src_lon'],prev['src_dep']),
+							 src_cusp,(src_lat,src_lon,src_dep))
+		sta_row = match_rows(prev['sta_lab'],(prev['sta_lat'],prev['sta_lon']),
+							 sta_lab,(sta_lat,sta_lon))
+	old_src = np.flatnonzero(src_row >= 0)
+	new_src = np.flatnonzero(src_row < 0)
+	old_sta = np.flatnonzero(sta_row >= 0)
+	new_sta = np.flatnonzero(sta_row < 0)
+	state = rt_io.create_state(fn_state+'.tmp',fingerprint,src_cusp,src_lat,src_lon,src_dep,
+							   sta_lab,sta_lat,sta_lon,dtype)
+	rows = max(1,block//max(1,nsrc))
+	# Copy the results of unchanged pairs
+	for i0 in range(0,len(old_sta),rows):
+		i = old_sta[i0:i0+rows]
+		for name in rt_io.FIELDS:
+			state[name][np.ix_(i,old_src)] = prev[name][np.ix_(sta_row[i],src_row[old_src])]
+	# Trace new stations against all events and old stations against new events
+	src_dep = offset_depths(src_dep,mod_nl,mod_top)
+	for i,j in ((new_sta,np.arange(nsrc)),(old_sta,new_src)):
+		if len(i) == 0 or len(j) == 0:
+			continue
+		for i0,j0,results in iterpartials(src_lat[j],src_lon[j],src_dep[j],sta_lat[i],sta_lon[i],
+										  mod_nl,mod_ratio,mod_v,mod_top,ttable,
+										  (rows,len(j)),workers,tracer,dtype):
+			block_i = i[i0:i0+len(results[0])]
+			for name,result in zip(rt_io.FIELDS,results):
+				state[name][np.ix_(block_i,j)] = result
+	# Write the merged results
+	if tracer is not None:
+		start = time.perf_counter()
+	with rt_io.open_writer(fn_srcpar,fmt,src_cusp,sta_lab,dtype) as writer:
+		for i0 in range(0,nsta,rows):
+			writer.write(i0,0,[state[name][i0:i0+rows] for name in rt_io.FIELDS])
+	if tracer is not None:
+		tracer.record('write',time.perf_counter()-start,nsta*nsrc)
+	for array in state.values():
+		array.flush()
+	del state,prev
+	os.replace(fn_state+'.tmp',fn_state)
+
+	return len(new_sta)*nsrc+len(old_sta)*len(new_src)
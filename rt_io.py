@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+import json
+import numpy as np
+
+######################################################################
+# Output writers for rayTrace results (rayTrace.src and binary forms)
+######################################################################
+
+# Result arrays returned by rt_functions.trace_pairs, in order
+FIELDS = ('ttp','tts','xp','yp','zp','dist','az','ain')
+
+# Row format of the text source parameter file
+SRC_FORMAT = '%13g %13g %13g %13s %13g %13g %13g \n'
+
+# Magic bytes opening a raw binary file
+RAW_MAGIC = b'RTSRC\x01\n\x00'
+
+
+def format_src(src_cusp, sta_lab, ttp, tts, dist, az, ain):
+	"""
+	Format a block of rayTrace.src rows in one pass
+	###########
+	Every '%13g' field is 13 characters wide, so each column is
+	formatted as one string and the columns are interleaved as
+	fixed-width bytes.  Blocks with wider fields (long station
+	labels) fall back to formatting row by row.
+	###########
+	PARAMETERS:
+	src_cusp[nsrc] (int array) ---- Event IDs of the block
+	sta_lab[nsta] (str array) ---- Station labels of the block
+	ttp, tts, dist, az, ain[nsta,nsrc] (float array) ---- Block results
+	###########
+	RETURNS:
+	rows (bytes) ---- nsta*nsrc rows ordered station by station
+	###########
+	"""
+	nsta,nsrc = np.shape(ttp)
+	columns = [(src_cusp,'%13g'),(ttp,'%13g'),(tts,'%13g'),(sta_lab,'%13s'),
+			   (dist,'%13g'),(az,'%13g'),(ain,'%13g')]
+	rows = np.full((nsta,nsrc,14*7+1),ord(' '),dtype=np.uint8)
+	rows[:,:,-1] = ord('\n')
+	for k,(values,fmt) in enumerate(columns):
+		values = np.asarray(values).ravel().tolist()
+		text = (fmt*len(values)) % tuple(values)
+		if len(text) != 13*len(values):
+			break
+		text = np.frombuffer(text.encode('ascii'),dtype=np.uint8)
+		if k == 0:
+			rows[:,:,0:13] = text.reshape(1,nsrc,13)
+		elif k == 3:
+			rows[:,:,42:55] = text.reshape(nsta,1,13)
+		else:
+			rows[:,:,14*k:14*k+13] = text.reshape(nsta,nsrc,13)
+	else:
+		return rows.tobytes()
+	# Wide fields, format row by row
+	src_cusp = np.asarray(src_cusp).tolist()
+	return ''.join(SRC_FORMAT % (src_cusp[j],ttp[i,j],tts[i,j],sta_lab[i],dist[i,j],az[i,j],ain[i,j])
+				   for i in range(0,nsta) for j in range(0,nsrc)).encode('ascii')
+
+
+class TextWriter(object):
+	"""
+	Writes rayTrace.src text rows.  Blocks must cover every event and
+	arrive in station order, as in the serial partials loop.
+	###########
+	PARAMETERS:
+	fileloc (str) ---- Output file location
+	src_cusp[nsrc] (int array) ---- Event IDs
+	sta_lab[nsta] (str array) ---- Station labels
+	dtype (dtype) ---- Type of the result arrays of the binary formats
+				(default float64; text rows are the same for both)
+	###########
+	"""
+	def __init__(self, fileloc, src_cusp, sta_lab, dtype=float):
+		self.src_cusp = src_cusp
+		self.sta_lab = sta_lab
+		self.nrow = 0
+		self.srcpar = open(fileloc,'wb')
+
+	def write(self, i0, j0, results):
+		"""
+		Write results for stations i0:i0+n and events j0:j0+m
+		###########
+		PARAMETERS:
+		i0 (int) ---- First station of the block
+		j0 (int) ---- First event of the block
+		results (tuple) ---- Block arrays in the order of FIELDS
+		###########
+		"""
+		ttp,tts,xp,yp,zp,dist,az,ain = results
+		nsta,nsrc = np.shape(ttp)
+		if i0 != self.nrow or j0 != 0 or nsrc != len(self.src_cusp):
+			raise ValueError('Text output needs whole station rows in order')
+		self.srcpar.write(format_src(self.src_cusp,self.sta_lab[i0:i0+nsta],ttp,tts,dist,az,ain))
+		self.nrow = i0+nsta
+
+	def close(self):
+		self.srcpar.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+class NpzWriter(TextWriter):
+	"""
+	Collects the results and saves them as a NumPy .npz archive with
+	arrays cusp, sta_lab and the (nsta, nsrc) arrays named in FIELDS.
+	"""
+	def __init__(self, fileloc, src_cusp, sta_lab, dtype=float):
+		self.fileloc = fileloc
+		self.src_cusp = src_cusp
+		self.sta_lab = sta_lab
+		self.arrays = dict((name,np.zeros((len(sta_lab),len(src_cusp)),dtype=dtype)) for name in FIELDS)
+
+	def write(self, i0, j0, results):
+		for name,result in zip(FIELDS,results):
+			nsta,nsrc = np.shape(result)
+			self.arrays[name][i0:i0+nsta,j0:j0+nsrc] = result
+
+	def close(self):
+		# Pass a file object so numpy keeps the name as given
+		with open(self.fileloc,'wb') as f:
+			np.savez(f,cusp=self.src_cusp,sta_lab=np.asarray(self.sta_lab,dtype=str),
+				 **self.arrays)
+
+
+class RawWriter(TextWriter):
+	"""
+	Writes a memory-mappable binary file: 8 magic bytes, the length of
+	a JSON header as a little-endian uint64, the header (name, dtype,
+	shape and byte offset of each array) and the arrays cusp, sta_lab
+	and FIELDS, each aligned to 64 bytes.  Blocks may arrive in any
+	order.
+	"""
+	def __init__(self, fileloc, src_cusp, sta_lab, dtype=float):
+		src_cusp = np.asarray(src_cusp)
+		sta_lab = np.asarray(sta_lab,dtype=str)
+		nsta,nsrc = len(sta_lab),len(src_cusp)
+		arrays = [('cusp',src_cusp.dtype.str,(nsrc,)),('sta_lab',sta_lab.dtype.str,(nsta,))]
+		arrays += [(name,little_endian(dtype),(nsta,nsrc)) for name in FIELDS]
+		create_raw(fileloc,arrays)
+		self.arrays = load_raw(fileloc,mode='r+')
+		self.arrays['cusp'][:] = src_cusp
+		self.arrays['sta_lab'][:] = sta_lab
+
+	def write(self, i0, j0, results):
+		for name,result in zip(FIELDS,results):
+			nsta,nsrc = np.shape(result)
+			self.arrays[name][i0:i0+nsta,j0:j0+nsrc] = result
+
+	def close(self):
+		for array in self.arrays.values():
+			array.flush()
+
+
+def create_raw(fileloc, arrays, meta=None):
+	"""
+	Create a raw file with room for the given arrays (see RawWriter)
+	###########
+	PARAMETERS:
+	fileloc (str) ---- Raw file location
+	arrays (list) ---- (name, dtype string, shape) of each array
+	meta (dict) ---- JSON-serializable values to keep in the header (optional)
+	###########
+	"""
+	# Lay out the header, then every array on a 64 byte boundary
+	fields = []
+	offset = 0
+	for name,dtype,shape in arrays:
+		fields.append({'name':name,'dtype':dtype,'shape':shape,'offset':offset})
+		offset += -(-np.dtype(dtype).itemsize*int(np.prod(shape))//64)*64
+	# Shift the arrays past the header until the header fits
+	start = 0
+	while True:
+		header = {'fields':[dict(field,offset=field['offset']+start) for field in fields]}
+		if meta is not None:
+			header['meta'] = meta
+		header = json.dumps(header).encode('ascii')
+		if 16+len(header) <= start:
+			break
+		start = -(-(16+len(header))//64)*64
+	with open(fileloc,'wb') as f:
+		f.write(RAW_MAGIC)
+		f.write(np.uint64(len(header)).astype('<u8').tobytes())
+		f.write(header)
+		f.truncate(start+offset)
+
+
+def little_endian(dtype):
+	"""Little-endian dtype string of raw file arrays, e.g. '<f8'"""
+	return np.dtype(dtype).newbyteorder('<').str
+
+
+# Output formats selectable from rt_run.py
+WRITERS = {'text':TextWriter,'npz':NpzWriter,'raw':RawWriter}
+
+
+def open_writer(fileloc, fmt, src_cusp, sta_lab, dtype=float):
+	"""
+	Open a writer for one of the formats in WRITERS
+	###########
+	PARAMETERS:
+	fileloc (str) ---- Output file location
+	fmt (str) ---- 'text' (rayTrace.src), 'npz' or 'raw'
+	src_cusp[nsrc] (int array) ---- Event IDs
+	sta_lab[nsta] (str array) ---- Station labels
+	dtype (dtype) ---- Type of the binary result arrays (default float64)
+	###########
+	RETURNS:
+	writer ---- Object with write(i0, j0, results) and close()
+	###########
+	"""
+	if fmt not in WRITERS:
+		raise ValueError('Unknown output format %s (use %s)' % (fmt,', '.join(WRITERS)))
+	return WRITERS[fmt](fileloc,src_cusp,sta_lab,dtype)
+
+
+def read_header(fileloc):
+	"""
+	Read the JSON header of a raw file
+	###########
+	PARAMETERS:
+	fileloc (str) ---- Raw file location
+	###########
+	RETURNS:
+	header (dict) ---- fields (name, dtype, shape, offset of each
+				array) and meta if the file has one
+	###########
+	"""
+	with open(fileloc,'rb') as f:
+		if f.read(8) != RAW_MAGIC:
+			raise ValueError('%s is not a rayTrace raw file' % fileloc)
+		length = int(np.frombuffer(f.read(8),dtype='<u8')[0])
+		return json.loads(f.read(length).decode('ascii'))
+
+
+def load_raw(fileloc, mode='r'):
+	"""
+	Memory-map the arrays of a file written by RawWriter
+	###########
+	PARAMETERS:
+	fileloc (str) ---- Raw file location
+	mode (str) ---- numpy.memmap mode ('r' read only, 'r+' to update)
+	###########
+	RETURNS:
+	arrays (dict) ---- cusp, sta_lab and FIELDS as numpy.memmap arrays
+	###########
+	"""
+	header = read_header(fileloc)
+	arrays = {}
+	for field in header['fields']:
+		arrays[field['name']] = np.memmap(fileloc,dtype=field['dtype'],mode=mode,
+										  offset=field['offset'],shape=tuple(field['shape']))
+
+	return arrays
+
+
+def load_src(fileloc):
+	"""
+	Load binary rayTrace output written in the 'npz' or 'raw' format
+	###########
+	PARAMETERS:
+	fileloc (str) ---- Output file location
+	###########
+	RETURNS:
+	arrays (dict) ---- cusp[nsrc], sta_lab[nsta] and the (nsta, nsrc)
+				arrays named in FIELDS
+	###########
+	"""
+	with open(fileloc,'rb') as f:
+		magic = f.read(8)
+	if magic == RAW_MAGIC:
+		return load_raw(fileloc)
+	with np.load(fileloc) as f:
+		return dict((name,f[name]) for name in f.files)
+
+
+def create_state(fileloc, fingerprint, src_cusp, src_lat, src_lon, src_dep,
+				 sta_lab, sta_lat, sta_lon, dtype=float):
+	"""
+	Create the binary sidecar kept by incremental runs: a raw file with
+	the station and event coordinates next to the results, and the
+	velocity model fingerprint in its header
+	###########
+	PARAMETERS:
+	fileloc (str) ---- Sidecar file location
+	fingerprint (str) ---- rt_functions.model_fingerprint of the run
+	src_cusp, src_lat, src_lon, src_dep[nsrc] (array) ---- Events
+	sta_lab, sta_lat, sta_lon[nsta] (array) ---- Stations
+	dtype (dtype) ---- Type of the FIELDS arrays (default float64; the
+				coordinates are always float64)
+	###########
+	RETURNS:
+	arrays (dict) ---- Writable numpy.memmap arrays; FIELDS are left
+				for the caller to fill
+	###########
+	"""
+	src_cusp = np.asarray(src_cusp)
+	sta_lab = np.asarray(sta_lab,dtype=str)
+	nsta,nsrc = len(sta_lab),len(src_cusp)
+	arrays = [('cusp',src_cusp.dtype.str,(nsrc,)),('sta_lab',sta_lab.dtype.str,(nsta,))]
+	arrays += [(name,'<f8',(nsrc,)) for name in ('src_lat','src_lon','src_dep')]
+	arrays += [(name,'<f8',(nsta,)) for name in ('sta_lat','sta_lon')]
+	arrays += [(name,little_endian(dtype),(nsta,nsrc)) for name in FIELDS]
+	create_raw(fileloc,arrays,{'model':fingerprint})
+	state = load_raw(fileloc,mode='r+')
+	for name,values in (('cusp',src_cusp),('sta_lab',sta_lab),('src_lat',src_lat),('src_lon',src_lon),
+						('src_dep',src_dep),('sta_lat',sta_lat),('sta_lon',sta_lon)):
+		state[name][:] = values
+
+	return state
+
+
+def load_state(fileloc):
+	"""
+	Load an incremental sidecar written by create_state
+	###########
+	PARAMETERS:
+	fileloc (str) ---- Sidecar file location
+	###########
+	RETURNS:
+	fingerprint (str) ---- Velocity model fingerprint of the previous run
+	state (dict) ---- Read-only numpy.memmap arrays
+	###########
+	"""
+	return read_header(fileloc).get('meta',{}).get('model'),load_raw(fileloc)
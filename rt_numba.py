@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+import numba
+import numpy as np
+
+"""
+Numba kernels for rt_functions.ttime_batch
+
+The tiddid, refract and direct routines written pair by pair, as in the
+HypoDD fortran, and compiled with numba.  ttime_pairs traces every pair
+in a prange loop across threads (NUMBA_NUM_THREADS); each pair follows
+the same operations in the same order as the NumPy routines (float32
+velocities stay float32 where NumPy keeps them so, layer sums run top
+down like add_layers), so the results are identical to the 'python'
+backend, bit for bit.  The compiled code is cached on disk (numba's
+cache=True, in __pycache__ or NUMBA_CACHE_DIR), so only the first run
+for a velocity dtype pays for the compilation.
+
+Select with rt_functions.set_backend('numba'), RT_BACKEND=numba or
+rt_run.py --backend numba; rt_functions falls back to the NumPy
+routines when numba is not installed.
+"""
+
+# Options of every kernel: NumPy's floating point errors (inf and nan
+# instead of ZeroDivisionError) and no fast math, to keep the rounding
+OPTIONS = dict(cache=True,nogil=True,error_model='numpy')
+
+
+@numba.njit(**OPTIONS)
+def tiddid(jl, nl, v, vsq, thk, tid, did):
+	"""tiddid for event layer jl, written into tid[nl] and did[nl] (zeros above jl)"""
+	tid[:] = 0.
+	did[:] = 0.
+	j = max(jl,0)
+	fastest = vsq[0]
+	for m in range(1,nl):
+		if vsq[m] <= fastest:
+			# Low velocity layer
+			if m >= jl:
+				tid[m] = 100000.
+				did[m] = 100000.
+			continue
+		fastest = max(fastest,vsq[m])
+		if m < jl:
+			continue
+		# Layers above the event layer, then twice the ones below
+		tid1 = 0.
+		did1 = 0.
+		for l in range(0,j):
+			sqt = np.sqrt(vsq[m]-vsq[l])
+			tid1 += thk[l]*sqt/(v[l]*v[m])
+			did1 += thk[l]*v[l]/sqt
+		tid2 = 0.
+		did2 = 0.
+		for l in range(j,m):
+			sqt = np.sqrt(vsq[m]-vsq[l])
+			tid2 += thk[l]*sqt/(v[l]*v[m])
+			did2 += thk[l]*v[l]/sqt
+		tid[m] = tid1 + 2*tid2
+		did[m] = did1 + 2*did2
+
+
+@numba.njit(**OPTIONS)
+def refract(nl, v, vsq, tid, did, jl, tkj, delta):
+	"""
+	refract for one pair, with the intercepts of its source depth
+	computed on the fly.  Returns kk, tref and xovmax as refract_batch
+	(xovmax nan for a low velocity layer below the event layer).
+	"""
+	tref = 100000.
+	kk = 0
+	for m in range(jl+1,nl):
+		if tid[m] == 100000.:
+			continue
+		sqt = np.sqrt(vsq[m]-vsq[jl])
+		tr = (tid[m] - tkj*sqt/(v[m]*v[jl])) + delta/v[m]
+		if did[m] - tkj*v[jl]/sqt > delta:
+			tr = 100000.
+		if np.isnan(tr):
+			# argmin takes the first nan
+			tref = 100000.
+			kk = 0
+			break
+		if tr < tref:
+			tref = tr
+			kk = m
+	lx = jl+1
+	if lx >= nl or tid[lx] == 100000.:
+		xovmax = np.nan
+	else:
+		sqt = np.sqrt(vsq[lx]-vsq[jl])
+		tinj = tid[lx] - tkj*sqt/(v[lx]*v[jl])
+		if jl == 0:
+			xovmax = tinj*v[lx]*v[0]/(v[lx] - v[0])
+		else:
+			xovmax = (tinj - tid[lx])*v[lx]*v[lx]/(v[lx]*v[lx])
+
+	return kk,tref,xovmax
+
+
+@numba.njit(**OPTIONS)
+def direct(nl, v, vsq, thk, jl, tkj, delta, depth):
+	"""
+	direct_batch for one pair below the surface layer.  Returns
+	tdir, u, x and the number of false position iterations.
+	"""
+	# Layers above the event (all but the last for jl = -1, as v[:jl])
+	nab = jl if jl >= 0 else nl+jl
+	jw = jl if jl >= 0 else len(v)+jl
+	# Fastest layer between the event and the surface (the first if tied)
+	lmax = jl
+	vlmax = v[jw]
+	l = 0
+	for k in range(1,nab):
+		if v[k] > v[l]:
+			l = k
+	if v[l] > vlmax:
+		lmax = l
+		vlmax = v[l]
+	vsqj = vsq[jl]
+	if lmax == jl:
+		tklmax = tkj
+	else:
+		tklmax = thk[lmax]
+	if tklmax <= 0.05:
+		tklmax = 0.05
+	# Initial bounds on sine of takeoff angle
+	ua = (v[jw]/vlmax)*delta/np.sqrt(delta*delta + depth*depth)
+	ub = (v[jw]/vlmax)*delta/np.sqrt(delta*delta + tklmax*tklmax)
+	uasq = ua*ua
+	ubsq = ub*ub
+	if uasq >= 1:
+		uasq = 0.9999
+	if ubsq >= 1:
+		ubsq = 0.9999
+	xa = tkj*ua/np.sqrt(1.0-uasq)
+	if lmax == jl:
+		xb = delta
+	else:
+		xb = tkj*ub/np.sqrt(1.0-ubsq)
+	dela = xa
+	delb = xb
+	for k in range(0,nab):
+		c = vsqj/vsq[k]
+		dela += thk[k]*ua/np.sqrt(c-uasq)
+		delb += thk[k]*ub/np.sqrt(c-ubsq)
+	# False position
+	x = 0.
+	u = 0.
+	usq = 0.
+	delt = np.nan
+	niter = 0
+	for count in range(0,25):
+		if (delb-dela) < 0.02:
+			x = 0.5*(xa+xb)
+			u = x/np.sqrt(x*x + tkj*tkj)
+			usq = u*u
+			if count == 0:
+				# Initial bounds already within 0.02 km (near the epicentre)
+				delt = x
+				for k in range(0,nab):
+					delt += thk[k]*u/np.sqrt(vsqj/vsq[k]-usq)
+			break
+		niter += 1
+		x = xa+(delta-dela)*(xb-xa)/(delb-dela)
+		u = x/np.sqrt(x*x + tkj*tkj)
+		usq = u*u
+		delt = x
+		for k in range(0,nab):
+			delt += thk[k]*u/np.sqrt(vsqj/vsq[k]-usq)
+		xtest = delt-delta
+		if abs(xtest) < 0.02:
+			break
+		if xtest < 0.0:
+			xa = x
+			dela = delt
+		else:
+			xb = x
+			delb = delt
+	# Direct-ray travel time
+	tdir = np.sqrt(x*x + tkj*tkj)/v[jw]
+	for k in range(0,nab):
+		tdir += thk[k]*v[jw]/(vsq[k]+np.sqrt(vsqj/vsq[k]-usq))
+	tdir = tdir - (u/v[jw])*(delt-delta)
+
+	return tdir,u,x,niter
+
+
+def ttime_pairs(nl, v, top, vsq, thk, jl, tkj, depth, isrc, delta):
+	"""
+	ttime for every pair, the interface of the ttime_batch backends
+	###########
+	PARAMETERS:
+	nl (int) ---- Number of layers
+	v (float array) ---- Velocity of layers (float32 or float64)
+	top[nl] (float array) ---- Depth to top of layer
+	vsq[nl], thk[nl] (float array) ---- From vmodel_batch
+	jl, tkj, depth[nsrc] (int, float arrays) ---- Event layer, depth in
+					it and depth of each distinct source depth
+	isrc[n] (int array) ---- Source depth of each pair
+	delta[n] (float array) ---- Epicentral distance of each pair
+	###########
+	RETURNS:
+	t[n] (float array) ---- Minimum traveltime
+	ain[n] (float array) ---- Takeoff angles, or None to have ttime_batch
+					compute them from kk and u
+	kk[n] (int array) ---- Refracting layer of the fastest ray, -1 for
+					the direct ray, 0 for none
+	u[n], x[n] (float array) ---- Sine of the takeoff angle and event
+					layer leg of direct rays (0 for the others)
+	near[n] (bool array) ---- delta <= xovmax, so the direct ray was solved
+	niter[n] (int array) ---- Direct ray iterations (None if not counted)
+	lvl[n] (bool array) ---- Refracted ray found under a low velocity
+					layer below the event layer (an error in ttime)
+	###########
+	"""
+	t,kk,u,x,niter,lvl = ttimes(nl,v,vsq,thk,jl,tkj,depth,isrc,delta)
+
+	return t,None,kk,u,x,niter >= 0,niter,lvl
+
+
+@numba.njit(parallel=True,**OPTIONS)
+def ttimes(nl, v, vsq, thk, jl, tkj, depth, isrc, delta):
+	"""Compiled loop of ttime_pairs; niter is -1 where the direct ray was not solved"""
+	n = len(delta)
+	nsrc = len(jl)
+	# Intercepts of each event layer (jl = -1 takes those of 0)
+	tid = np.zeros((nl,nl))
+	did = np.zeros((nl,nl))
+	used = np.zeros(nl,dtype=np.bool_)
+	for i in range(0,nsrc):
+		used[max(jl[i],0)] = True
+	for layer in numba.prange(0,nl):
+		if used[layer]:
+			tiddid(layer,nl,v,vsq,thk,tid[layer],did[layer])
+	t = np.empty(n)
+	kk = np.zeros(n,dtype=np.int64)
+	u = np.zeros(n)
+	x = np.zeros(n)
+	niter = np.full(n,-1,dtype=np.int64)
+	lvl = np.zeros(n,dtype=np.bool_)
+	for i in numba.prange(0,n):
+		s = isrc[i]
+		j = jl[s]
+		row = max(j,0)
+		k,tref,xovmax = refract(nl,v,vsq,tid[row],did[row],j,tkj[s],delta[i])
+		if tref != 100000.:
+			lvl[i] = np.isnan(xovmax)
+		else:
+			xovmax = 100000.
+		t[i] = tref
+		kk[i] = k
+		if not delta[i] <= xovmax:
+			continue
+		if j == 0:
+			# Surface layer event
+			r = np.sqrt(depth[s]*depth[s] + delta[i]*delta[i])
+			tdir = r/v[0]
+			ui = delta[i]/r
+			xi = delta[i]
+			niter[i] = 0
+		else:
+			tdir,ui,xi,niter[i] = direct(nl,v,vsq,thk,j,tkj[s],delta[i],depth[s])
+		if tref >= tdir:
+			t[i] = tdir
+			kk[i] = -1
+			u[i] = ui
+			x[i] = xi
+
+	return t,kk,u,x,niter,lvl
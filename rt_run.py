@@ -1,9 +1,16 @@
 #!/usr/bin/env python
+import argparse
+import itertools
+import json
 import numpy as np
 import os
-import sys
+import platform
+import rt_cache
 import rt_functions as rt
+import rt_io
 import time
+import warnings
+from collections import OrderedDict
 
 """
 Script runs rayTrace from hypoDD (v1.3)
@@ -25,8 +32,49 @@ Note README file for all necessary citations for use of this program package.
 To run this script there are two required inputs.
 	1. the input file location string (default='rayTrace.inp')
 	2. the output file location string (default='rayTrace.src')
+An optional third input is a traveltime table file (.npz).  The table is built
+and saved there on the first run and reused while the velocity model is unchanged,
+so partials interpolates traveltimes instead of ray tracing every pair.
+Use --workers N to trace the station-event pairs with N processes.
+Use --trace to print call counts, times and ray branches for each subroutine.
+Use --profile REPORT.json to write the same counts as JSON, with the histogram of
+direct ray iterations, the fraction of pairs solved for a direct ray and the time
+spent in each event layer (see rt_functions.Tracer.report), to compare runs.
+Use --format npz or --format raw to write the results as binary arrays instead of
+text (see rt_io.py, load them back with rt_io.load_src).
+Use --block N to stream the output in tiles of about N station-event pairs, so
+memory stays constant for catalogs too big to hold (text and raw formats).
+Use --incremental STATEFILE to keep the results in a binary sidecar and on later
+runs only trace pairs whose event or station is new or moved.  The sidecar is
+rebuilt from scratch when the velocity model (or traveltime table), --backend,
+--solver or --precision changes.
+Use --backend numba to trace with the compiled kernels of rt_numba.py (same
+results, several threads; set NUMBA_NUM_THREADS) when numba is installed.
+Use --backend fortran for the fortran routines themselves, wrapped with f2py
+(build them first with python rt_fortran.py); the traveltimes are then those of
+the fortran rayTrace.  The RT_BACKEND environment variable sets the default.
+Use --solver newton to solve direct rays by Newton iterations (rt.direct_newton)
+instead of the false position of HypoDD: faster for models with many layers,
+and within a few ms of the converged direct ray where false position can stall
+seconds off, so the output differs from the default (NumPy routines only, any
+--backend is ignored for it).  RT_SOLVER sets the default.
+Use --precision float32 to trace, hold and write (npz, raw) the results in single
+precision, for half the memory: traveltimes stay within rt.FLOAT32_ERROR of the
+float64 ones, unless the model has a low velocity layer (a warning is given).
+Use --cache DBFILE to share results between runs, even of different catalogs:
+pairs already traced with the same velocity model, --backend, --solver,
+--precision, station and event coordinates are read from the SQLite file DBFILE (see rt_cache.py) and only
+the others are traced.  --cache-size caps the file, least recently used first.
 Examples of these can be found in the example/ folder or in the README
 
+Importing this module has no side effects.  To trace from another program load
+the inputs once and call the loaded RayTracer as often as needed:
+	raytracer = rt_run.RayTracer.from_inputfile('rayTrace.inp')
+	ttp,tts,xp,yp,zp,dist,az,ain = raytracer.trace(events=[0,5],stations=None)
+	results = raytracer.trace_events(src_lat,src_lon,src_dep)  # relocated hypocenters
+	dtp_dv,dtp_dtop,dts_dv,dts_dtop = raytracer.derivatives()  # [npairs,nl] for tomography
+	raytracer.write('rayTrace.src')
+
 Examples of all data files required to run this package (event.dat and station.dat) 
 can also be found in the example/ folder or in the README.  This format is consistent
 with hypoDD and therefore can be run on both software packages.
@@ -53,8 +101,8 @@ def readinputfile(fileloc='rayTrace.inp'):
 	mod_v (float array) ---- P velocity of layers (km)
 	###########
 	"""
-	inputfile = open(fileloc)
-	inputs = inputfile.readlines()
+	with open(fileloc) as inputfile:
+		inputs = inputfile.readlines()
 	l = 0
 	for line in inputs:
 		line = line.split()
@@ -79,6 +127,157 @@ def readinputfile(fileloc='rayTrace.inp'):
 	return eventfile,statfile,mod_nl,mod_ratio,mod_top,mod_v
 
 
+# Record type of event.dat rows
+EVENT_DTYPE = rt.EVENT_DTYPE
+
+# Number of lines parsed at a time
+CHUNKSIZE = 100000
+
+
+def parseevents(lines, first=1):
+	"""
+	This function parses a block of event.dat lines in bulk
+	###########
+	Columns are read as in rayTrace.f: latitude, longitude and depth
+	from columns 3-5 and the event ID from column 10.
+	###########
+	PARAMETERS:
+	lines (list of str) ---- Event.dat lines
+	first (int) ---- Line number of lines[0] in the file (for errors)
+	###########
+	RETURNS:
+	events (structured array) ---- Rows with fields of EVENT_DTYPE
+	###########
+	"""
+	try:
+		return np.loadtxt(lines,dtype=EVENT_DTYPE,usecols=(9,2,3,4),ndmin=1,comments=None)
+	except ValueError:
+		# Find the line that failed
+		for index,line in enumerate(lines):
+			try:
+				np.loadtxt([line],dtype=EVENT_DTYPE,usecols=(9,2,3,4),ndmin=1,comments=None)
+			except ValueError:
+				raise ValueError('** Bad earthquake data, so stop: (line %i)\n%s' % (first+index,line.rstrip()))
+		raise
+
+
+def parsestats(lines, first=1):
+	"""
+	This function parses a block of station.dat lines in bulk
+	###########
+	PARAMETERS:
+	lines (list of str) ---- Station.dat lines
+	first (int) ---- Line number of lines[0] in the file (for errors)
+	###########
+	RETURNS:
+	stats (structured array) ---- Rows with fields lab (fixed-width
+				str, as wide as the longest label), lat and lon
+	###########
+	"""
+	try:
+		columns = np.loadtxt(lines,dtype=str,usecols=(0,1,2),ndmin=2,comments=None)
+		stats = np.empty(len(columns),dtype=[('lab',columns.dtype),('lat',np.float64),('lon',np.float64)])
+		stats['lab'] = columns[:,0]
+		stats['lat'] = columns[:,1].astype(np.float64)
+		stats['lon'] = columns[:,2].astype(np.float64)
+		return stats
+	except ValueError:
+		# Find the line that failed
+		for index,line in enumerate(lines):
+			stat = line.split()
+			try:
+				float(stat[1]),float(stat[2])
+			except (IndexError,ValueError):
+				if stat:
+					raise ValueError('** Bad station line, stop: (line %i)\n%s' % (first+index,line.rstrip()))
+		raise
+
+
+def iterlines(fileloc, parse, chunksize=CHUNKSIZE):
+	"""
+	This function streams a data file as parsed blocks of lines
+	###########
+	PARAMETERS:
+	fileloc (str) ---- Data file location
+	parse (function) ---- parseevents or parsestats
+	chunksize (int) ---- Lines per block (default CHUNKSIZE)
+	###########
+	RETURNS:
+	Generator of structured arrays, one per block
+	###########
+	"""
+	with open(fileloc,'r') as datafile:
+		first = 1
+		while True:
+			lines = list(itertools.islice(datafile,chunksize))
+			if not lines:
+				break
+			yield parse(lines,first)
+			first = first+len(lines)
+
+
+def iterevents(fileloc, chunksize=CHUNKSIZE):
+	"""
+	This function streams the event.dat file in blocks of chunksize lines
+	###########
+	PARAMETERS:
+	fileloc (str) ---- Event.dat file location
+	chunksize (int) ---- Lines per block (default CHUNKSIZE)
+	###########
+	RETURNS:
+	Generator of structured arrays with fields cusp (int64), lat, lon, dep
+	###########
+	"""
+	return iterlines(fileloc,parseevents,chunksize)
+
+
+def iterstats(fileloc, chunksize=CHUNKSIZE):
+	"""
+	This function streams the station.dat file in blocks of chunksize lines
+	###########
+	PARAMETERS:
+	fileloc (str) ---- Station.dat file location
+	chunksize (int) ---- Lines per block (default CHUNKSIZE)
+	###########
+	RETURNS:
+	Generator of structured arrays with fields lab, lat, lon
+	###########
+	"""
+	return iterlines(fileloc,parsestats,chunksize)
+
+
+def readeventset(fileloc):
+	"""
+	This function reads the event.dat file into an EventSet
+	###########
+	PARAMETERS:
+	fileloc (str) ---- Event.dat file location
+	###########
+	RETURNS:
+	events (EventSet) ---- Event IDs (int64), latitudes, longitudes and depths
+	###########
+	"""
+	events = list(iterevents(fileloc))
+
+	return rt.EventSet(np.concatenate(events) if events else np.zeros(0,dtype=EVENT_DTYPE))
+
+
+def readstationset(fileloc):
+	"""
+	This function reads the station.dat file into a StationSet
+	###########
+	PARAMETERS:
+	fileloc (str) ---- Station.dat file location
+	###########
+	RETURNS:
+	stations (StationSet) ---- Fixed-width labels, latitudes and longitudes
+	###########
+	"""
+	stats = list(iterstats(fileloc))
+
+	return rt.StationSet(np.concatenate(stats) if stats else np.zeros(0,dtype=rt.station_dtype(1)))
+
+
 def readevents(fileloc):
 	"""
 	This function reads the event.dat file into numpy arrays
@@ -94,30 +293,20 @@ def readevents(fileloc):
 	src_dep (float array) ---- Event depths
 	###########
 	"""
-	# Read file
-	eventfile = open(fileloc,'r')
-	events = eventfile.readlines()
-	# Initialize arrays
+	events = readeventset(fileloc).records
+	# Split into contiguous arrays
 	nsrc = len(events)
-	src_cusp = np.zeros(nsrc)
-	src_lat = np.zeros(nsrc)
-	src_lon = np.zeros(nsrc)
-	src_dep = np.zeros(nsrc)
-	# Fill arrays
-	for index,event in enumerate(events):
-		event = event.split()
-		event = list(filter(None,event))
-		src_cusp[index] = event[-1]
-		src_lat[index] = event[2]
-		src_lon[index] = event[3]
-		src_dep[index] = event[4]
+	src_cusp = np.ascontiguousarray(events['cusp'])
+	src_lat = np.ascontiguousarray(events['lat'])
+	src_lon = np.ascontiguousarray(events['lon'])
+	src_dep = np.ascontiguousarray(events['dep'])
 
 	return nsrc,src_cusp,src_lat,src_lon,src_dep
 
 
 def readstats(fileloc):
 	"""
-	This function reads the event.dat file into numpy arrays
+	This function reads the station.dat file into numpy arrays
 	###########
 	PARAMETERS:
 	fileloc (str) ---- Station.dat file location
@@ -129,66 +318,327 @@ def readstats(fileloc):
 	sta_lon (float array) ---- Station longitudes
 	###########
 	"""
-	# Read file
-	statfile = open(fileloc,'r')
-	stats = statfile.readlines()
-	# Initialize arrays
+	stats = readstationset(fileloc).records
+	# Split into contiguous arrays
 	nsta = len(stats)
-	sta_lab = np.empty(nsta,dtype='object')
-	sta_lat = np.zeros(nsta)
-	sta_lon = np.zeros(nsta)
-	# Fill arrays
-	for index,stat in enumerate(stats):
-		stat = stat.split(' ')
-		stat = list(filter(None,stat))
-		sta_lab[index] = stat[0]
-		sta_lat[index] = float(stat[1])
-		sta_lon[index] = float(stat[2])
+	sta_lab = np.ascontiguousarray(stats['lab'])
+	sta_lat = np.ascontiguousarray(stats['lat'])
+	sta_lon = np.ascontiguousarray(stats['lon'])
 
 	return nsta,sta_lab,sta_lat,sta_lon
 
 
 
 
-# RUN FROM INPUT TO OUTPUT
-try:
-	#import pdb;pdb.set_trace()
-	inputs = sys.argv
-except:
-	print('User Enter Inputs:')
-	inputfile = input('Inputfile location.  Default = "rayTrace.inp"')
-	if not inputfile:
-		inputfile = 'rayTrace.inp'
-	outputfile = input('Outputfile location.  Default = "rayTrace.src"')
-	if not outputfile:
-		outputfile = 'rayTrace.src'
-
-if len(inputs) ==1:
-	print('User Enter Inputs:')
-	inputfile = input('Inputfile location.  Default = "rayTrace.inp"')
-	if not inputfile:
-		inputfile = 'rayTrace.inp'
-	outputfile = input('Outputfile location.  Default = "rayTrace.src"')
-	if not outputfile:
-		outputfile = 'rayTrace.src'
-elif len(inputs) > 1 and len(inputs) < 3:
-	raise RuntimeError('Not enough inputs.  Run format: run rt_run.py [inputfile] [outputfile]') 
-elif len(inputs) == 3:
-	inputfile = inputs[1]
-	outputfile = inputs[2]
-else:
-	raise RuntimeError('Inputs file issues. Run format: run rt_run.py [inputfile] [outputfile]')
-
-
-# Initialise data
-eventfile,statfile,mod_nl,mod_ratio,mod_top,mod_v = readinputfile(inputfile)
-nsrc,src_cusp,src_lat,src_lon,src_dep = readevents(eventfile)
-nsta,sta_lab,sta_lat,sta_lon = readstats(statfile)
-
-start = time.time()
-print('Starting Partials')
-tmp_ttp,tmp_tts,tmp_xp,tmp_yp,tmp_zp = rt.partials(nsrc,src_cusp,src_lat,src_lon,src_dep,nsta,sta_lab,sta_lat,
-												   sta_lon,mod_nl,mod_ratio,mod_v,mod_top,outputfile)
-end = time.time()
-print('rayTrace complete.  Outputs located in %s.  Time elapsed %f' % (outputfile,end-start))
+class RayTracer(object):
+	"""
+	Velocity model, stations and events loaded once and traced on
+	request, for callers that serve many requests from one process
+	(e.g. a relocation service) instead of running this script.
+	###########
+	trace returns the results of all pairs or of a subset of the
+	loaded stations and events, trace_events those of hypocenters
+	that are not in the catalog (e.g. relocated ones), and write runs
+	partials_catalog (or partials_stream, partials_incremental) to an
+	output file as the command line does.  Event depths are kept as
+	read; the copies moved off layer boundaries are made once here.
+	###########
+	PARAMETERS:
+	model (VelocityModel) ---- Velocity model
+	events (EventSet) ---- Events
+	stations (StationSet) ---- Stations
+	ttable (TravelTimeTable) ---- Interpolate traveltimes from this table (optional)
+	workers (int) ---- Number of processes to trace with (default 1)
+	cache (ResultCache) ---- Result cache to read and add to (optional)
+	dtype (dtype) ---- Precision to trace in and return, float64 (default)
+				or float32 (see rt.partials)
+	###########
+	"""
+	def __init__(self, model, events, stations, ttable=None, workers=1, cache=None, dtype=float):
+		self.model = model
+		self.events = events
+		self.stations = stations
+		self.ttable = ttable
+		self.workers = workers
+		self.cache = cache
+		self.dtype = np.dtype(dtype)
+		if self.dtype == np.float32 and not rt.float32_bounded(model.v[:model.nl]):
+			warnings.warn('Low velocity layer in the model: float32 traveltimes may be far '
+						  'from float64 ones (see rt_functions.FLOAT32_ERROR)')
+		# Depths moved off layer boundaries, as partials does
+		self.src_moved = model.offset_depths(events.dep)
+
+	@classmethod
+	def from_inputfile(cls, fileloc='rayTrace.inp', tablefile=None, **options):
+		"""
+		Load the model, events and stations named in a rayTrace input file
+		###########
+		PARAMETERS:
+		fileloc (str) ---- Input file location (default='rayTrace.inp')
+		tablefile (str) ---- Traveltime table file, built if missing or
+					made for another model (optional, see load_table)
+		options ---- workers, cache, dtype (see RayTracer)
+		###########
+		RETURNS:
+		tracer (RayTracer) ---- The loaded catalog
+		###########
+		"""
+		eventfile,statfile,mod_nl,mod_ratio,mod_top,mod_v = readinputfile(fileloc)
+		model = rt.VelocityModel(mod_nl,mod_ratio,mod_v,mod_top)
+		tracer = cls(model,readeventset(eventfile),readstationset(statfile),**options)
+		if tablefile is not None:
+			tracer.load_table(tablefile)
+
+		return tracer
+
+	@property
+	def nsrc(self):
+		return len(self.events)
 
+	@property
+	def nsta(self):
+		return len(self.stations)
+
+	def load_table(self, tablefile, verbose=False):
+		"""
+		Load the traveltime table in tablefile, or build it for this
+		catalog and save it there if it is missing or was made for
+		another velocity model, precision, backend or solver (saying so
+		before the build if verbose).  Returns True if it was built.
+		"""
+		self.ttable = None
+		if os.path.exists(tablefile):
+			self.ttable = rt.TravelTimeTable.load(tablefile)
+		if self.ttable is not None and self.ttable.matches(*self.model.params,self.dtype):
+			return False
+		delt,dist,az = rt.delaz_pairs(self.events.lat,self.events.lon,self.stations.lat,self.stations.lon)
+		zmax = min(self.events.dep.max(),self.model.top[self.model.nl-1])
+		if verbose:
+			print('Building traveltime table %s' % tablefile)
+		self.ttable = rt.TravelTimeTable.build(*self.model.params,dist.max(),zmax,dtype=self.dtype)
+		self.ttable.save(tablefile)
+
+		return True
+
+	def trace(self, events=None, stations=None, tracer=None):
+		"""
+		Trace loaded station-event pairs
+		###########
+		PARAMETERS:
+		events (index or mask) ---- Events to trace (default all)
+		stations (index or mask) ---- Stations to trace (default all)
+		tracer (Tracer) ---- Record calls, time and ray branches (optional)
+		###########
+		RETURNS:
+		results (tuple) ---- ttp, tts, xp, yp, zp, dist, az, ain [nsta,nsrc]
+					arrays of the selected stations and events (as
+					rt.trace_pairs, fields as in rt_io.FIELDS)
+		###########
+		"""
+		events = slice(None) if events is None else events
+		stations = slice(None) if stations is None else stations
+		src = self.events[events]
+		moved = np.atleast_1d(self.src_moved[events])
+
+		return self.trace_points((src.lat,src.lon,moved),self.stations[stations],src.dep,tracer)
+
+	def trace_events(self, src_lat, src_lon, src_dep, stations=None, tracer=None):
+		"""
+		Trace hypocenters that are not in the loaded catalog (e.g.
+		relocated events) to the loaded stations
+		###########
+		PARAMETERS:
+		src_lat, src_lon, src_dep (float array) ---- Hypocenters (depths in km)
+		stations (index or mask) ---- Stations to trace (default all)
+		tracer (Tracer) ---- Record calls, time and ray branches (optional)
+		###########
+		RETURNS:
+		Same as trace
+		###########
+		"""
+		src_lat = np.atleast_1d(np.asarray(src_lat,dtype=float))
+		src_lon = np.atleast_1d(np.asarray(src_lon,dtype=float))
+		src_dep = np.atleast_1d(np.asarray(src_dep,dtype=float))
+		stations = slice(None) if stations is None else stations
+		src = (src_lat,src_lon,self.model.offset_depths(src_dep))
+
+		return self.trace_points(src,self.stations[stations],src_dep,tracer)
+
+	def derivatives(self, events=None, stations=None, tracer=None):
+		"""
+		Derivatives of the P and S traveltimes of loaded station-event
+		pairs with respect to each layer velocity and depth to layer
+		top, for velocity model inversions (see rt.ray_derivatives).
+		Always ray traced in this process, without table or cache.
+		###########
+		PARAMETERS:
+		events (index or mask) ---- Events to trace (default all)
+		stations (index or mask) ---- Stations to trace (default all)
+		tracer (Tracer) ---- Record calls, time and ray branches (optional)
+		###########
+		RETURNS:
+		dtp_dv, dtp_dtop, dts_dv, dts_dtop[npairs,nl] (float array) ----
+					As rt.trace_pairs, pairs in the order of the
+					flattened [nsta,nsrc] arrays of trace
+		###########
+		"""
+		events = slice(None) if events is None else events
+		stations = slice(None) if stations is None else stations
+		src = self.events[events]
+		sta = self.stations[stations]
+		moved = np.atleast_1d(self.src_moved[events])
+		results = rt.trace_pairs(src.lat,src.lon,moved,sta.lat,sta.lon,*self.model.params,
+								 tracer=tracer,derivs=True,dtype=self.dtype)
+
+		return results[8:]
+
+	def trace_points(self, src, stations, src_dep, tracer=None):
+		"""Trace (lat, lon, moved depth) sources to a StationSet; src_dep as read for the cache keys"""
+		sta = (stations.lat,stations.lon)
+		model = self.model.params
+		if self.cache is not None:
+			keys,stakeys = self.cache.keys(src[0],src[1],src_dep,*sta)
+			return rt.trace_cached(*src,*sta,*model,self.cache,keys,stakeys,self.ttable,
+								   self.workers,tracer,self.dtype)
+		if self.workers > 1:
+			return rt.trace_parallel(*src,*sta,*model,self.ttable,self.workers,tracer=tracer,
+									 dtype=self.dtype)
+
+		return rt.trace_pairs(*src,*sta,*model,self.ttable,tracer,dtype=self.dtype)
+
+	def write(self, fileloc='rayTrace.src', fmt='text', block=None, incremental=None, tracer=None):
+		"""
+		Trace every pair and write the output file, as the command line does
+		###########
+		PARAMETERS:
+		fileloc (str) ---- Output file location (default='rayTrace.src')
+		fmt (str) ---- Output format, 'text' (default), 'npz' or 'raw' (see rt_io)
+		block (int) ---- Stream the output in tiles of about block pairs (optional)
+		incremental (str) ---- Sidecar of partials_incremental (optional)
+		tracer (Tracer) ---- Record calls, time and ray branches (optional)
+		###########
+		RETURNS:
+		ntraced (int) ---- Number of station-event pairs traced (not read
+					from the sidecar or the cache)
+		###########
+		"""
+		npairs = self.nsta*self.nsrc
+		if incremental is not None or block is not None:
+			events,stations = self.events,self.stations
+			args = (self.nsrc,events.cusp,events.lat,events.lon,events.dep,self.nsta,stations.lab,
+					stations.lat,stations.lon,*self.model.params,fileloc)
+			if incremental is not None:
+				return rt.partials_incremental(*args,incremental,self.ttable,self.workers,tracer,fmt,
+											   block or rt.BLOCK,self.dtype)
+			rt.partials_stream(*args,self.ttable,self.workers,tracer,fmt,block,self.dtype)
+			return npairs
+		hits = 0 if self.cache is None else self.cache.hits
+		rt.partials_catalog(self.events,self.stations,self.model,fileloc,self.ttable,self.workers,
+							tracer,fmt,self.cache,self.dtype)
+
+		return npairs if self.cache is None else npairs-(self.cache.hits-hits)
+
+
+# Version of the --profile report layout
+PROFILE_VERSION = 1
+
+def writeprofile(fileloc, tracer, raytracer, inputfile, ntraced, elapsed):
+	"""
+	Write the counts of a run as JSON
+	###########
+	PARAMETERS:
+	fileloc (str) ---- Report file location
+	tracer (Tracer) ---- Counts of the run
+	raytracer (RayTracer) ---- The traced catalog
+	inputfile (str) ---- Input file location
+	ntraced (int) ---- Station-event pairs traced
+	elapsed (float) ---- Wall time of the run (s)
+	###########
+	"""
+	run = OrderedDict([('inputfile',inputfile),('nsrc',raytracer.nsrc),('nsta',raytracer.nsta),
+					   ('nl',int(raytracer.model.nl)),('pairs',raytracer.nsrc*raytracer.nsta),
+					   ('traced',int(ntraced)),('workers',raytracer.workers),
+					   ('table',raytracer.ttable is not None),('backend',rt.get_backend()[0]),
+					   ('solver',rt.get_solver()),('precision',raytracer.dtype.name),
+					   ('elapsed',elapsed),
+					   ('python',platform.python_version()),('numpy',np.__version__)])
+	report = OrderedDict([('version',PROFILE_VERSION),('run',run)])
+	report.update(tracer.report())
+	with open(fileloc,'w') as profile:
+		json.dump(report,profile,indent=1)
+		profile.write('\n')
+
+
+def main(argv=None):
+	"""Command line entry point (argv defaults to sys.argv[1:])"""
+	parser = argparse.ArgumentParser(description='Python rayTrace from hypoDD (v1.3)')
+	parser.add_argument('inputfile',nargs='?',help='Input file location (default rayTrace.inp)')
+	parser.add_argument('outputfile',nargs='?',help='Output file location (default rayTrace.src)')
+	parser.add_argument('tablefile',nargs='?',help='Traveltime table file (.npz), built if missing')
+	parser.add_argument('--workers',type=int,default=1,help='Number of processes to trace with')
+	parser.add_argument('--trace',action='store_true',help='Print call counts, times and ray branches')
+	parser.add_argument('--profile',metavar='REPORT',
+						help='Write call counts, times, direct ray iterations and event layer counts as JSON to REPORT')
+	parser.add_argument('--format',choices=sorted(rt_io.WRITERS),default='text',
+						help='Output format: text rayTrace.src (default), npz archive or raw memmap file')
+	parser.add_argument('--block',type=int,help='Stream the output in tiles of about BLOCK station-event pairs')
+	parser.add_argument('--incremental',metavar='STATEFILE',
+						help='Reuse results kept in STATEFILE for unchanged events and stations')
+	parser.add_argument('--cache',metavar='DBFILE',help='Read and add traced pairs to the result cache DBFILE')
+	parser.add_argument('--cache-size',type=float,default=rt_cache.MAXSIZE/2**20,
+						help='Size limit of the result cache (MB, default %(default)g)')
+	parser.add_argument('--backend',choices=list(rt.BACKENDS),
+						help='Kernels to trace with (default RT_BACKEND or python; see rt_functions.set_backend)')
+	parser.add_argument('--precision',choices=('float64','float32'),default='float64',
+						help='Precision to trace and write binary output in (default float64)')
+	parser.add_argument('--solver',choices=list(rt.DIRECT_SOLVERS),
+						help='Direct ray solver (default RT_SOLVER or falsepos; see rt_functions.set_solver)')
+	args = parser.parse_args(argv)
+
+	if args.inputfile is None:
+		print('User Enter Inputs:')
+		inputfile = input('Inputfile location.  Default = "rayTrace.inp"')
+		if not inputfile:
+			inputfile = 'rayTrace.inp'
+		outputfile = input('Outputfile location.  Default = "rayTrace.src"')
+		if not outputfile:
+			outputfile = 'rayTrace.src'
+	elif args.outputfile is None:
+		parser.error('Not enough inputs.  Run format: run rt_run.py [inputfile] [outputfile] [tablefile]')
+	else:
+		inputfile = args.inputfile
+		outputfile = args.outputfile
+	if args.cache is not None and (args.block is not None or args.incremental is not None):
+		parser.error('--cache can not be used with --block or --incremental')
+
+	# Initialise data
+	rt.set_backend(args.backend)
+	rt.set_solver(args.solver)
+	cache = None
+	if args.cache is not None:
+		cache = rt_cache.ResultCache(args.cache,int(args.cache_size*2**20))
+	raytracer = RayTracer.from_inputfile(inputfile,workers=args.workers,cache=cache,dtype=args.precision)
+	# Load the traveltime table or build it for this catalog
+	if args.tablefile is not None:
+		raytracer.load_table(args.tablefile,verbose=True)
+
+	tracer = rt.Tracer() if args.trace or args.profile is not None else None
+	start = time.time()
+	print('Starting Partials')
+	ntraced = raytracer.write(outputfile,args.format,args.block,args.incremental,tracer)
+	if args.incremental is not None:
+		print('Traced %i of %i station-event pairs' % (ntraced,raytracer.nsta*raytracer.nsrc))
+	if cache is not None:
+		print('Read %i of %i station-event pairs from %s' % (cache.hits,raytracer.nsta*raytracer.nsrc,args.cache))
+		cache.close()
+	end = time.time()
+	print('rayTrace complete.  Outputs located in %s.  Time elapsed %f' % (outputfile,end-start))
+	if args.trace:
+		print(tracer.summary())
+	if args.profile is not None:
+		writeprofile(args.profile,tracer,raytracer,inputfile,ntraced,end-start)
+
+
+# RUN FROM INPUT TO OUTPUT
+if __name__ == '__main__':
+	main()
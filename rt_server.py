@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+import argparse
+import asyncio
+import json
+import numpy as np
+import os
+import signal
+import socket
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+import rt_io
+import rt_run
+
+"""
+Local traveltime server for rayTrace
+
+The velocity model and station table (and traveltime table, if given)
+are loaded once into an rt_run.RayTracer.  Clients on the same machine
+connect over a Unix socket or localhost TCP and send hypocenters; each
+gets back the rt_io.FIELDS arrays (traveltimes, partial derivatives,
+distance, azimuth and takeoff angle) for every station.  Requests that
+arrive within max-latency seconds of each other are traced together in
+one batch, so many small queries from separate processes cost about
+as much as one large one.
+
+Protocol (all numbers little endian):
+	on connect the server sends   b'RTS1' uint32 n  JSON[n]
+		JSON: {"stations": [labels], "fields": [rt_io.FIELDS]}
+	request                       b'RTQ1' uint32 nsrc  float64[nsrc,3]
+		rows of latitude, longitude, depth (km)
+	reply                         b'RTR1' uint32 nsta uint32 nsrc  float64[8,nsta,nsrc]
+	or on error                   b'RTE1' uint32 n  message[n] (utf-8)
+TravelTimeClient speaks this protocol.
+
+Run format: python rt_server.py [inputfile] [tablefile] [--socket rayTrace.sock | --port 8765]
+			[--max-latency 0.005] [--max-batch 10000] [--workers N]
+"""
+
+# Message tags
+GREETING = b'RTS1'
+REQUEST = b'RTQ1'
+REPLY = b'RTR1'
+ERROR = b'RTE1'
+
+# Default time a request waits for others to batch with (s)
+MAX_LATENCY = 0.005
+
+# Default maximum number of events traced in one batch
+MAX_BATCH = 10000
+
+
+class Batcher(object):
+	"""
+	Collects the hypocenters of concurrent requests and traces them
+	together with RayTracer.trace_events.
+	###########
+	A batch is traced max_latency seconds after its first request
+	arrives, or as soon as it holds max_batch events.  Tracing runs
+	in a worker thread so the event loop keeps accepting requests,
+	and one batch is traced at a time.  Requests whose hypocenters
+	can not be traced (not finite, or deeper than the top of the last
+	layer) fail alone instead of failing their batch.
+	###########
+	PARAMETERS:
+	raytracer (RayTracer) ---- Loaded model and stations
+	max_latency (float) ---- Seconds a request waits for others (default MAX_LATENCY)
+	max_batch (int) ---- Events per batch (default MAX_BATCH)
+	###########
+	"""
+	def __init__(self, raytracer, max_latency=MAX_LATENCY, max_batch=MAX_BATCH):
+		self.raytracer = raytracer
+		self.max_latency = max_latency
+		self.max_batch = max_batch
+		self.pending = []
+		self.npending = 0
+		self.timer = None
+		self.executor = ThreadPoolExecutor(1)
+		self.requests = 0
+		self.batches = 0
+
+	def check(self, src):
+		"""Raise ValueError if the [n,3] hypocenters can not be traced"""
+		deepest = self.raytracer.model.top[self.raytracer.model.nl-1]
+		if not np.isfinite(src).all():
+			raise ValueError('Hypocenters must be finite')
+		if (src[:,2] > deepest).any():
+			raise ValueError('Depths must not be below the top of the last layer (%g km)' % deepest)
+
+	def submit(self, src):
+		"""
+		Queue hypocenters for the next batch
+		###########
+		PARAMETERS:
+		src[n,3] (float array) ---- Latitudes, longitudes and depths (km)
+		###########
+		RETURNS:
+		future (asyncio.Future) ---- Resolves to the [8,nsta,n] results
+		###########
+		"""
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+		try:
+			self.check(src)
+		except ValueError as error:
+			future.set_exception(error)
+			return future
+		self.requests += 1
+		self.pending.append((src,future))
+		self.npending += len(src)
+		if self.npending >= self.max_batch:
+			self.flush()
+		elif self.timer is None:
+			self.timer = loop.call_later(self.max_latency,self.flush)
+
+		return future
+
+	def flush(self):
+		"""Start tracing the pending requests as one batch"""
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+		if not self.pending:
+			return
+		batch = self.pending
+		self.pending = []
+		self.npending = 0
+		self.batches += 1
+		asyncio.ensure_future(self.run(batch))
+
+	async def run(self, batch):
+		"""Trace a batch in the worker thread and hand each request its columns"""
+		src = np.concatenate([part for part,future in batch])
+		loop = asyncio.get_running_loop()
+		try:
+			results = await loop.run_in_executor(self.executor,self.raytracer.trace_events,
+												 src[:,0],src[:,1],src[:,2])
+		except Exception as error:
+			for part,future in batch:
+				if not future.done():
+					future.set_exception(error)
+			return
+		results = np.stack(results)
+		j0 = 0
+		for part,future in batch:
+			j1 = j0+len(part)
+			if not future.done():
+				future.set_result(results[:,:,j0:j1])
+			j0 = j1
+
+
+async def send_error(writer, message):
+	text = str(message).encode('utf-8')
+	writer.write(ERROR+struct.pack('<I',len(text))+text)
+	await writer.drain()
+
+
+async def serve_client(batcher, greeting, reader, writer):
+	"""Answer the requests of one connection until it closes"""
+	try:
+		writer.write(greeting)
+		await writer.drain()
+		while True:
+			header = await reader.readexactly(8)
+			if header[:4] != REQUEST:
+				await send_error(writer,'Bad request tag %r' % header[:4])
+				break
+			nsrc, = struct.unpack('<I',header[4:])
+			src = np.frombuffer(await reader.readexactly(24*nsrc),dtype='<f8').reshape(nsrc,3)
+			try:
+				results = await batcher.submit(src)
+			except Exception as error:
+				await send_error(writer,error)
+				continue
+			writer.write(REPLY+struct.pack('<II',results.shape[1],nsrc))
+			writer.write(np.ascontiguousarray(results,dtype='<f8').tobytes())
+			await writer.drain()
+	except (asyncio.IncompleteReadError,ConnectionError):
+		pass
+	finally:
+		writer.close()
+
+
+async def serve(raytracer, path=None, host='127.0.0.1', port=None, max_latency=MAX_LATENCY,
+				max_batch=MAX_BATCH, ready=None):
+	"""
+	Serve traveltimes until cancelled
+	###########
+	PARAMETERS:
+	raytracer (RayTracer) ---- Loaded model and stations
+	path (str) ---- Unix socket location (used if given)
+	host, port (str, int) ---- TCP address otherwise (default host 127.0.0.1)
+	max_latency, max_batch ---- As in Batcher
+	ready (function) ---- Called with the Batcher once listening (optional)
+	###########
+	"""
+	batcher = Batcher(raytracer,max_latency,max_batch)
+	info = json.dumps({'stations':raytracer.stations.lab.tolist(),
+					   'fields':list(rt_io.FIELDS)}).encode('utf-8')
+	greeting = GREETING+struct.pack('<I',len(info))+info
+	handler = lambda reader,writer: serve_client(batcher,greeting,reader,writer)
+	if path is not None:
+		if os.path.exists(path):
+			os.remove(path)
+		server = await asyncio.start_unix_server(handler,path)
+	else:
+		server = await asyncio.start_server(handler,host,port)
+	try:
+		async with server:
+			if ready is not None:
+				ready(batcher)
+			await server.serve_forever()
+	finally:
+		batcher.executor.shutdown(wait=False)
+		if path is not None and os.path.exists(path):
+			os.remove(path)
+
+
+class TravelTimeClient(object):
+	"""
+	Blocking client of a local traveltime server
+	###########
+	PARAMETERS:
+	path (str) ---- Unix socket location (used if given)
+	host, port (str, int) ---- TCP address otherwise (default host 127.0.0.1)
+	###########
+	"""
+	def __init__(self, path=None, host='127.0.0.1', port=None):
+		if path is not None:
+			self.sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+			self.sock.connect(path)
+		else:
+			self.sock = socket.create_connection((host,port))
+			self.sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+		tag,n = struct.unpack('<4sI',self.recv(8))
+		if tag != GREETING:
+			raise IOError('Not a rayTrace server (tag %r)' % tag)
+		info = json.loads(self.recv(n).decode('utf-8'))
+		self.stations = info['stations']
+		self.fields = tuple(info['fields'])
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		self.sock.close()
+
+	def recv(self, n):
+		"""Read exactly n bytes"""
+		data = bytearray(n)
+		view = memoryview(data)
+		while n:
+			k = self.sock.recv_into(view,n)
+			if k == 0:
+				raise IOError('Server closed the connection')
+			view = view[k:]
+			n -= k
+
+		return data
+
+	def trace(self, src_lat, src_lon, src_dep):
+		"""
+		Trace hypocenters to every station of the server
+		###########
+		PARAMETERS:
+		src_lat, src_lon, src_dep (float array) ---- Hypocenters (depths in km)
+		###########
+		RETURNS:
+		results (tuple) ---- The rt_io.FIELDS arrays [nsta,nsrc]
+		###########
+		"""
+		src = np.stack([np.atleast_1d(np.asarray(x,dtype='<f8')) for x in (src_lat,src_lon,src_dep)],axis=1)
+		self.sock.sendall(REQUEST+struct.pack('<I',len(src))+src.tobytes())
+		tag = bytes(self.recv(4))
+		if tag == ERROR:
+			n, = struct.unpack('<I',self.recv(4))
+			raise ValueError(self.recv(n).decode('utf-8'))
+		if tag != REPLY:
+			raise IOError('Bad reply tag %r' % tag)
+		nsta,nsrc = struct.unpack('<II',self.recv(8))
+		results = np.frombuffer(self.recv(8*len(self.fields)*nsta*nsrc),dtype='<f8')
+
+		return tuple(results.reshape(len(self.fields),nsta,nsrc))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Local rayTrace traveltime server')
+	parser.add_argument('inputfile',nargs='?',default='rayTrace.inp',help='Input file location (default rayTrace.inp)')
+	parser.add_argument('tablefile',nargs='?',help='Traveltime table file (.npz), built if missing')
+	parser.add_argument('--socket',help='Unix socket to listen on (default rayTrace.sock unless --port)')
+	parser.add_argument('--host',default='127.0.0.1',help='TCP host with --port (default 127.0.0.1)')
+	parser.add_argument('--port',type=int,help='TCP port to listen on instead of a Unix socket')
+	parser.add_argument('--max-latency',type=float,default=MAX_LATENCY,
+						help='Seconds a request waits to be batched with others (default %(default)g)')
+	parser.add_argument('--max-batch',type=int,default=MAX_BATCH,
+						help='Maximum events traced in one batch (default %(default)i)')
+	parser.add_argument('--workers',type=int,default=1,help='Number of processes to trace with')
+	args = parser.parse_args()
+	path = args.socket if args.socket is not None or args.port is not None else 'rayTrace.sock'
+
+	raytracer = rt_run.RayTracer.from_inputfile(args.inputfile,args.tablefile,workers=args.workers)
+	batchers = []
+	def ready(batcher):
+		batchers.append(batcher)
+		print('Serving %i stations on %s' % (raytracer.nsta,path or '%s:%i' % (args.host,args.port)))
+	def stop(signum, frame):
+		raise KeyboardInterrupt
+	# Stop cleanly when killed as a daemon too
+	signal.signal(signal.SIGTERM,stop)
+	start = time.time()
+	try:
+		asyncio.run(serve(raytracer,path,args.host,args.port,args.max_latency,args.max_batch,ready))
+	except KeyboardInterrupt:
+		pass
+	if batchers:
+		print('Served %i requests in %i batches over %.1f s' % (batchers[0].requests,batchers[0].batches,
+															  time.time()-start))
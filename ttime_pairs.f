@@ -0,0 +1,103 @@
+c Traveltimes of many station-event pairs, for the f2py extension
+c built by rt_fortran.py.  Each pair is traced as in ttime, which
+c only returns t and ain, so the ray (refracting layer, sine of the
+c takeoff angle and event layer leg of the direct ray) is returned too.
+
+	subroutine ttime_pairs(n, nl, v, top, depth, delta,
+     &	t, ain, kk, u, x, near)
+
+	implicit none
+
+	include "rayTrace.inc"
+
+c	Parameters:
+	integer	n
+	integer	nl
+	real	v(nl)
+	real	top(nl)
+	real	depth(n)
+	real	delta(n)
+	real	t(n)
+	real	ain(n)
+	integer	kk(n)
+	real	u(n)
+	real	x(n)
+	integer	near(n)
+Cf2py	intent(in) v, top, depth, delta
+Cf2py	intent(out) t, ain, kk, u, x, near
+Cf2py	integer intent(hide), depend(v) :: nl = len(v)
+Cf2py	integer intent(hide), depend(delta) :: n = len(delta)
+
+c	Local variables:
+	integer	i
+	integer	jl
+	integer	k
+	real	tdir
+	real	thk(MAXLAY)
+	real	tkj
+	real	tref
+	real	ui
+	real	vsq(MAXLAY)
+	real	xi
+	real	xovmax
+
+c	input:
+c	delta	epicentral distance of each pair in km
+c	depth	focal depth of the source of each pair in km
+c	nl	number of layers in velocity model (at most MAXLAY)
+c	v	velocity in each layer
+c	top	depth to top of layer
+
+c	output:
+c	t	minimum traveltime
+c	ain	angle of emergence at source (unset without a ray)
+c	kk	refracting layer of the fastest ray, -1 for the
+c		direct ray and 0 for none
+c	u	sine of the takeoff angle of the direct ray
+c	x	horizontal travel distance in the event layer
+c	near	1 if delta <= xovmax, so the direct ray was solved
+
+c	squares and thicknesses from a source inside the model
+	call vmodel(nl,v,top,top(1)+1.,vsq,thk,jl,tkj)
+
+	do 10 i=1,n
+
+c	sources at or above the top of layer 1 are put in it
+c	(vmodel would take the depth of top(0))
+	if (depth(i).gt.top(1)) then
+	call vmodel(nl,v,top,depth(i),vsq,thk,jl,tkj)
+	else
+	jl=1
+	tkj=depth(i)-top(1)
+	endif
+
+	call refract(nl,v,vsq,thk,jl,tkj,delta(i),
+     &			k,tref,xovmax)
+
+	t(i)=tref
+	kk(i)=k
+	u(i)=0.
+	x(i)=0.
+	near(i)=0
+	if (k.gt.0) then
+	ain(i)=asin(v(jl)/v(k))*57.2958
+	endif
+
+	if (delta(i).le.xovmax) then
+	near(i)=1
+	call direct1(nl,v,vsq,thk,jl,tkj,delta(i),depth(i),tdir,ui,xi)
+
+c	direct time is the minimum traveltime
+	if (tref.gt.tdir) then
+	t(i)=tdir
+	ain(i)=180-asin(ui)*57.2958
+	kk(i)=-1
+	u(i)=ui
+	x(i)=xi
+	endif
+	endif
+   10	continue
+
+	return
+c *****	end of subroutine ttime_pairs *****
+	end